@@ -0,0 +1,121 @@
+"""
+禁止ワードのパターンの検証と最悪ケースの照合時間のベンチマーク
+処理時間が急激に増えるパターン（[b-c]+[b-c]+z など）が登録時に拒否され、登録できるパターンは
+最悪に近い4,000文字のメッセージでも照合時間が上限以内に収まることを確認します。
+登録時の検証（別プロセス）の間にイベントループが止まらないことも確認します。
+
+使用例:
+python -m benchmarks.bench_banword_patterns
+python -m benchmarks.bench_banword_patterns --budget-ms 5
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import command
+import detector_worker
+
+# 登録を拒否すべきパターン（照合すると数秒から数分イベントループが止まるもの・使用できない構文のもの）
+REJECTED_PATTERNS = (
+    're:[b-c]+[b-c]+z',
+    're:[b-c]+[b-c]+[b-c]+z',
+    're:[b-c]{1,100}[b-c]{1,100}z',
+    're:([b-c]+)[b-c]+z',
+    're:(?:ab|[b-c]+)[b-c]+z',
+    're:[^x]+[^y]+z',
+    're:\\w+\\d+x',
+    're:.{0,10}.{0,10}.{0,10}z',
+    're:a.*b.*c',
+    're:(a+)+b',
+    're:(a|ab)+c',
+    're:fr\\w+e',
+    're:[a-z]+\\s[a-z]+\\s[a-z]+\\s[a-z]+!',
+    're:\\w*-\\w*-\\w*-\\w*x',
+    're:(?i)free',
+    's*p*a*m',
+)
+
+# 登録できるべきパターン
+ACCEPTED_PATTERNS = (
+    'f*ck',
+    'f*c*k',
+    're:fr[e3]{1,3}',
+    're:spam+',
+    're:fr\\w{1,10}e',
+    're:\\bfree\\b',
+    're:d[i1!]ck',
+    're:discord\\.gg/\\w{2,10}',
+)
+
+MESSAGE_LENGTH = 4000
+
+def worst_case_messages(entry):
+    """登録時の検証と同じ、一致しかけては失敗する入力（最長のメッセージ）"""
+    tree = detector_worker.re_parser.parse(detector_worker.pattern_source(entry))
+    return [(unit * MESSAGE_LENGTH)[:MESSAGE_LENGTH] for unit in detector_worker.probe_units(tree)]
+
+async def measure_validation_stall(entries):
+    """別プロセスでの検証を順に行い、その間のイベントループの最大の停止時間（秒）を返す"""
+    stalls = [0.0]
+    
+    async def ticker():
+        interval = 0.005
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            stalls.append(now - last - interval)
+            last = now
+    
+    task = asyncio.create_task(ticker())
+    for entry in entries:
+        await command.validate_pattern_in_process(entry, False)
+    task.cancel()
+    return max(stalls)
+
+def main():
+    parser = argparse.ArgumentParser(description="禁止ワードのパターンの検証と最悪ケースの照合時間のベンチマーク")
+    parser.add_argument('--budget-ms', type=float, default=10.0, help="登録できるパターンの照合1回あたりの上限（ミリ秒）")
+    parser.add_argument('--stall-budget-ms', type=float, default=50.0, help="登録時の検証中のイベントループの停止時間の上限（ミリ秒）")
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'パターン':<36} {'期待':>6} {'結果':>6} {'最悪照合(ms)':>14}")
+    for entry in REJECTED_PATTERNS + ACCEPTED_PATTERNS:
+        expected = entry in ACCEPTED_PATTERNS
+        problem = detector_worker.validate_pattern(entry, False)
+        accepted = problem is None
+        worst = 0.0
+        if accepted:
+            # 拒否すべきパターンは照合しない（止まらなくなるため）
+            matcher = detector_worker.compile_banword_matcher([entry], False)
+            for message in worst_case_messages(entry):
+                started_at = time.perf_counter()
+                detector_worker.match_banwords(matcher, message)
+                worst = max(worst, time.perf_counter() - started_at)
+        mark = ''
+        if accepted != expected or worst * 1000 > args.budget_ms:
+            failures.append(entry)
+            mark = ' ❌'
+        print(f"{entry:<36} {'登録' if expected else '拒否':>6} {'登録' if accepted else '拒否':>6} {worst * 1000:>14.2f}{mark}")
+        if problem and expected:
+            print(f"    理由: {problem}")
+
+    stall = asyncio.run(measure_validation_stall(REJECTED_PATTERNS + ACCEPTED_PATTERNS))
+    print(f"\n登録時の検証中のイベントループの最大停止: {stall * 1000:.1f}ms")
+    if stall * 1000 > args.stall_budget_ms:
+        failures.append('（検証中のイベントループの停止）')
+
+    print()
+    if failures:
+        print(f"❌ 期待どおりでないパターン: {', '.join(failures)}")
+        return 1
+    print("✅ すべてのパターンが期待どおりでした")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
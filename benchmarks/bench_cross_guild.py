@@ -0,0 +1,82 @@
+"""
+複数サーバー横断の同一内容検出の誤検出率ベンチマーク
+多数のサーバー・ユーザーがすべて異なる内容を投稿する通常のトラフィックを流し、スパムと判定された割合（誤検出率）を
+メッセージの流量ごとに計測します。同時に、複数サーバーで同じ内容を投稿するスパムが検出されることも確認します。
+
+使用例:
+python -m benchmarks.bench_cross_guild
+python -m benchmarks.bench_cross_guild --guilds 200 --users 20000 --rates 20 50 200 --duration 600
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import command
+from benchmarks.bench_hot_path import random_text
+
+def reset_sketch(now):
+    command.fingerprint_sketch['current'] = command.create_fingerprint_generation()
+    command.fingerprint_sketch['previous'] = command.create_fingerprint_generation()
+    command.fingerprint_sketch['rotated_at'] = now
+
+def record(guild_id, user_id, text, now):
+    features = command.MessageFeatures(text)
+    return command.record_message_fingerprint(guild_id, user_id, features.text, now, features.content_hash)
+
+def run_rate(rng, args, rate):
+    """rate件/秒のすべて異なる内容を流し、(誤検出の件数, 件数, 1件あたりの秒数, スパムを検出したか) を返す"""
+    now = 1_700_000_000.0
+    reset_sketch(now)
+    total = int(rate * args.duration)
+    false_positives = 0
+    elapsed = 0.0
+    spam_text = random_text(rng, 60) + " 無料でNitroを配布中"
+    spam_detected = False
+    for index in range(total):
+        now += 1 / rate
+        text = f"{random_text(rng, rng.randint(30, 80))} {index}"
+        started_at = time.perf_counter()
+        false_positives += record(rng.randrange(args.guilds), rng.randrange(args.users), text, now)
+        elapsed += time.perf_counter() - started_at
+
+        # 終盤に、同じ内容を別々のサーバー・ユーザーが投稿するスパムを混ぜる
+        if index == total - 5 * command.CROSS_GUILD_SETTINGS['guild_threshold']:
+            for spammer in range(command.CROSS_GUILD_SETTINGS['guild_threshold']):
+                spam_detected = record(args.guilds + spammer, args.users + spammer, spam_text, now)
+    return false_positives, total, elapsed / total, spam_detected
+
+def main():
+    parser = argparse.ArgumentParser(description="複数サーバー横断の同一内容検出の誤検出率ベンチマーク")
+    parser.add_argument('--guilds', type=int, default=200, help="サーバー数")
+    parser.add_argument('--users', type=int, default=20000, help="ユーザー数")
+    parser.add_argument('--rates', type=float, nargs='+', default=[20, 50, 200], help="プロセス全体のメッセージ数/秒")
+    parser.add_argument('--duration', type=float, default=600, help="流す時間（秒、擬似時刻）")
+    args = parser.parse_args()
+
+    rng = random.Random('cross-guild')
+    failures = 0
+    print(f"{args.guilds}サーバー / {args.users}ユーザー / {args.duration:.0f}秒 "
+          f"（スケッチ {command.CROSS_GUILD_SETTINGS['width']}×{command.CROSS_GUILD_SETTINGS['depth']}）")
+    print(f"{'件/秒':>8} {'件数':>10} {'誤検出':>8} {'誤検出率':>10} {'1件あたり(µs)':>14} {'スパム検出':>10}")
+    for rate in args.rates:
+        false_positives, total, per_message, spam_detected = run_rate(rng, args, rate)
+        mark = ''
+        if false_positives or not spam_detected:
+            failures += 1
+            mark = ' ❌'
+        print(f"{rate:>8.0f} {total:>10,} {false_positives:>8} {false_positives / total:>9.3%} "
+              f"{per_message * 1e6:>14.2f} {'✅' if spam_detected else '❌':>10}{mark}")
+
+    print()
+    if failures:
+        print("❌ 誤検出があったか、スパムを検出できませんでした")
+        return 1
+    print("✅ 誤検出はなく、スパムを検出しました")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,283 @@
+"""
+モデレーション処理のエンドツーエンド遅延ベンチマーク
+ローカルの擬似Discord REST サーバー（benchmarks/fake_rest.py）に discord.py の HTTPClient を接続し、
+handle_spam_action / handle_banned_word_action / n!ban / n!dice を同時実行して、
+判定からAPI呼び出し完了までの遅延分布と429の発生回数、送信スケジューラの分類ごとの待ち時間を計測します。
+
+使用例:
+python -m benchmarks.bench_e2e_latency
+python -m benchmarks.bench_e2e_latency --decisions 500 --rate 0 --concurrency 50 --inject-429 0.02
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import discord
+import discord.http
+
+import command
+from benchmarks.fake_rest import FakeDiscordRest
+from benchmarks.fakes import FakeChannel, FakeGuild, FakeMessage, FakePermissions
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_PATH = os.path.join(BENCHMARK_DIR, 'results', 'e2e_latency.json')
+
+# 実行中の判定（種類, 開始時刻）。タスクごとに引き継がれる
+current_decision = contextvars.ContextVar('current_decision')
+
+class FakeTextChannel(FakeChannel, discord.TextChannel):
+    """handle_spam_action の isinstance チェックを通り、チャンネル権限の上書きまで実行させるためのチャンネル"""
+
+class HttpApi:
+    """FakeGuild の API 呼び出しを discord.py の HTTPClient 経由の本物のHTTPリクエストに変換"""
+    def __init__(self, http):
+        self.http = http
+        self.samples = []  # (判定の種類, API呼び出し, 判定からの遅延秒, 成功したか)
+
+    async def call(self, name, **params):
+        decision = current_decision.get(None)
+        ok = False
+        try:
+            result = await self.request(name, params)
+            ok = True
+            return result
+        except discord.NotFound:
+            ok = True  # 未バンの確認など、404も正常な応答
+            raise
+        finally:
+            if decision:
+                self.samples.append((decision[0], name, time.perf_counter() - decision[1], ok))
+
+    async def request(self, name, params):
+        http = self.http
+        if name == 'delete':
+            return await http.delete_message(params['channel_id'], params['message_id'])
+        if name == 'send':
+            payload = {'content': params.get('content')}
+            if params.get('embed'):
+                payload['embeds'] = [params['embed'].to_dict()]
+            route = discord.http.Route('POST', '/channels/{channel_id}/messages', channel_id=params['channel_id'])
+            return await http.request(route, json=payload)
+        if name == 'create_role':
+            return await http.create_role(params['guild_id'], name=params['role_name'])
+        if name == 'add_roles':
+            return await http.add_role(params['guild_id'], params['user_id'], params['role_id'])
+        if name == 'remove_roles':
+            return await http.remove_role(params['guild_id'], params['user_id'], params['role_id'])
+        if name == 'set_permissions':
+            return await http.edit_channel_permissions(params['channel_id'], params['target_id'], '0', '2099200', 0)
+        if name == 'timeout':
+            return await http.edit_member(params['guild_id'], params['user_id'], communication_disabled_until=None)
+        if name == 'ban':
+            return await http.ban(params['user_id'], params['guild_id'], 0, params.get('reason'))
+        if name == 'unban':
+            return await http.unban(params['user_id'], params['guild_id'])
+        if name == 'fetch_ban':
+            return await http.get_ban(params['user_id'], params['guild_id'])
+        raise ValueError(f"未対応のAPI呼び出し: {name}")
+
+class FakeContext:
+    """n!ban のコールバックを直接呼ぶための最小限の commands.Context"""
+    def __init__(self, guild, channel, author, mentions, command=None):
+        self.command = command
+        self.invoked_with = command.name if command else None
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.message = FakeMessage(author, channel, "")
+        self.message.mentions = mentions
+
+    async def send(self, content=None, *, embed=None, **kwargs):
+        return await self.channel.send(content, embed=embed)
+
+def build_world(api, guilds, channels_per_guild, members_per_guild):
+    world = []
+    for index in range(guilds):
+        guild = FakeGuild(name=f"guild{index}", api=api)
+        guild.me.guild_permissions = FakePermissions(ban_members=True)
+        moderator = guild.add_member(name=f"mod{index}", roles=[guild.add_role("moderator", position=50)])
+        channels = []
+        for channel_index in range(channels_per_guild):
+            channel = FakeTextChannel(guild, f"channel{channel_index}")
+            guild.channels.append(channel)
+            channels.append(channel)
+        members = [guild.add_member() for _ in range(members_per_guild)]
+        world.append((guild, moderator, channels, members))
+    return world
+
+async def run_decision(kind, coroutine_factory, ctx=None):
+    current_decision.set((kind, time.perf_counter()))
+    # コマンドはボット本体と同じく global check で送信の分類を決める（受け付けなかった場合は実行しない）
+    if ctx is not None and not await command.classify_outbound_requests(ctx):
+        return
+    await coroutine_factory()
+
+def plan_decisions(rng, world, count, banword_action):
+    """判定の種類（spam / banword / ban / fun）を混ぜた実行計画を作成"""
+    plan = []
+    for _ in range(count):
+        guild, moderator, channels, members = rng.choice(world)
+        channel = rng.choice(channels)
+        member = rng.choice(members)
+        kind = rng.choices(('spam', 'banword', 'ban', 'fun'), weights=(6, 3, 1, 4))[0]
+        if kind == 'spam':
+            message = FakeMessage(member, channel, "spam spam spam")
+            plan.append((kind, lambda message=message: command.handle_spam_action(message), None))
+        elif kind == 'banword':
+            message = FakeMessage(member, channel, "forbidden")
+            plan.append((kind, lambda message=message: command.handle_banned_word_action(message, "forbidden"), None))
+        elif kind == 'ban':
+            ctx = FakeContext(guild, channel, moderator, [member], command.ban_user)
+            plan.append((kind, lambda ctx=ctx, member=member: command.ban_user.callback(ctx, str(member.id), reason="ベンチマーク"), ctx))
+        else:
+            ctx = FakeContext(guild, channel, member, [], command.dice_roll)
+            plan.append((kind, lambda ctx=ctx: command.dice_roll.callback(ctx, "3d6"), ctx))
+    return plan
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+def summarize(api, server):
+    """判定の種類×API呼び出しごとの遅延分布と、APIごとの429回数を集計"""
+    groups = {}
+    for kind, name, latency, ok in api.samples:
+        group = groups.setdefault(f"{kind}/{name}", {'latencies': [], 'failures': 0})
+        group['latencies'].append(latency)
+        if not ok:
+            group['failures'] += 1
+
+    latency = {}
+    for key, group in sorted(groups.items()):
+        values = sorted(group['latencies'])
+        latency[key] = {
+            'count': len(values),
+            'failures': group['failures'],
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p90_ms': percentile(values, 0.90) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'max_ms': values[-1] * 1000
+        }
+
+    requests = {}
+    for record in server.requests:
+        counts = requests.setdefault(record.kind, {'requests': 0, 'rate_limited': 0})
+        counts['requests'] += 1
+        if record.status == 429:
+            counts['rate_limited'] += 1
+
+    # 送信スケジューラの分類ごとの待ち
+    outbound = {}
+    for name, stats in command.outbound_stats.items():
+        count, (p50, p99) = command.query_perf(f'outbound:{name}', 60)
+        outbound[name] = {'requests': stats['requests'], 'queued': stats['queued'], 'shed': stats['shed'],
+                          'wait_p50_ms': p50 * 1000, 'wait_p99_ms': p99 * 1000}
+    return {'latency': latency, 'requests': requests, 'outbound': outbound}
+
+def print_report(report):
+    print(f"判定数: {report['decisions']}  例外で終了: {report['errors']}  到着レート: {report['settings']['rate']}件/秒  同時実行数: {report['concurrency']}  所要時間: {report['elapsed']:.2f}秒")
+    print()
+    print(f"{'判定/API呼び出し':<28}{'件数':>7}{'失敗':>6}{'p50(ms)':>10}{'p90(ms)':>10}{'p99(ms)':>10}{'最大(ms)':>10}")
+    for key, row in report['latency'].items():
+        print(f"{key:<28}{row['count']:>7}{row['failures']:>6}{row['p50_ms']:>10.1f}{row['p90_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+    print()
+    print(f"{'API':<20}{'リクエスト':>10}{'429':>8}")
+    for kind, counts in sorted(report['requests'].items()):
+        print(f"{kind:<20}{counts['requests']:>10}{counts['rate_limited']:>8}")
+    print()
+    print(f"{'送信の分類':<16}{'送信':>7}{'待機':>7}{'受付停止':>9}{'待ちp50(ms)':>13}{'待ちp99(ms)':>13}")
+    for name, row in report['outbound'].items():
+        print(f"{name:<16}{row['requests']:>7}{row['queued']:>7}{row['shed']:>9}{row['wait_p50_ms']:>13.1f}{row['wait_p99_ms']:>13.1f}")
+
+async def run(args):
+    server = await FakeDiscordRest(bucket_limit=args.bucket_limit, bucket_window=args.bucket_window,
+                                   global_limit=args.global_limit, inject_429=args.inject_429,
+                                   latency=args.server_latency / 1000, seed=args.seed).start()
+    # Route はURLを生成時に組み立てるため、HTTPClient を作る前に接続先を差し替える
+    discord.http.Route.BASE = server.base_url
+    http = discord.http.HTTPClient(asyncio.get_running_loop())
+    await http.static_login('benchmark-token')
+    if not args.no_scheduler:
+        command.OUTBOUND_SETTINGS['global_limit'] = args.global_limit
+        command.install_outbound_scheduler(http)
+
+    api = HttpApi(http)
+    rng = random.Random(args.seed)
+    world = build_world(api, args.guilds, args.channels, args.members)
+    plan = plan_decisions(rng, world, args.decisions, args.banword_action)
+    for guild, _, _, _ in world:
+        command.banword_data[guild.id]['action'] = args.banword_action
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index, kind, factory, ctx):
+        # 判定は --rate 件/秒 で到着し、同時に処理するのは --concurrency 件まで
+        if args.rate:
+            await asyncio.sleep(index / args.rate)
+        async with semaphore:
+            await run_decision(kind, factory, ctx)
+
+    async def confirm_immediately(*args, **kwargs):
+        return None
+
+    started = time.perf_counter()
+    command.LOG_SETTINGS['level'] = 'off'
+    with mock.patch.object(command.bot, 'wait_for', confirm_immediately):
+        outcomes = await asyncio.gather(*(limited(index, kind, factory, ctx) for index, (kind, factory, ctx) in enumerate(plan)),
+                                        return_exceptions=True)
+        # 集約された警告メッセージの送信を待つ
+        await asyncio.gather(*(buffer['task'] for buffer in list(command.pending_notices.values())), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    # ミュート解除の待機タスクは計測対象外
+    for task in command.pending_unmutes.values():
+        task.cancel()
+    command.pending_unmutes.clear()
+
+    await http.close()
+    await server.stop()
+
+    report = summarize(api, server)
+    report.update({'decisions': args.decisions, 'errors': sum(isinstance(outcome, Exception) for outcome in outcomes), 'concurrency': args.concurrency, 'elapsed': elapsed,
+                   'settings': {key: value for key, value in vars(args).items() if key != 'output'}})
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="擬似Discord REST サーバーに対するモデレーション処理の遅延ベンチマーク")
+    parser.add_argument('--decisions', type=int, default=300, help="実行する判定の数")
+    parser.add_argument('--rate', type=float, default=20.0, help="判定の到着レート（件/秒、0で一斉に実行）")
+    parser.add_argument('--concurrency', type=int, default=30, help="同時に処理する判定の数")
+    parser.add_argument('--guilds', type=int, default=3)
+    parser.add_argument('--channels', type=int, default=3, help="1サーバーあたりのチャンネル数")
+    parser.add_argument('--members', type=int, default=40, help="1サーバーあたりのメンバー数")
+    parser.add_argument('--banword-action', choices=('delete', 'warn', 'mute'), default='delete')
+    parser.add_argument('--bucket-limit', type=int, default=5, help="バケットごとの上限（件/ウィンドウ）")
+    parser.add_argument('--bucket-window', type=float, default=1.0, help="バケットのウィンドウ（秒）")
+    parser.add_argument('--global-limit', type=int, default=50, help="全体の上限（件/秒）")
+    parser.add_argument('--no-scheduler', action='store_true', help="送信スケジューラを使わずに計測（比較用）")
+    parser.add_argument('--inject-429', type=float, default=0.0, help="無条件に429を返す確率")
+    parser.add_argument('--server-latency', type=float, default=0.0, help="サーバー側の処理遅延（ミリ秒）")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=RESULT_PATH, help="結果を保存するJSONファイル")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+モデレーションのホットパスのベンチマーク
+is_spam / contains_banned_word / is_whitelisted と on_message 全体（有効な機能がないサーバー・過負荷時の縮退を含む）を擬似オブジェクトで実行し、
+結果をJSONに保存して、コミット済みのベースラインと比較します。
+
+使用例:
+python -m benchmarks.bench_hot_path                    # 計測してベースラインと比較
+python -m benchmarks.bench_hot_path --quick            # 小さい条件のみ計測
+python -m benchmarks.bench_hot_path --update-baseline  # ベースラインを更新
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import string
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import command
+from benchmarks.fakes import FakeClock, FakeGuild, FakeMessage, install_bot_user
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baselines', 'hot_path.json')
+RESULT_PATH = os.path.join(BENCHMARK_DIR, 'results', 'hot_path.json')
+
+BANWORD_COUNTS = (10, 100, 1000, 10000, 50000)
+MESSAGE_LENGTHS = (10, 100, 1000, 4000)
+MESSAGE_RATES = (10, 100, 1000)   # 1サーバーあたりのメッセージ数/秒
+WHITELIST_ROLE_COUNTS = (1, 10, 50)
+ACTIVE_USERS = 50
+
+def random_word(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+def random_text(rng, length):
+    """指定した長さの単語列（禁止ワードに一致しないよう数字を混ぜる）"""
+    words = []
+    size = 0
+    while size < length:
+        word = random_word(rng, rng.randint(2, 8)) + str(rng.randint(0, 9))
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words)[:length]
+
+def reset_state():
+    """ベンチマーク間でモジュールの状態を初期化"""
+    for name in ('user_message_history', 'user_last_messages', 'user_warnings', 'spam_stats',
+                 'whitelist_data', 'banword_data', 'near_duplicate_index', 'signature_cache',
+                 'member_verdicts', 'guild_features'):
+        getattr(command, name).clear()
+    command.fingerprint_sketch['current'] = command.create_fingerprint_generation()
+    command.fingerprint_sketch['previous'] = command.create_fingerprint_generation()
+
+async def measure(setup, operations, repeats):
+    """setupで状態を作ってからoperations回実行することをrepeats回繰り返し、最速の1回あたり時間（秒）を返す"""
+    best = None
+    for _ in range(repeats):
+        run_once = setup()
+        start = time.perf_counter()
+        for i in range(operations):
+            await run_once(i)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / operations
+
+def operations_for(cost_hint):
+    """重い条件ほど実行回数を減らす（cost_hintはおおよその処理量）"""
+    return max(5, min(2000, 2_000_000 // max(1, cost_hint)))
+
+async def bench_banwords(results, quick, repeats):
+    counts = BANWORD_COUNTS[:3] if quick else BANWORD_COUNTS
+    lengths = MESSAGE_LENGTHS[:3] if quick else MESSAGE_LENGTHS
+    for word_count in counts:
+        for length in lengths:
+            name = f"contains_banned_word/{word_count}words/{length}chars"
+            rng = random.Random(name)
+            words = {random_word(rng, rng.randint(5, 10)) for _ in range(word_count)}
+            texts = [random_text(rng, length) for _ in range(20)]
+            
+            def setup():
+                reset_state()
+                guild = FakeGuild()
+                channel = guild.add_channel()
+                author = guild.add_member()
+                settings = command.banword_data[guild.id]
+                settings['enabled'] = True
+                settings['words'] = set(words)
+                messages = [FakeMessage(author, channel, text) for text in texts]
+                
+                async def run_once(i):
+                    command.contains_banned_word(messages[i % len(messages)])
+                return run_once
+            
+            operations = operations_for(word_count * length // 10)
+            per_op = await measure(setup, operations, repeats)
+            results[name] = {'per_op_us': per_op * 1e6, 'operations': operations}
+
+async def bench_whitelist(results, quick, repeats):
+    for role_count in WHITELIST_ROLE_COUNTS:
+        def setup():
+            reset_state()
+            guild = FakeGuild()
+            roles = [guild.add_role(f"role{i}", position=i + 1) for i in range(role_count)]
+            member = guild.add_member(roles=roles)
+            whitelist = command.whitelist_data[guild.id]
+            whitelist['enabled'] = True
+            whitelist['roles'] = {guild.add_role(f"trusted{i}").id for i in range(20)}  # 一致しない（最悪ケース）
+            
+            async def run_once(i):
+                command.is_whitelisted(member)
+            return run_once
+        
+        operations = 20000
+        per_op = await measure(setup, operations, repeats)
+        results[f"is_whitelisted/{role_count}roles"] = {'per_op_us': per_op * 1e6, 'operations': operations}
+
+def build_traffic(rng, guild, channel, count):
+    """ACTIVE_USERS人がランダムな内容を投稿するメッセージ列"""
+    authors = [guild.add_member() for _ in range(ACTIVE_USERS)]
+    return [FakeMessage(rng.choice(authors), channel, random_text(rng, 100)) for _ in range(count)]
+
+async def bench_rates(results, quick, repeats, clock):
+    rates = MESSAGE_RATES[:2] if quick else MESSAGE_RATES
+    for stage in ('is_spam', 'on_message'):
+        for rate in rates:
+            name = f"{stage}/{rate}msgs_per_sec"
+            api_calls = {}
+            
+            def setup():
+                reset_state()
+                rng = random.Random(name)
+                guild = FakeGuild()
+                channel = guild.add_channel()
+                messages = build_traffic(rng, guild, channel, 2000)
+                api_calls['counts'] = guild.api.counts
+                
+                if stage == 'on_message':
+                    # 一般的な設定（禁止ワード1000件、ホワイトリスト有効）
+                    settings = command.banword_data[guild.id]
+                    settings['enabled'] = True
+                    settings['words'] = {random_word(rng, rng.randint(5, 10)) for _ in range(1000)}
+                    command.whitelist_data[guild.id]['enabled'] = True
+                    command.refresh_guild_features(guild.id)
+                
+                async def run_once(i):
+                    clock.advance(1 / rate)
+                    if stage == 'is_spam':
+                        await command.is_spam(messages[i])
+                    else:
+                        await command.on_message(messages[i])
+                return run_once
+            
+            operations = 2000
+            per_op = await measure(setup, operations, repeats)
+            results[name] = {
+                'per_op_us': per_op * 1e6,
+                'operations': operations,
+                'api_calls': dict(api_calls['counts'])
+            }
+
+async def bench_idle_guild(results, repeats):
+    """有効な機能がないサーバー（スパム対策も無効）での on_message。サーバー別の状態が確保されないことも確認する"""
+    world = {}
+    
+    def setup():
+        reset_state()
+        rng = random.Random('idle_guild')
+        guild = FakeGuild()
+        channel = guild.add_channel()
+        messages = build_traffic(rng, guild, channel, 2000)
+        world['guild_id'] = guild.id
+        
+        async def run_once(i):
+            await command.on_message(messages[i])
+        return run_once
+    
+    operations = 2000
+    with mock.patch.dict(command.SPAM_SETTINGS, enabled=False):
+        per_op = await measure(setup, operations, repeats)
+    results['on_message/idle_guild'] = {
+        'per_op_us': per_op * 1e6,
+        'operations': operations,
+        'allocated': [name for name in command.GUILD_STATE_STRUCTURES if world['guild_id'] in getattr(command, name)]
+    }
+
+async def bench_overload(results, repeats, clock):
+    """過負荷レベルごとの on_message（1000件/秒、禁止ワード1000件）。縮退でどれだけ軽くなるかを確認する"""
+    for level in range(1, len(command.OVERLOAD_LEVELS)):
+        name = f"on_message/overload_level{level}"
+        
+        def setup():
+            reset_state()
+            rng = random.Random(name)
+            guild = FakeGuild()
+            channel = guild.add_channel()
+            messages = build_traffic(rng, guild, channel, 2000)
+            settings = command.banword_data[guild.id]
+            settings['enabled'] = True
+            settings['words'] = {random_word(rng, rng.randint(5, 10)) for _ in range(1000)}
+            command.refresh_guild_features(guild.id)
+            
+            async def run_once(i):
+                clock.advance(1 / 1000)
+                await command.on_message(messages[i])
+            return run_once
+        
+        operations = 2000
+        with mock.patch.dict(command.overload_state, level=level):
+            per_op = await measure(setup, operations, repeats)
+        results[name] = {'per_op_us': per_op * 1e6, 'operations': operations}
+
+async def run_suite(quick, repeats):
+    clock = FakeClock()
+    results = {}
+    install_bot_user(command.bot)
+    with mock.patch('time.time', clock):
+        await bench_banwords(results, quick, repeats)
+        await bench_whitelist(results, quick, repeats)
+        await bench_rates(results, quick, repeats, clock)
+        await bench_idle_guild(results, repeats)
+        await bench_overload(results, repeats, clock)
+    
+    # ミュート解除などのバックグラウンドタスクを破棄
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    reset_state()
+    return results
+
+def compare(results, baseline, tolerance):
+    """ベースラインと比較し、悪化したベンチマーク名の一覧を返す"""
+    regressions = []
+    print(f"{'ベンチマーク':<55} {'ベースライン':>12} {'今回':>12} {'比率':>7}")
+    for name, result in results.items():
+        current = result['per_op_us']
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            print(f"{name:<55} {'-':>12} {current:>10.2f}µs {'new':>7}")
+            continue
+        ratio = current / base['per_op_us'] if base['per_op_us'] else 1.0
+        mark = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            mark = ' ❌'
+        print(f"{name:<55} {base['per_op_us']:>10.2f}µs {current:>10.2f}µs {ratio:>6.2f}x{mark}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="モデレーションのホットパスのベンチマーク")
+    parser.add_argument('--quick', action='store_true', help="小さい条件のみ計測")
+    parser.add_argument('--repeats', type=int, default=3, help="各条件の繰り返し回数（最速の結果を採用）")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="悪化とみなす比率（0.25 = 25%%増）")
+    parser.add_argument('--output', default=RESULT_PATH, help="結果JSONの出力先")
+    parser.add_argument('--update-baseline', action='store_true', help="結果をベースラインとして保存")
+    args = parser.parse_args()
+    
+    results = asyncio.run(run_suite(args.quick, args.repeats))
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'quick': args.quick,
+        'results': results
+    }
+    
+    output = BASELINE_PATH if args.update_baseline else args.output
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+    print(f"結果を保存しました: {output}")
+    
+    if args.update_baseline or not os.path.exists(BASELINE_PATH):
+        return 0
+    
+    with open(BASELINE_PATH, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"❌ {len(regressions)}件のベンチマークがベースラインより{int(args.tolerance * 100)}%以上遅くなっています")
+        return 1
+    print("✅ ベースラインからの悪化はありません")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+"""
+参加レイド検出のベンチマーク
+1,000参加/秒のフラッドを再現し、1参加あたりの処理時間と検出までの参加数を計測します。
+使用例: python benchmarks/bench_join_detector.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import command
+
+JOINS_PER_SECOND = 1000
+DURATION_SECONDS = 60
+GUILD_COUNT = 10
+
+def run_benchmark():
+    trackers = [command.create_join_tracker() for _ in range(GUILD_COUNT)]
+    random.seed(0)
+    
+    # (時刻, サーバー番号, アカウント年齢) の参加イベントを事前に生成
+    total_joins = JOINS_PER_SECOND * DURATION_SECONDS
+    base_time = 1_700_000_000.0
+    events = [
+        (base_time + i / JOINS_PER_SECOND, random.randrange(GUILD_COUNT), random.choice((600, 7200, 86400 * 3, 86400 * 90)))
+        for i in range(total_joins)
+    ]
+    
+    first_detection = None
+    detections = 0
+    start = time.perf_counter()
+    for i, (now, guild_index, account_age) in enumerate(events):
+        if command.record_member_join(trackers[guild_index], account_age, now):
+            detections += 1
+            if first_detection is None:
+                first_detection = i + 1
+    elapsed = time.perf_counter() - start
+    
+    print(f"参加イベント数: {total_joins:,} ({JOINS_PER_SECOND:,}参加/秒 × {DURATION_SECONDS}秒, {GUILD_COUNT}サーバー)")
+    print(f"合計処理時間: {elapsed * 1000:.1f}ms")
+    print(f"1参加あたり: {elapsed / total_joins * 1e9:.0f}ns")
+    print(f"実時間に対する負荷: {elapsed / DURATION_SECONDS * 100:.3f}%")
+    print(f"最初の検出: {first_detection}参加目 / フラッド判定: {detections:,}回")
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,173 @@
+"""
+サーバー別状態のメモリ使用量ベンチマーク
+user_message_history / user_last_messages / user_warnings / spam_stats / whitelist_data / banword_data を
+多数のサーバー・アクティブユーザー分だけ埋め、tracemallocで構造体ごとの確保量を計測します。
+サーバーごとの状態は互いに独立しているため、既定では --sample-guilds 分だけ実際に埋めて --guilds 分に換算します。
+
+使用例:
+python -m benchmarks.bench_memory                        # 1,000サーバー × 1万ユーザーに換算して表示
+python -m benchmarks.bench_memory --sample-guilds 1000   # 全サーバー分を実際に埋める（数十GB必要）
+python -m benchmarks.bench_memory --update-baseline      # ベースラインを更新
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import string
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import command
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baselines', 'memory.json')
+RESULT_PATH = os.path.join(BENCHMARK_DIR, 'results', 'memory.json')
+
+STRUCTURES = ('user_message_history', 'user_last_messages', 'user_warnings',
+              'spam_stats', 'whitelist_data', 'banword_data')
+
+def random_text(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase + ' ') for _ in range(length)).strip()
+
+def fill_structure(name, guild_ids, args, rng):
+    """is_spam や各コマンドが書き込むのと同じ形で、指定した構造体を埋める"""
+    users = range(10**17, 10**17 + args.users)
+    for guild_id in guild_ids:
+        if name == 'user_message_history':
+            history = command.user_message_history[guild_id]
+            now = 1_700_000_000.0
+            for user_id in users:
+                timestamps = history[user_id]
+                for index in range(args.messages_per_user):
+                    timestamps.append(now + index * 0.5 + rng.random())
+        elif name == 'user_last_messages':
+            last_messages = command.user_last_messages[guild_id]
+            for user_id in users:
+                contents = last_messages[user_id]
+                for _ in range(min(args.messages_per_user, contents.maxlen)):
+                    contents.append(random_text(rng, rng.randint(5, args.message_length)))
+        elif name == 'user_warnings':
+            warnings = command.user_warnings[guild_id]
+            for user_id in rng.sample(users, int(args.users * args.warned_ratio)):
+                warnings[user_id] += rng.randint(1, 3)
+        elif name == 'spam_stats':
+            stats = command.spam_stats[guild_id]
+            stats['messages_deleted'] += rng.randint(0, 10**6)
+            stats['warnings_given'] += rng.randint(0, 10**6)
+            stats['mutes_applied'] += rng.randint(0, 10**5)
+            stats['notices_suppressed'] += rng.randint(0, 10**5)
+        elif name == 'whitelist_data':
+            whitelist = command.whitelist_data[guild_id]
+            whitelist['enabled'] = True
+            whitelist['users'].update(rng.sample(users, args.whitelist_users))
+            whitelist['roles'].update(rng.randrange(10**17, 10**18) for _ in range(args.whitelist_roles))
+        elif name == 'banword_data':
+            banwords = command.banword_data[guild_id]
+            banwords['words'].update(random_text(rng, rng.randint(3, 12)) for _ in range(args.banwords))
+
+def measure(args):
+    """構造体ごとに、埋める前後の tracemalloc の確保量の差と sys.getsizeof の合計を計測"""
+    rng = random.Random(args.seed)
+    guild_ids = [10**18 + index for index in range(args.sample_guilds)]
+    scale = args.guilds / args.sample_guilds
+    
+    tracemalloc.start()
+    results = {}
+    for name in STRUCTURES:
+        getattr(command, name).clear()
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        fill_structure(name, guild_ids, args, rng)
+        gc.collect()
+        traced = tracemalloc.get_traced_memory()[0] - before
+        estimated = asyncio.run(command.measure_state_memory((name,)))[name]
+        results[name] = {
+            'traced_bytes': int(traced * scale),
+            'getsizeof_bytes': int(estimated * scale),
+            'bytes_per_guild': traced / args.sample_guilds,
+            'bytes_per_user': traced / (args.sample_guilds * args.users)
+        }
+    tracemalloc.stop()
+    
+    for name in STRUCTURES:
+        getattr(command, name).clear()
+    return results
+
+def print_report(results, args):
+    print(f"{args.guilds}サーバー × {args.users}アクティブユーザー（{args.sample_guilds}サーバー分を計測して換算）")
+    print()
+    print(f"{'構造体':<24}{'tracemalloc':>14}{'getsizeof':>14}{'1サーバー':>14}{'1ユーザー':>12}")
+    for name, row in sorted(results.items(), key=lambda item: item[1]['traced_bytes'], reverse=True):
+        print(f"{name:<24}{command.format_bytes(row['traced_bytes']):>14}{command.format_bytes(row['getsizeof_bytes']):>14}"
+              f"{command.format_bytes(row['bytes_per_guild']):>14}{row['bytes_per_user']:>11.1f}B")
+    total = sum(row['traced_bytes'] for row in results.values())
+    print(f"{'合計':<24}{command.format_bytes(total):>14}")
+
+def compare(results, baseline, tolerance):
+    """1サーバーあたりの確保量がベースラインより tolerance 以上増えた構造体を返す"""
+    regressions = []
+    print()
+    print(f"{'構造体':<24}{'ベースライン':>14}{'今回':>14}{'比率':>8}")
+    for name, row in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if not base or not base['bytes_per_guild']:
+            continue
+        ratio = row['bytes_per_guild'] / base['bytes_per_guild']
+        mark = '❌' if ratio > 1 + tolerance else '✅'
+        print(f"{name:<24}{command.format_bytes(base['bytes_per_guild']):>14}{command.format_bytes(row['bytes_per_guild']):>14}{ratio:>7.2f}x {mark}")
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="サーバー別状態のメモリ使用量ベンチマーク")
+    parser.add_argument('--guilds', type=int, default=1000, help="換算するサーバー数")
+    parser.add_argument('--users', type=int, default=10000, help="1サーバーあたりのアクティブユーザー数")
+    parser.add_argument('--sample-guilds', type=int, default=5, help="実際に埋めるサーバー数")
+    parser.add_argument('--messages-per-user', type=int, default=20, help="1ユーザーあたりの履歴件数（上限は各dequeのmaxlen）")
+    parser.add_argument('--message-length', type=int, default=80, help="記録するメッセージ内容の最大長")
+    parser.add_argument('--warned-ratio', type=float, default=0.05, help="警告を受けたユーザーの割合")
+    parser.add_argument('--whitelist-users', type=int, default=50)
+    parser.add_argument('--whitelist-roles', type=int, default=20)
+    parser.add_argument('--banwords', type=int, default=100, help="1サーバーあたりの禁止ワード数")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tolerance', type=float, default=0.10, help="悪化とみなす増加率")
+    parser.add_argument('--output', default=RESULT_PATH, help="結果を保存するJSONファイル")
+    parser.add_argument('--update-baseline', action='store_true', help="結果をベースラインとして保存")
+    args = parser.parse_args()
+    args.sample_guilds = max(1, min(args.sample_guilds, args.guilds))
+    
+    results = measure(args)
+    print_report(results, args)
+    
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'update_baseline', 'tolerance')},
+        'results': results
+    }
+    output = BASELINE_PATH if args.update_baseline else args.output
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+    print(f"\n結果を保存しました: {output}")
+    
+    if args.update_baseline or not os.path.exists(BASELINE_PATH):
+        return 0
+    
+    with open(BASELINE_PATH, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"❌ {len(regressions)}件の構造体がベースラインより{int(args.tolerance * 100)}%以上増えています")
+        return 1
+    print("✅ ベースラインからの悪化はありません")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+"""
+メトリクス計測のオーバーヘッドのベンチマーク
+on_messageの1段階あたりに追加される処理（perf_counter 2回 + record_stage_latency によるヒストグラムと n!perf のスケッチへの記録）の時間を計測します。
+目標: 1段階あたり1マイクロ秒未満
+使用例: python benchmarks/bench_metrics_overhead.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import command
+
+ITERATIONS = 1_000_000
+
+def run_benchmark():
+    record_stage_latency = command.record_stage_latency
+    perf_counter = time.perf_counter
+    
+    # 計測なしのループ
+    start = perf_counter()
+    for _ in range(ITERATIONS):
+        pass
+    baseline = perf_counter() - start
+    
+    # 計測ありのループ（on_messageと同じ形）
+    start = perf_counter()
+    for _ in range(ITERATIONS):
+        started_at = perf_counter()
+        record_stage_latency('benchmark', perf_counter() - started_at)
+    instrumented = perf_counter() - start
+    
+    per_stage_ns = (instrumented - baseline) / ITERATIONS * 1e9
+    print(f"計測回数: {ITERATIONS:,}")
+    print(f"1段階あたりのオーバーヘッド: {per_stage_ns:.0f}ns")
+    print("✅ 目標（1µs未満）を満たしています" if per_stage_ns < 1000 else "❌ 目標（1µs未満）を超えています")
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,98 @@
+"""
+禁止ワード照合のプロセスプールへの委譲のベンチマーク
+大量の禁止ワードと長いメッセージで、イベントループ上の照合とワーカープロセスへの委譲を比べます。
+処理時間に加えて、照合中のイベントループ遅延（ハートビートが遅れる原因）を計測し、両者の判定結果が一致することを確認します。
+
+使用例:
+python -m benchmarks.bench_offload
+python -m benchmarks.bench_offload --workers 4 --words 50000 --length 4000 --messages 400
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import command
+from benchmarks.bench_hot_path import random_text, random_word
+from benchmarks.fakes import FakeGuild, FakeMessage
+
+async def probe_loop_lag(samples, interval=0.005):
+    """一定間隔でスリープし、予定より遅れた時間を記録"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - start - interval))
+
+async def run_mode(name, args, words, texts):
+    command.banword_matchers.clear()
+    guild = FakeGuild()
+    channel = guild.add_channel()
+    author = guild.add_member()
+    settings = command.banword_data[guild.id]
+    settings['enabled'] = True
+    settings['words'] = set(words)
+    messages = [FakeMessage(author, channel, text) for text in texts]
+
+    # 照合器の作成とワーカーの起動は計測に含めない
+    command.get_banword_matcher(guild.id, settings)
+    if command.offload_state['executor'] is not None:
+        await command.scan_banned_word(messages[0], command.MessageFeatures(messages[0].content))
+
+    lag_samples = []
+    probe = asyncio.create_task(probe_loop_lag(lag_samples))
+    await asyncio.sleep(0.02)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(command.scan_banned_word(message, command.MessageFeatures(message.content))
+                                     for message in messages))
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0.02)  # 照合中に止まっていた分の遅延を記録させる
+    probe.cancel()
+
+    lag_samples.sort()
+    p99 = lag_samples[int(len(lag_samples) * 0.99)] if lag_samples else 0.0
+    worst = lag_samples[-1] if lag_samples else 0.0
+    print(f"{name:<10} {elapsed * 1000:>10.1f} {len(messages) / elapsed:>12.1f} {p99 * 1000:>14.1f} {worst * 1000:>14.1f}")
+    return results
+
+async def main():
+    parser = argparse.ArgumentParser(description="禁止ワード照合のプロセスプールへの委譲のベンチマーク")
+    parser.add_argument('--workers', type=int, default=2, help="ワーカープロセス数")
+    parser.add_argument('--words', type=int, default=50000, help="禁止ワード数")
+    parser.add_argument('--length', type=int, default=4000, help="メッセージの文字数")
+    parser.add_argument('--messages', type=int, default=200, help="照合するメッセージ数")
+    parser.add_argument('--hit-ratio', type=float, default=0.1, help="禁止ワードを含むメッセージの割合")
+    args = parser.parse_args()
+
+    rng = random.Random('offload')
+    words = sorted({random_word(rng, rng.randint(5, 10)) for _ in range(args.words)})
+    texts = []
+    for _ in range(args.messages):
+        text = random_text(rng, args.length)
+        if rng.random() < args.hit_ratio:
+            text = text[:args.length // 2] + f" {rng.choice(words)} " + text[args.length // 2:]
+        texts.append(text)
+
+    print(f"禁止ワード {len(words)}件 / {args.length}文字 × {args.messages}件 / ワーカー {args.workers}プロセス")
+    print(f"{'モード':<10} {'合計(ms)':>10} {'件/秒':>12} {'ループ遅延p99(ms)':>14} {'最大(ms)':>14}")
+
+    inline = await run_mode('inline', args, words, texts)
+
+    command.OFFLOAD_SETTINGS['workers'] = args.workers
+    command.start_detector_pool()
+    try:
+        offloaded = await run_mode('offload', args, words, texts)
+    finally:
+        command.offload_state['executor'].shutdown(wait=True)
+        command.offload_state['executor'] = None
+
+    print()
+    print(f"一致したメッセージ: {sum(result is not None for result in inline)}件")
+    print("✅ 判定結果が一致しました" if inline == offloaded else "❌ 判定結果が一致しません")
+    print(f"バッチ: {command.offload_stats['batches']}回 / 照合器を添えた再送: {command.offload_stats['resent']}件")
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+"""
+ローカルで動くDiscord REST APIの擬似サーバー
+モデレーションで使うルート（メッセージ削除・一括削除・送信、ロール作成・付与、チャンネル権限、バン）を提供し、
+X-RateLimit-* ヘッダーと429応答を本物に近い形で再現します。受信したリクエストはすべて記録されます。
+"""
+import asyncio
+import itertools
+import random
+import time
+from dataclasses import dataclass
+
+from aiohttp import web
+
+@dataclass
+class RecordedRequest:
+    kind: str            # ルートの種類（delete, add_roles など）
+    params: dict         # URL中のID
+    arrived_at: float    # 受信時刻（time.perf_counter）
+    status: int          # 応答ステータス
+
+# (メソッド, パス, 種類, レート制限バケットの主パラメータ)
+ROUTES = (
+    ('GET', '/api/v10/users/@me', 'login', None),
+    ('DELETE', '/api/v10/channels/{channel_id}/messages/{message_id}', 'delete', 'channel_id'),
+    ('POST', '/api/v10/channels/{channel_id}/messages/bulk-delete', 'bulk_delete', 'channel_id'),
+    ('POST', '/api/v10/channels/{channel_id}/messages', 'send', 'channel_id'),
+    ('PUT', '/api/v10/channels/{channel_id}/permissions/{target_id}', 'set_permissions', 'channel_id'),
+    ('POST', '/api/v10/guilds/{guild_id}/roles', 'create_role', 'guild_id'),
+    ('PATCH', '/api/v10/guilds/{guild_id}/members/{user_id}', 'timeout', 'guild_id'),
+    ('PUT', '/api/v10/guilds/{guild_id}/members/{user_id}/roles/{role_id}', 'add_roles', 'guild_id'),
+    ('DELETE', '/api/v10/guilds/{guild_id}/members/{user_id}/roles/{role_id}', 'remove_roles', 'guild_id'),
+    ('GET', '/api/v10/guilds/{guild_id}/bans/{user_id}', 'fetch_ban', 'guild_id'),
+    ('PUT', '/api/v10/guilds/{guild_id}/bans/{user_id}', 'ban', 'guild_id'),
+    ('DELETE', '/api/v10/guilds/{guild_id}/bans/{user_id}', 'unban', 'guild_id'),
+)
+
+class FakeDiscordRest:
+    """
+    bucket_limit件 / bucket_window秒 をルートの種類と主パラメータごとのバケットで制限し、
+    全体では global_limit件/秒 に制限します。inject_429 の確率で制限とは無関係な429も返します。
+    """
+    def __init__(self, bucket_limit=5, bucket_window=1.0, global_limit=50, inject_429=0.0, latency=0.0, seed=0):
+        self.bucket_limit = bucket_limit
+        self.bucket_window = bucket_window
+        self.global_limit = global_limit
+        self.inject_429 = inject_429
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.requests = []
+        self.buckets = {}        # (種類, 主パラメータ) -> [残り回数, リセット時刻]
+        self.global_window = [0, 0.0]  # [件数, 窓の開始時刻]
+        self.ids = itertools.count(900000000000000000)
+        self.runner = None
+        self.port = None
+    
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/api/v10"
+    
+    async def start(self):
+        app = web.Application()
+        for method, path, kind, major in ROUTES:
+            app.router.add_route(method, path, self.make_handler(kind, major))
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+    
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+    
+    def make_handler(self, kind, major):
+        async def handler(request):
+            arrived_at = time.perf_counter()
+            params = dict(request.match_info)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            response = self.respond(kind, major, params)
+            self.requests.append(RecordedRequest(kind, params, arrived_at, response.status))
+            return response
+        return handler
+    
+    def rate_limited(self, retry_after, is_global, bucket):
+        # Via が無い429は discord.py が Cloudflare による遮断とみなすため、本物と同様に付ける
+        headers = {'Retry-After': f"{retry_after:.3f}", 'X-RateLimit-Scope': 'global' if is_global else 'user', 'Via': '1.1 google'}
+        if is_global:
+            headers['X-RateLimit-Global'] = 'true'
+        if not is_global:
+            headers.update({'X-RateLimit-Limit': str(self.bucket_limit), 'X-RateLimit-Remaining': '0',
+                            'X-RateLimit-Reset-After': f"{retry_after:.3f}", 'X-RateLimit-Bucket': bucket})
+        body = {'message': 'You are being rate limited.', 'retry_after': retry_after, 'global': is_global}
+        return web.json_response(body, status=429, headers=headers)
+    
+    def respond(self, kind, major, params):
+        now = time.time()
+        bucket = kind  # 本物と同じく、バケットのハッシュは主パラメータを含まない
+        key = (kind, params.get(major))
+        
+        # 全体のレート制限（拒否したリクエストは数えない）
+        if now - self.global_window[1] >= 1.0:
+            self.global_window = [0, now]
+        if self.global_window[0] >= self.global_limit:
+            return self.rate_limited(1.0 - (now - self.global_window[1]), True, bucket)
+        
+        # バケットごとのレート制限
+        state = self.buckets.get(key)
+        if state is None or now >= state[1]:
+            state = self.buckets[key] = [self.bucket_limit, now + self.bucket_window]
+        reset_after = state[1] - now
+        if state[0] <= 0 or (self.inject_429 and self.rng.random() < self.inject_429):
+            return self.rate_limited(reset_after, False, bucket)
+        state[0] -= 1
+        self.global_window[0] += 1
+        
+        headers = {
+            'X-RateLimit-Limit': str(self.bucket_limit),
+            'X-RateLimit-Remaining': str(state[0]),
+            'X-RateLimit-Reset': f"{state[1]:.3f}",
+            'X-RateLimit-Reset-After': f"{reset_after:.3f}",
+            'X-RateLimit-Bucket': bucket
+        }
+        
+        if kind == 'login':
+            return web.json_response({'id': '1', 'username': 'benchmark', 'discriminator': '0', 'avatar': None, 'global_name': None}, headers=headers)
+        if kind == 'create_role':
+            role = {'id': str(next(self.ids)), 'name': 'Muted', 'color': 0, 'hoist': False, 'position': 1,
+                    'permissions': '0', 'managed': False, 'mentionable': False}
+            return web.json_response(role, headers=headers)
+        if kind == 'send':
+            return web.json_response({'id': str(next(self.ids)), 'channel_id': params['channel_id']}, headers=headers)
+        if kind == 'fetch_ban':
+            return web.json_response({'message': 'Unknown Ban', 'code': 10026}, status=404, headers=headers)
+        return web.Response(status=204, headers=headers)
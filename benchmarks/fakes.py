@@ -0,0 +1,218 @@
+"""
+ベンチマーク用の軽量なDiscordオブジェクトの代替
+discord.Message / Member / Guild などのうち、モデレーション処理が参照する属性だけを持ちます。
+API呼び出し（削除・送信・ロール付与など）はすべて guild.api.call() を通り、
+既定の FakeApiCalls は呼び出し回数だけを記録します（実際のHTTPに差し替えることもできます）。
+"""
+import asyncio
+import heapq
+import itertools
+from types import SimpleNamespace
+
+import discord
+
+_ids = itertools.count(100000000000000000)
+
+def next_id():
+    return next(_ids)
+
+class FakeClock:
+    """
+    time.time() の代わりに使う、手動で進める時計
+    sleep() はこの時計が指定秒数進むまで待つため、ミュート解除などの待機もこの時計の時刻で進みます（advance_to で起こす）。
+    """
+    def __init__(self, start=1_700_000_000.0):
+        self.now = start
+        self.sleepers = []  # (起こす時刻, 登録順, future) のヒープ
+        self.order = itertools.count()
+    
+    def __call__(self):
+        return self.now
+    
+    def advance(self, seconds):
+        self.now += seconds
+    
+    async def sleep(self, delay, result=None):
+        """asyncio.sleep() の代わりに、この時計が delay 秒進むまで待つ"""
+        if delay <= 0:
+            return await asyncio.sleep(0, result)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.sleepers, (self.now + delay, next(self.order), future))
+        await future
+        return result
+    
+    async def advance_to(self, now):
+        """時計を now まで進め、途中で期限が来た sleep() を時刻順に起こして実行させる"""
+        # 直前に作られたタスクが現在の時刻で sleep() を登録するまで進める
+        await asyncio.sleep(0)
+        while self.sleepers and self.sleepers[0][0] <= now:
+            deadline, _, future = heapq.heappop(self.sleepers)
+            self.now = max(self.now, deadline)
+            if not future.done():
+                future.set_result(None)
+                # 起こしたタスクを次の待機まで進める（擬似APIは待機しないため、ここで処理が終わる）
+                await asyncio.sleep(0)
+                await asyncio.sleep(0)
+        self.now = max(self.now, now)
+
+class FakeApiCalls:
+    """擬似API呼び出しの回数を記録（Discord APIの代わり）"""
+    def __init__(self):
+        self.counts = {}
+    
+    async def call(self, name, **params):
+        self.counts[name] = self.counts.get(name, 0) + 1
+        return None
+
+class FakePermissions:
+    def __init__(self, administrator=False, manage_messages=False, manage_guild=False, ban_members=False, moderate_members=False):
+        self.administrator = administrator
+        self.manage_messages = manage_messages
+        self.manage_guild = manage_guild
+        self.ban_members = ban_members
+        self.moderate_members = moderate_members
+
+class FakeRole:
+    def __init__(self, guild, name, position=1):
+        self.guild = guild
+        self.id = next_id()
+        self.name = name
+        self.position = position
+        self.members = []
+        self.managed = False
+    
+    @property
+    def mention(self):
+        return f"<@&{self.id}>"
+    
+    def __lt__(self, other):
+        return self.position < other.position
+    
+    def __ge__(self, other):
+        return self.position >= other.position
+
+class FakeMember:
+    def __init__(self, guild, name=None, roles=(), administrator=False, bot=False, created_at=None):
+        self.guild = guild
+        self.id = next_id()
+        self.name = name or f"user{self.id % 100000}"
+        self.display_name = self.name
+        self.discriminator = "0"
+        self.bot = bot
+        self.roles = [guild.default_role, *roles]
+        self.guild_permissions = FakePermissions(administrator=administrator)
+        self.created_at = created_at
+        self.joined_at = None
+    
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+    
+    @property
+    def top_role(self):
+        return max(self.roles, key=lambda role: role.position)
+    
+    def __str__(self):
+        return self.name
+    
+    async def add_roles(self, *roles, reason=None):
+        for role in roles:
+            await self.guild.api.call('add_roles', guild_id=self.guild.id, user_id=self.id, role_id=role.id)
+        self.roles.extend(roles)
+    
+    async def remove_roles(self, *roles, reason=None):
+        for role in roles:
+            await self.guild.api.call('remove_roles', guild_id=self.guild.id, user_id=self.id, role_id=role.id)
+        self.roles = [role for role in self.roles if role not in roles]
+    
+    async def timeout(self, until, reason=None):
+        await self.guild.api.call('timeout', guild_id=self.guild.id, user_id=self.id)
+
+class FakeChannel:
+    def __init__(self, guild, name="general"):
+        self.guild = guild
+        self.id = next_id()
+        self.name = name
+    
+    async def send(self, content=None, *, embed=None, file=None, delete_after=None):
+        await self.guild.api.call('send', channel_id=self.id, content=content, embed=embed)
+        return FakeMessage(self.guild.me, self, content or "")
+    
+    async def set_permissions(self, target, **permissions):
+        await self.guild.api.call('set_permissions', channel_id=self.id, target_id=target.id)
+
+class FakeGuild:
+    def __init__(self, name="guild", api=None):
+        self.id = next_id()
+        self.name = name
+        self.api = api or FakeApiCalls()
+        self.default_role = FakeRole(self, "@everyone", position=0)
+        self.roles = [self.default_role]
+        self.channels = []
+        self.members = []
+        self.owner_id = 0
+        self.me = None
+        self.me = self.add_member(name="bot", bot=True, roles=[self.add_role("bot", position=100)])
+    
+    def add_role(self, name, position=1):
+        role = FakeRole(self, name, position)
+        self.roles.append(role)
+        return role
+    
+    def add_member(self, **kwargs):
+        member = FakeMember(self, **kwargs)
+        self.members.append(member)
+        return member
+    
+    def add_channel(self, name="general"):
+        channel = FakeChannel(self, name)
+        self.channels.append(channel)
+        return channel
+    
+    def get_member(self, user_id):
+        for member in self.members:
+            if member.id == user_id:
+                return member
+        return None
+    
+    async def create_role(self, name=None, reason=None, **kwargs):
+        await self.api.call('create_role', guild_id=self.id, role_name=name)
+        return self.add_role(name)
+    
+    async def ban(self, user, reason=None, delete_message_seconds=0):
+        await self.api.call('ban', guild_id=self.id, user_id=user.id, reason=reason)
+    
+    async def unban(self, user, reason=None):
+        await self.api.call('unban', guild_id=self.id, user_id=user.id, reason=reason)
+    
+    async def fetch_ban(self, user):
+        if not await self.api.call('fetch_ban', guild_id=self.id, user_id=user.id):
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Ban')
+
+class FakeMessage:
+    def __init__(self, author, channel, content):
+        self.id = next_id()
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.attachments = []
+        self.mentions = []
+        self.role_mentions = []
+        self.mention_everyone = False
+        self.embeds = []
+        self.stickers = []
+        self.reference = None
+        self.type = None
+        self.flags = None
+        self.webhook_id = None
+        self.interaction_metadata = None
+        self._state = None  # commands.Context が参照する
+    
+    async def delete(self):
+        await self.guild.api.call('delete', channel_id=self.channel.id, message_id=self.id)
+
+def install_bot_user(bot):
+    """ログインせずに bot.process_commands を動かせるよう、擬似的なボットユーザーを設定"""
+    if bot.user is None:
+        bot._connection.user = FakeGuild(name="bot-home").me
@@ -0,0 +1,261 @@
+"""
+メッセージトレースのリプレイ
+n!trace で記録したJSONLトレースを擬似オブジェクト上のモデレーション処理に流し込み、
+処理能力・処理段階ごとのレイテンシ・実行されるはずだったモデレーション操作を報告します。
+スパム判定にもミュート解除などの待機にも記録時の時刻を使うため、再生速度を変えても判定結果は変わりません。
+コマンド（n!〜）は実行せず、件数のみを数えます。ミュート後のユーザーの投稿は実際には届かないため除外します。
+
+内容は単語（空白区切り）ごとに匿名化されているため、部分一致で照合する禁止ワード（空白のない日本語の文を含む）と、
+文字単位で比べる類似メッセージの判定はリプレイでは再現できません。トレースには記録時に対処した段階も残っているため、
+段階ごとに記録時とリプレイの判定の件数・一致した件数を表示します（判定の違いが再現性の限界によるものか確認できます）。
+
+使用例:
+python -m benchmarks.replay_trace traces/trace-20260101-000000.jsonl --speed max
+python -m benchmarks.replay_trace trace.jsonl --speed 10 --spam-settings '{"message_limit": 8}'
+python -m benchmarks.replay_trace trace.jsonl --banwords words.txt --salt 記録時のTRACE_SALT
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import command
+from benchmarks.fakes import FakeApiCalls, FakeClock, FakeGuild, FakeMessage, install_bot_user
+
+def load_trace(path):
+    header = {}
+    events = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get('type') == 'header':
+                header = record
+            elif record.get('type') == 'message':
+                events.append(record)
+    events.sort(key=lambda record: record['t'])
+    return header, events
+
+class TraceAsyncio:
+    """command モジュールから見た asyncio（sleep だけがトレースの時刻で進む）"""
+    def __init__(self, clock):
+        self.sleep = clock.sleep
+    
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+class ReplayFeatures(command.MessageFeatures):
+    """on_message が作った特徴量を覚えておき、リプレイで対処した段階を取り出せるようにする"""
+    latest = None
+    
+    def __init__(self, content):
+        super().__init__(content)
+        ReplayFeatures.latest = self
+
+def histogram_quantile(histogram, quantile):
+    """ヒストグラムから分位点（バケットの上限値）を求める"""
+    target = quantile * histogram['count']
+    cumulative = 0
+    for bound, count in zip(command.LATENCY_BUCKETS + (float('inf'),), histogram['buckets']):
+        cumulative += count
+        if count and cumulative >= target:
+            return bound
+    return 0.0
+
+class ReplayWorld:
+    """トレース中のID -> 擬似オブジェクトの対応を管理"""
+    def __init__(self, api):
+        self.api = api
+        self.guilds = {}
+        self.channels = {}
+        self.members = {}
+    
+    def guild(self, guild_id):
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            guild = self.guilds[guild_id] = FakeGuild(name=f"guild-{guild_id}", api=self.api)
+        return guild
+    
+    def channel(self, guild_id, channel_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = self.guild(guild_id).add_channel(f"channel-{channel_id}")
+        return channel
+    
+    def member(self, guild_id, author_id, bot, admin):
+        key = (guild_id, author_id)
+        member = self.members.get(key)
+        if member is None:
+            member = self.members[key] = self.guild(guild_id).add_member(bot=bot, administrator=admin)
+        return member
+
+def apply_settings(world, header, args):
+    """トレースのヘッダーとコマンドライン引数から設定を適用"""
+    command.SPAM_SETTINGS.update(header.get('spam_settings', {}))
+    if args.spam_settings:
+        command.SPAM_SETTINGS.update(json.loads(args.spam_settings))
+    
+    banwords = header.get('banwords', {})
+    if args.banwords:
+        # 平文の禁止ワードを記録時と同じ鍵で匿名化して全サーバーに適用
+        with open(args.banwords, 'r', encoding='utf-8') as f:
+            words = [line.strip().lower() for line in f if line.strip()]
+        salt = args.salt.encode() if args.salt else None
+        scrubbed = [command.scrub_text(word, salt, header.get('content_mode')) for word in words]
+        banwords = {guild_id: {'enabled': True, 'action': args.banword_action, 'words': scrubbed}
+                    for guild_id in {str(record_guild) for record_guild in world.trace_guilds}}
+    
+    for guild_id, settings in banwords.items():
+        guild_settings = command.banword_data[world.guild(int(guild_id)).id]
+        guild_settings['enabled'] = settings['enabled']
+        guild_settings['action'] = settings['action']
+        guild_settings['words'] = set(settings['words'])
+        command.refresh_guild_features(world.guild(int(guild_id)).id)
+
+async def replay(header, events, args):
+    api = FakeApiCalls()
+    world = ReplayWorld(api)
+    world.trace_guilds = {event['g'] for event in events if event['g'] is not None}
+    apply_settings(world, header, args)
+    install_bot_user(command.bot)
+    
+    for histogram in command.stage_latency.values():
+        histogram.update(command.create_histogram())
+    
+    commands_seen = defaultdict(int)
+    
+    async def count_command(message):
+        if message.content.startswith(command.bot.command_prefix):
+            commands_seen[message.content.split(' ', 1)[0]] += 1
+    
+    speed = None if args.speed == 'max' else float(args.speed)
+    clock = FakeClock(events[0]['t'] if events else 0.0)
+    busy = 0.0
+    muted_messages = 0
+    verdicts = defaultdict(lambda: {'live': 0, 'replay': 0, 'agree': 0})
+    wall_start = time.perf_counter()
+    
+    with mock.patch('time.time', clock), mock.patch.object(command, 'asyncio', TraceAsyncio(clock)), \
+            mock.patch.object(command, 'MessageFeatures', ReplayFeatures), \
+            mock.patch.object(command.bot, 'process_commands', count_command):
+        for event in events:
+            if event['g'] is None:
+                continue  # DMはモデレーション対象外
+            
+            # 指定速度に合わせて待機
+            if speed:
+                delay = (event['t'] - events[0]['t']) / speed - (time.perf_counter() - wall_start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            
+            await clock.advance_to(event['t'])
+            author = world.member(event['g'], event['a'], event['bot'], event['admin'])
+            if any(role.name == "Muted" for role in author.roles):
+                muted_messages += 1  # 実際にはミュート中は投稿できない
+                continue
+            message = FakeMessage(author, world.channel(event['g'], event['c']), event['text'])
+            
+            started_at = time.perf_counter()
+            await command.on_message(message)
+            busy += time.perf_counter() - started_at
+            
+            # 記録時に対処した段階と比べる（記録時の判定がない古いトレースは比べない）
+            if 'v' in event:
+                live, replayed = event['v'], ReplayFeatures.latest.acted_stage
+                if live:
+                    verdicts[live]['live'] += 1
+                if replayed:
+                    verdicts[replayed]['replay'] += 1
+                if live and live == replayed:
+                    verdicts[live]['agree'] += 1
+    
+    wall = time.perf_counter() - wall_start
+    
+    # ミュート解除などのバックグラウンドタスクを破棄
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    
+    totals = defaultdict(int)
+    for guild in world.guilds.values():
+        for key, count in command.spam_stats.get(guild.id, {}).items():
+            totals[key] += count
+    
+    stages = {}
+    for stage, histogram in command.stage_latency.items():
+        if histogram['count']:
+            stages[stage] = {
+                'count': histogram['count'],
+                'mean_us': histogram['sum'] / histogram['count'] * 1e6,
+                'p50_us': histogram_quantile(histogram, 0.5) * 1e6,
+                'p99_us': histogram_quantile(histogram, 0.99) * 1e6
+            }
+    
+    return {
+        'events': len(events),
+        'trace_seconds': events[-1]['t'] - events[0]['t'] if events else 0.0,
+        'wall_seconds': wall,
+        'busy_seconds': busy,
+        'throughput_per_sec': (len(events) - muted_messages) / busy if busy else 0.0,
+        'stages': stages,
+        'api_calls': dict(api.counts),
+        'spam_stats': dict(totals),
+        'commands': dict(commands_seen),
+        'muted_messages': muted_messages,
+        'verdicts': dict(verdicts)
+    }
+
+def print_report(report):
+    print(f"イベント数: {report['events']:,}（トレース時間 {report['trace_seconds']:.1f}秒 / 実行時間 {report['wall_seconds']:.2f}秒）")
+    print(f"処理能力: {report['throughput_per_sec']:,.0f}件/秒（処理時間の合計 {report['busy_seconds']:.3f}秒）")
+    print("処理段階ごとのレイテンシ:")
+    for stage, stats in report['stages'].items():
+        print(f"  {stage:<22} {stats['count']:>8,}件  平均 {stats['mean_us']:>9.1f}µs  p50 ≤{stats['p50_us']:>9.0f}µs  p99 ≤{stats['p99_us']:>9.0f}µs")
+    print("実行されるはずだったAPI操作:")
+    for name, count in sorted(report['api_calls'].items()):
+        print(f"  {name:<22} {count:>8,}")
+    print("スパム対策統計:")
+    for name, count in sorted(report['spam_stats'].items()):
+        print(f"  {name:<22} {count:>8,}")
+    print(f"ミュート中のため投稿されなかったはずのメッセージ: {report['muted_messages']:,}件")
+    if report['verdicts']:
+        print("対処した段階（記録時 / リプレイ / 一致）:")
+        for stage, counts in sorted(report['verdicts'].items()):
+            print(f"  {stage:<22} {counts['live']:>8,} {counts['replay']:>8,} {counts['agree']:>8,}")
+    if report['commands']:
+        print(f"コマンド（未実行）: {sum(report['commands'].values()):,}件")
+
+def main():
+    parser = argparse.ArgumentParser(description="メッセージトレースのリプレイ")
+    parser.add_argument('trace', help="n!trace で記録したJSONLファイル")
+    parser.add_argument('--speed', default='max', help="再生速度（1, 10 など。max で待機なし）")
+    parser.add_argument('--spam-settings', help="SPAM_SETTINGSの上書き（JSON）")
+    parser.add_argument('--banwords', help="平文の禁止ワード一覧（1行1語）。トレースに記録された設定の代わりに使用")
+    parser.add_argument('--banword-action', default='delete', choices=['delete', 'warn', 'mute'])
+    parser.add_argument('--salt', help="記録時のTRACE_SALT（--banwords使用時に必要）")
+    parser.add_argument('--output', help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+    
+    header, events = load_trace(args.trace)
+    if not events:
+        print("❌ トレースにメッセージイベントがありません")
+        return 1
+    
+    report = asyncio.run(replay(header, events, args))
+    print_report(report)
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果を保存しました: {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+複数プロセスでボットを動かすクラスタ起動スクリプト
+シャードをN個のワーカープロセスに連続した範囲で割り当て、各プロセスで command.py を起動します。
+サーバー設定（ホワイトリスト・禁止ワード・スパム対策設定）は共有ストア（SQLite WAL）で同期され、
+あるプロセスでの `n!banword add` などの変更は数十ミリ秒以内に他のプロセスにも反映されます。
+
+使用例:
+python cluster.py --workers 4 --shards auto
+python cluster.py --workers 2 --shards 8 --db shared_state.db
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'command.py')
+IDENTIFY_INTERVAL = 5.0  # Discordの IDENTIFY 制限（max_concurrency ごとに5秒に1回）
+
+def fetch_gateway_info(token):
+    """Discordが推奨するシャード数と IDENTIFY の同時実行数を取得"""
+    request = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f'Bot {token}', 'User-Agent': 'DiscordBot (cluster.py, 1.0)'}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        data = json.load(response)
+    return data['shards'], data.get('session_start_limit', {}).get('max_concurrency', 1)
+
+def split_shards(shard_count, workers):
+    """シャード番号を連続した範囲でワーカーに割り当てる"""
+    workers = max(1, min(workers, shard_count))
+    return [list(range(index * shard_count // workers, (index + 1) * shard_count // workers))
+            for index in range(workers)]
+
+def start_worker(cluster_id, shard_ids, shard_count, db_path):
+    env = dict(os.environ)
+    env.update({
+        'CLUSTER_ID': str(cluster_id),
+        'SHARD_COUNT': str(shard_count),
+        'SHARD_IDS': ','.join(map(str, shard_ids)),
+        'SHARED_STATE_DB': db_path
+    })
+    # メトリクスのポートが衝突しないよう、プロセスごとにずらす（0 の場合は無効のまま）
+    base_port = int(os.getenv('METRICS_PORT', '9108'))
+    env['METRICS_PORT'] = str(base_port + cluster_id) if base_port else '0'
+    print(f"▶️ プロセス {cluster_id} を起動: シャード {shard_ids[0]}-{shard_ids[-1]} / {shard_count}")
+    return subprocess.Popen([sys.executable, BOT_SCRIPT], env=env)
+
+def main():
+    parser = argparse.ArgumentParser(description="ボットを複数プロセスのクラスタとして起動")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="ワーカープロセス数")
+    parser.add_argument('--shards', default='auto', help="全体のシャード数（auto でDiscordの推奨値）")
+    parser.add_argument('--db', default='shared_state.db', help="共有ストア（SQLite）のパス")
+    parser.add_argument('--max-restart-delay', type=float, default=60.0, help="異常終了したプロセスを再起動するまでの最大待ち時間（秒）")
+    args = parser.parse_args()
+
+    token = os.getenv('DISCORD_BOT_TOKEN')
+    if not token:
+        print("❌ DISCORD_BOT_TOKENが設定されていません")
+        return 1
+
+    if args.shards == 'auto':
+        shard_count, max_concurrency = fetch_gateway_info(token)
+    else:
+        shard_count, max_concurrency = int(args.shards), 1
+    assignments = split_shards(shard_count, args.workers)
+    db_path = os.path.abspath(args.db)
+    print(f"🧩 {len(assignments)}プロセス × 計{shard_count}シャードで起動します（共有ストア: {db_path}）")
+
+    workers = {}
+    restart_delays = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # 各プロセスが同時に IDENTIFY して制限に当たらないよう、担当シャード数に応じて間隔を空けて起動
+    for cluster_id, shard_ids in enumerate(assignments):
+        if stopping:
+            break
+        workers[cluster_id] = start_worker(cluster_id, shard_ids, shard_count, db_path)
+        restart_delays[cluster_id] = 1.0
+        if cluster_id < len(assignments) - 1:
+            time.sleep(IDENTIFY_INTERVAL * len(shard_ids) / max_concurrency)
+
+    # 異常終了したプロセスを指数的に間隔を空けて再起動
+    restart_at = {}
+    while not stopping:
+        time.sleep(1.0)
+        for cluster_id, process in list(workers.items()):
+            if process.poll() is None:
+                continue
+            if cluster_id not in restart_at:
+                print(f"⚠️ プロセス {cluster_id} が終了しました（終了コード {process.returncode}）。{restart_delays[cluster_id]:.0f}秒後に再起動します")
+                restart_at[cluster_id] = time.time() + restart_delays[cluster_id]
+                restart_delays[cluster_id] = min(restart_delays[cluster_id] * 2, args.max_restart_delay)
+            elif time.time() >= restart_at[cluster_id]:
+                del restart_at[cluster_id]
+                workers[cluster_id] = start_worker(cluster_id, assignments[cluster_id], shard_count, db_path)
+
+    print("🛑 すべてのプロセスを停止しています...")
+    for process in workers.values():
+        if process.poll() is None:
+            process.terminate()
+    for process in workers.values():
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,17 +4,141 @@ import re
 import os
 import asyncio
 import glob
+import json
+import io
+import hashlib
+import urllib.parse
+import contextvars
 from discord.ext import commands
 from typing import Optional
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
+from array import array
+from bisect import bisect_left
+from aiohttp import web
 import time
+import math
+import sys
+import tracemalloc
+import sqlite3
+import threading
+import queue
+import atexit
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+import detector_worker
 
 # Discordボット設定
 intents = discord.Intents.default()
 intents.message_content = True
 intents.guilds = True  # サーバー参加・退出イベントに必要
 intents.members = True  # メンバー情報取得に必要
-bot = commands.Bot(command_prefix='n!', intents=intents)
+
+# シャーディング設定（SHARD_COUNT=auto で自動シャーディング、数値でシャード数を固定、未設定なら単一接続）
+# SHARD_IDS はこのプロセスが担当するシャード番号（カンマ区切り、cluster.py が設定）
+SHARD_COUNT = os.getenv('SHARD_COUNT', '').strip().lower()
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()] or None
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix='n!',
+        intents=intents,
+        shard_count=None if SHARD_COUNT == 'auto' else int(SHARD_COUNT),
+        shard_ids=SHARD_IDS
+    )
+else:
+    bot = commands.Bot(command_prefix='n!', intents=intents)
+
+# ログ設定（イベントループを止めないよう、キューに積んでバックグラウンドのスレッドが書き出す）
+LOG_SETTINGS = {
+    'level': os.getenv('LOG_LEVEL', 'info').lower(),  # debug / info / warning / error
+    'format': os.getenv('LOG_FORMAT', 'json').lower(),  # json: 1行1レコードのJSON, text: 人が読む形式
+    'queue_size': 10000,   # キューの上限（超えた分は破棄して数える）
+    'sample_window': 60,   # 同じキーのレコードを数える期間（秒）
+    'sample_limit': 20     # 期間内に同じキーで出力する最大件数（超えた分は間引いて件数だけ残す）
+}
+
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40, 'off': 100}
+
+log_queue = queue.Queue(maxsize=LOG_SETTINGS['queue_size'])
+log_samples = {}  # キー -> [期間の開始時刻, 期間内の件数, 間引いた件数]
+log_state = {'dropped': 0, 'suppressed': 0, 'thread': None}
+
+def log_event(level, event, message, key=None, **fields):
+    """
+    構造化ログを1件キューに積む（ブロックしない）
+    keyを指定すると、同じキーのレコードは sample_window 秒あたり sample_limit 件までに間引かれ、
+    次に出力されるレコードに間引いた件数（suppressed）が付きます。
+    """
+    if LOG_LEVELS.get(level, 20) < LOG_LEVELS.get(LOG_SETTINGS['level'], 20):
+        return
+    
+    now = time.time()
+    record = {'ts': now, 'level': level, 'event': event, 'msg': message}
+    if key is not None:
+        sample = log_samples.get(key)
+        if sample is None or now - sample[0] >= LOG_SETTINGS['sample_window']:
+            suppressed = sample[2] if sample else 0
+            sample = log_samples[key] = [now, 0, 0]
+            if suppressed:
+                record['suppressed'] = suppressed
+        sample[1] += 1
+        if sample[1] > LOG_SETTINGS['sample_limit']:
+            sample[2] += 1
+            log_state['suppressed'] += 1
+            return
+        if sample[2]:
+            record['suppressed'] = sample[2]
+            sample[2] = 0
+    record.update(fields)
+    
+    try:
+        log_queue.put_nowait(record)
+    except queue.Full:
+        log_state['dropped'] += 1
+    
+    if log_state['thread'] is None:
+        start_log_writer()
+
+def format_log_record(record):
+    if LOG_SETTINGS['format'] == 'text':
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['ts']))
+        extra = ' '.join(f"{name}={value}" for name, value in record.items() if name not in ('ts', 'level', 'event', 'msg'))
+        return f"{timestamp} {record['level'].upper():<7} {record['msg']}" + (f" [{extra}]" if extra else "")
+    return json.dumps(record, ensure_ascii=False, default=str)
+
+def write_log_records():
+    """キューのレコードをまとめて標準出力に書き出す（バックグラウンドスレッド）"""
+    while True:
+        record = log_queue.get()
+        lines = []
+        while record is not None:
+            lines.append(format_log_record(record))
+            if len(lines) >= 500:
+                break
+            try:
+                record = log_queue.get_nowait()
+            except queue.Empty:
+                record = None
+        try:
+            sys.stdout.write('\n'.join(lines) + '\n')
+            sys.stdout.flush()
+        except (OSError, ValueError):
+            log_state['dropped'] += len(lines)
+
+def start_log_writer():
+    """ログ書き出しスレッドを開始（1回のみ）"""
+    if log_state['thread'] is None:
+        log_state['thread'] = threading.Thread(target=write_log_records, name='log-writer', daemon=True)
+        log_state['thread'].start()
+
+@atexit.register
+def flush_logs(timeout=2.0):
+    """終了時にキューに残っているレコードを書き出すまで少し待つ"""
+    deadline = time.time() + timeout
+    while log_state['thread'] is not None and not log_queue.empty() and time.time() < deadline:
+        time.sleep(0.01)
 
 # ロール名の定数
 ROLE_NAME = "Level Cannies η"
@@ -33,7 +157,7 @@ SPAM_SETTINGS = {
 user_message_history = defaultdict(lambda: defaultdict(lambda: deque(maxlen=20)))  # (guild_id, user_id)のメッセージ履歴
 user_last_messages = defaultdict(lambda: defaultdict(lambda: deque(maxlen=5)))     # (guild_id, user_id)の最新メッセージ内容
 user_warnings = defaultdict(lambda: defaultdict(int))                             # (guild_id, user_id)の警告回数
-spam_stats = defaultdict(lambda: {'messages_deleted': 0, 'warnings_given': 0, 'mutes_applied': 0})
+spam_stats = defaultdict(lambda: {'messages_deleted': 0, 'warnings_given': 0, 'mutes_applied': 0, 'notices_suppressed': 0})
 pending_unmutes = {}  # 予定されているミュート解除タスクを追跡
 
 # ホワイトリスト用データ構造（サーバー別にスコープ）
@@ -57,10 +181,701 @@ def create_banword_settings():
 
 banword_data = defaultdict(create_banword_settings)
 
-async def is_spam(message):
+# 参加レイド検出設定
+JOIN_RAID_SETTINGS = {
+    'window_seconds': 10,          # 参加数を数える時間窓（秒、1秒ごとのバケット数）
+    'join_limit': 10,              # 時間窓内の参加数しきい値
+    'young_account_age': 86400,    # 新規アカウントとみなす作成後の経過時間（秒）
+    'young_join_limit': 5,         # 時間窓内の新規アカウント参加数しきい値
+    'lockdown_duration': 600,      # ロックダウンの継続時間（秒）
+    'timeout_duration': 600,       # バースト中の参加者へのタイムアウト時間（秒）
+    'recent_joins': 50             # バースト時にさかのぼってタイムアウトする最大人数
+}
+
+# アカウント年齢ヒストグラムの境界（秒）: 1時間未満, 1日未満, 7日未満, 30日未満, それ以上
+ACCOUNT_AGE_EDGES = (3600, 86400, 604800, 2592000)
+
+def create_join_tracker():
+    """サーバーごとの参加レート追跡用データ（サイズ固定）"""
+    window = JOIN_RAID_SETTINGS['window_seconds']
+    bins = len(ACCOUNT_AGE_EDGES) + 1
+    return {
+        'second': 0,                                # 最後に記録した秒
+        'counts': [0] * window,                     # 1秒ごとの参加数
+        'ages': [[0] * bins for _ in range(window)],  # 1秒ごとのアカウント年齢ヒストグラム
+        'total': 0,                                 # 時間窓内の参加数
+        'age_totals': [0] * bins,                   # 時間窓内のアカウント年齢ヒストグラム
+        'recent': deque(maxlen=JOIN_RAID_SETTINGS['recent_joins'])  # (時刻, ユーザーID)
+    }
+
+def create_raid_guard_settings():
+    return {
+        'enabled': False,         # 参加レイド検出の有効/無効
+        'verification': True,     # ロックダウン時に認証レベルを引き上げる
+        'pause_invites': True,    # ロックダウン時に招待を一時停止する
+        'timeout': False          # バースト中の参加者をタイムアウトする
+    }
+
+join_trackers = defaultdict(create_join_tracker)
+raid_guard_data = defaultdict(create_raid_guard_settings)
+raid_lockdowns = {}  # guild_id -> ロックダウン状態
+
+# サーバーごとに有効な機能のビットマスク（有効な機能がないサーバーは登録しない）
+FEATURE_WHITELIST = 1
+FEATURE_BANWORD = 2
+FEATURE_RAID_GUARD = 4
+FEATURE_RULES = 8
+FEATURE_REGISTRIES = (
+    ('whitelist_data', create_whitelist, FEATURE_WHITELIST),
+    ('banword_data', create_banword_settings, FEATURE_BANWORD),
+    ('raid_guard_data', create_raid_guard_settings, FEATURE_RAID_GUARD)
+)
+
+guild_features = {}  # guild_id -> 有効な機能（設定の変更時に再計算し、メッセージ処理では参照のみ）
+
+def refresh_guild_features(guild_id):
+    """設定から機能のビットマスクを再計算し、既定値のままの設定は破棄する"""
+    features = 0
+    for name, factory, flag in FEATURE_REGISTRIES:
+        registry = globals()[name]
+        settings = registry.get(guild_id)
+        if settings is None:
+            continue
+        if settings == factory():
+            del registry[guild_id]
+        elif settings['enabled']:
+            features |= flag
+    if guild_id in guild_rules:
+        features |= FEATURE_RULES
+    if features:
+        guild_features[guild_id] = features
+    else:
+        guild_features.pop(guild_id, None)
+    return features
+
+# サーバー別の状態（guild_id をキーとする構造体）。シャードごとの整合・削除の対象
+GUILD_STATE_STRUCTURES = (
+    'user_message_history', 'user_last_messages', 'user_warnings', 'spam_stats',
+    'whitelist_data', 'banword_data', 'join_trackers', 'raid_guard_data', 'cooldown_data',
+    'banword_matchers', 'member_verdicts', 'guild_features', 'moderation_stage_overrides', 'guild_rules', 'rule_activity',
+    'shadow_stats', 'banword_pattern_slow'
+)
+ready_shards = set()  # 一度でも準備完了になったシャード（再接続の判定用）
+
+def guild_shard_id(guild_id):
+    """サーバーが属するシャード番号（Discordの規則: (guild_id >> 22) % シャード数）"""
+    return (guild_id >> 22) % (bot.shard_count or 1)
+
+def shard_guild_ids(shard_id):
+    """指定したシャードに属し、状態を保持しているサーバーIDの集合"""
+    guild_ids = set()
+    for name in GUILD_STATE_STRUCTURES:
+        guild_ids.update(guild_id for guild_id in globals()[name] if guild_shard_id(guild_id) == shard_id)
+    return guild_ids
+
+def drop_guild_state(guild_id):
+    """サーバー別の状態と、予定されているミュート解除タスクを破棄"""
+    for name in GUILD_STATE_STRUCTURES:
+        globals()[name].pop(guild_id, None)
+    for key in [key for key in pending_unmutes if key[0] == guild_id]:
+        pending_unmutes.pop(key).cancel()
+
+async def rehydrate_shard(shard_id):
+    """
+    再接続（セッションの再作成）したシャードに属するサーバーの状態だけを整合させる
+    切断中に退出したサーバーの状態を破棄し、そのシャードの一括バンジョブを再開します。
+    他のシャードの状態には触れません。
+    """
+    current = {guild.id for guild in bot.guilds if guild_shard_id(guild.id) == shard_id}
+    stale = shard_guild_ids(shard_id) - current
+    for guild_id in stale:
+        drop_guild_state(guild_id)
+    
+    # 共有ストアがある場合は、このシャードのサーバー設定を読み直す
+    if shared_state['db'] is not None:
+        await load_shared_config(shard_id)
+    
+    await resume_mass_ban_jobs(shard_id)
+    log_event('info', 'shard_rehydrated', f"🔄 シャード {shard_id} の状態を整合しました（サーバー {len(current)} 件、破棄 {len(stale)} 件）", shard_id=shard_id)
+
+# クラスタ設定（cluster.py から複数プロセスで起動された場合に環境変数で設定される）
+CLUSTER_SETTINGS = {
+    'cluster_id': int(os.getenv('CLUSTER_ID', '0')),        # このプロセスの番号
+    'shared_state_path': os.getenv('SHARED_STATE_DB', ''),   # 共有ストア（SQLite WAL）。未設定なら単一プロセス
+    'poll_interval': 0.02,     # 他プロセスの変更を確認する間隔（秒）
+    'stats_interval': 5.0,     # プロセスごとの統計を書き込む間隔（秒）。このとき全プロセスが反映済みの変更履歴を削除する
+    'stale_after': 30.0        # この秒数以上更新のないプロセスの統計は集計せず、変更履歴の削除も待たない
+}
+
+# 共有ストアで同期する設定の種類と、変更しうるコマンド
+SHARED_CONFIG_COMMANDS = {'whitelist': 'whitelist', 'banword': 'banword', 'antispam': 'spam_settings', 'cooldown': 'cooldown',
+                          'pipeline': 'pipeline', 'rules': 'rules'}
+
+# 共有ストアの操作はすべて専用スレッド（executor）で行う。書き込みロック待ち（最大 timeout 秒）でイベントループを止めないため
+shared_state = {'db': None, 'executor': None, 'data_version': None, 'last_seq': 0, 'published': {}, 'task': None, 'stats_written_at': 0.0}
+
+def owns_guild(guild_id):
+    """このプロセスがサーバーを担当しているか（guild_id 0 は全体設定）"""
+    shard_ids = getattr(bot, 'shard_ids', None)
+    return guild_id == 0 or not shard_ids or guild_shard_id(guild_id) in shard_ids
+
+async def run_shared_store(function, *args):
+    """共有ストアの操作を専用スレッドで実行する（接続はこのスレッドでのみ使う）"""
+    return await asyncio.get_running_loop().run_in_executor(shared_state['executor'], function, *args)
+
+def open_shared_state(path):
+    """共有ストアを開き、テーブルを作成する（専用スレッドで実行）"""
+    db = sqlite3.connect(path, isolation_level=None, timeout=5.0, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS guild_config (
+            guild_id INTEGER NOT NULL, kind TEXT NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL,
+            PRIMARY KEY (guild_id, kind));
+        CREATE TABLE IF NOT EXISTS config_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, guild_id INTEGER NOT NULL, kind TEXT NOT NULL, origin INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS worker_stats (
+            cluster_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS change_cursors (
+            cluster_id INTEGER PRIMARY KEY, last_seq INTEGER NOT NULL, updated_at REAL NOT NULL);
+    """)
+    return db
+
+def serialize_config(guild_id, kind):
+    """設定をJSON文字列にする（比較できるよう、集合はソート済みリストにする）"""
+    if kind == 'whitelist':
+        whitelist = whitelist_data.get(guild_id) or create_whitelist()
+        data = {'enabled': whitelist['enabled'], 'users': sorted(whitelist['users']), 'roles': sorted(whitelist['roles'])}
+    elif kind == 'banword':
+        banword_settings = banword_data.get(guild_id) or create_banword_settings()
+        data = {'enabled': banword_settings['enabled'], 'words': sorted(banword_settings['words']),
+                'action': banword_settings['action'], 'case_sensitive': banword_settings['case_sensitive']}
+    elif kind == 'cooldown':
+        data = cooldown_data.get(guild_id, {})
+    elif kind == 'pipeline':
+        data = moderation_stage_overrides.get(guild_id, {})
+    elif kind == 'rules':
+        ruleset = guild_rules.get(guild_id)
+        data = json.loads(ruleset['source']) if ruleset else None
+    else:
+        data = SPAM_SETTINGS
+    return json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+def apply_config(guild_id, kind, text):
+    """共有ストアの設定を反映する（他の処理が参照を保持しているため、集合は中身を入れ替える）"""
+    data = json.loads(text)
+    if kind == 'whitelist':
+        whitelist = whitelist_data[guild_id]
+        whitelist['enabled'] = data['enabled']
+        whitelist['users'].clear()
+        whitelist['users'].update(data['users'])
+        whitelist['roles'].clear()
+        whitelist['roles'].update(data['roles'])
+        invalidate_member_verdicts(guild_id)
+    elif kind == 'banword':
+        banword_settings = banword_data[guild_id]
+        banword_settings['words'].clear()
+        banword_settings['words'].update(data.pop('words'))
+        banword_settings.update(data)
+    elif kind == 'cooldown':
+        cooldown_settings = cooldown_data[guild_id]
+        cooldown_settings.clear()
+        cooldown_settings.update(data)
+    elif kind == 'pipeline':
+        overrides = moderation_stage_overrides[guild_id]
+        overrides.clear()
+        overrides.update(data)
+    elif kind == 'rules':
+        install_guild_rules(guild_id, compile_rules(text) if data else None)
+    else:
+        SPAM_SETTINGS.update(data)
+    if kind in ('whitelist', 'banword'):
+        refresh_guild_features(guild_id)
+    if kind == 'banword':
+        invalidate_banword_matcher(guild_id)
+    shared_state['published'][(guild_id, kind)] = text
+
+async def publish_config(guild_id, kind):
+    """設定が前回から変わっていれば共有ストアに書き込み、他のプロセスに通知する"""
+    text = serialize_config(guild_id, kind)
+    if shared_state['published'].get((guild_id, kind)) == text:
+        return
+    await run_shared_store(write_shared_config, guild_id, kind, text)
+    shared_state['published'][(guild_id, kind)] = text
+
+def write_shared_config(guild_id, kind, text):
+    db = shared_state['db']
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute('INSERT OR REPLACE INTO guild_config VALUES (?, ?, ?, ?)', (guild_id, kind, text, time.time()))
+        db.execute('INSERT INTO config_changes (guild_id, kind, origin) VALUES (?, ?, ?)',
+                   (guild_id, kind, CLUSTER_SETTINGS['cluster_id']))
+        db.execute('COMMIT')
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+
+async def load_shared_config(shard_id=None):
+    """共有ストアから担当サーバー（shard_idを指定した場合はそのシャードのみ）の設定を読み込む"""
+    last_seq, rows = await run_shared_store(read_shared_config)
+    shared_state['last_seq'] = max(shared_state['last_seq'], last_seq)
+    loaded = 0
+    for guild_id, kind, text in rows:
+        if not owns_guild(guild_id):
+            continue
+        if shard_id is not None and guild_id != 0 and guild_shard_id(guild_id) != shard_id:
+            continue
+        apply_config(guild_id, kind, text)
+        loaded += 1
+    return loaded
+
+def read_shared_config():
+    db = shared_state['db']
+    last_seq = db.execute("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'config_changes'), 0)").fetchone()[0]
+    return last_seq, db.execute('SELECT guild_id, kind, data FROM guild_config').fetchall()
+
+async def apply_shared_changes():
+    """他のプロセスが書き込んだ変更を反映する（変更がなければ PRAGMA data_version の確認のみ）"""
+    changes = await run_shared_store(read_shared_changes, shared_state['data_version'], shared_state['last_seq'])
+    if changes is None:
+        return 0
+    shared_state['data_version'], rows, missed = changes
+    if missed:
+        # 反映する前に変更履歴が削除されていた（長く止まっていた）場合は、すべての設定を読み直す
+        log_event('warning', 'shared_state_resync', "共有ストアの変更履歴が削除済みのため、設定をすべて読み直します", key='shared_state_resync')
+        return await load_shared_config()
+    
+    applied = 0
+    for seq, guild_id, kind, origin, text in rows:
+        shared_state['last_seq'] = seq
+        if origin == CLUSTER_SETTINGS['cluster_id'] or not owns_guild(guild_id):
+            continue
+        if text is not None:
+            apply_config(guild_id, kind, text)
+            applied += 1
+    return applied
+
+def read_data_version():
+    return shared_state['db'].execute('PRAGMA data_version').fetchone()[0]
+
+def read_shared_changes(data_version, last_seq):
+    """(data_version, last_seq より後の変更と現在の設定, 変更履歴が欠けているか)。変更がなければNone"""
+    db = shared_state['db']
+    current_version = read_data_version()
+    if current_version == data_version:
+        return None
+    # 残っている最も古い変更（すべて削除済みなら次に振られる番号）が last_seq の次より後なら、間の変更は削除済み
+    oldest = db.execute("""
+        SELECT COALESCE((SELECT MIN(seq) FROM config_changes),
+                        (SELECT seq + 1 FROM sqlite_sequence WHERE name = 'config_changes'), 1)""").fetchone()[0]
+    if oldest > last_seq + 1:
+        return current_version, [], True
+    rows = db.execute("""
+        SELECT changes.seq, changes.guild_id, changes.kind, changes.origin, config.data
+        FROM config_changes AS changes
+        LEFT JOIN guild_config AS config ON config.guild_id = changes.guild_id AND config.kind = changes.kind
+        WHERE changes.seq > ? ORDER BY changes.seq""", (last_seq,)).fetchall()
+    return current_version, rows, False
+
+def collect_worker_stats():
+    """このプロセスの統計（n!perf / n!serverinfo でクラスタ全体を集計するため）"""
+    stages = {}
+    for key in list(perf_sketches):
+        count, (p50, p99) = query_perf(key, 5)
+        if count:
+            stages[key] = [count, p50, p99]
+    totals = defaultdict(int)
+    for stats in spam_stats.values():
+        for name, value in stats.items():
+            totals[name] += value
+    return {
+        'pid': os.getpid(),
+        'shard_ids': sorted(get_shard_states()),
+        'guilds': len(bot.guilds),
+        'members': sum(guild.member_count or 0 for guild in bot.guilds),
+        'latency': bot.latency if math.isfinite(bot.latency) else None,
+        'stages': stages,
+        'spam_stats': totals
+    }
+
+async def write_worker_stats():
+    shared_state['stats_written_at'] = time.time()
+    await run_shared_store(write_worker_row, json.dumps(collect_worker_stats()), shared_state['last_seq'])
+
+def write_worker_row(data, last_seq):
+    """統計と反映済みの位置を書き込み、更新が途絶えていない全プロセスが反映済みの変更履歴を削除する"""
+    db = shared_state['db']
+    cluster_id = CLUSTER_SETTINGS['cluster_id']
+    now = time.time()
+    db.execute('INSERT OR REPLACE INTO worker_stats VALUES (?, ?, ?)', (cluster_id, data, now))
+    db.execute('INSERT OR REPLACE INTO change_cursors VALUES (?, ?, ?)', (cluster_id, last_seq, now))
+    db.execute('DELETE FROM config_changes WHERE seq <= (SELECT MIN(last_seq) FROM change_cursors WHERE updated_at >= ?)',
+               (now - CLUSTER_SETTINGS['stale_after'],))
+
+async def read_cluster_stats():
+    """更新が途絶えていないプロセスの統計を cluster_id -> 統計 で返す（共有ストアがなければ空）"""
+    if shared_state['db'] is None:
+        return {}
+    rows = await run_shared_store(read_worker_rows, time.time() - CLUSTER_SETTINGS['stale_after'])
+    return {cluster_id: json.loads(data) for cluster_id, data in rows}
+
+def read_worker_rows(threshold):
+    return shared_state['db'].execute(
+        'SELECT cluster_id, data FROM worker_stats WHERE updated_at >= ? ORDER BY cluster_id', (threshold,)).fetchall()
+
+async def poll_shared_state():
+    """他のプロセスの設定変更を数十ミリ秒以内に反映し、一定間隔で統計を書き込む"""
+    while True:
+        await asyncio.sleep(CLUSTER_SETTINGS['poll_interval'])
+        try:
+            await apply_shared_changes()
+            if time.time() - shared_state['stats_written_at'] >= CLUSTER_SETTINGS['stats_interval']:
+                await write_worker_stats()
+        except sqlite3.Error as e:
+            log_event('error', 'shared_state_error', f"共有ストアエラー: {e}", key='shared_state_error')
+
+async def start_shared_state():
+    """共有ストアを開いて担当サーバーの設定を読み込み、変更の監視を開始（1回のみ）"""
+    path = CLUSTER_SETTINGS['shared_state_path']
+    if not path or shared_state['executor'] is not None:
+        return
+    shared_state['executor'] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-state')
+    shared_state['db'] = await run_shared_store(open_shared_state, path)
+    shared_state['data_version'] = await run_shared_store(read_data_version)
+    loaded = await load_shared_config()
+    await write_worker_stats()
+    shared_state['task'] = asyncio.create_task(poll_shared_state())
+    log_event('info', 'shared_state_connected', f"🧩 共有ストアに接続しました: {path}（プロセス {CLUSTER_SETTINGS['cluster_id']}、設定 {loaded} 件）")
+
+def account_age_bin(account_age):
+    """アカウント年齢からヒストグラムのビン番号を求める"""
+    for index, edge in enumerate(ACCOUNT_AGE_EDGES):
+        if account_age < edge:
+            return index
+    return len(ACCOUNT_AGE_EDGES)
+
+def record_member_join(tracker, account_age, now):
+    """参加を記録し、参加フラッドかどうかを返す（1参加あたりO(1)）"""
+    window = len(tracker['counts'])
+    # 時計が戻った場合は最後に記録した秒のバケットに数える（古いバケットに積まれたまま窓から外れなくなるのを防ぐ）
+    second = max(int(now), tracker['second'])
+    
+    # 古いバケットを時間窓から外す（最大でwindow個なので償却O(1)）
+    if second != tracker['second']:
+        steps = min(second - tracker['second'], window)
+        for offset in range(1, steps + 1):
+            index = (tracker['second'] + offset) % window
+            tracker['total'] -= tracker['counts'][index]
+            tracker['counts'][index] = 0
+            bucket_ages = tracker['ages'][index]
+            for age_bin, count in enumerate(bucket_ages):
+                if count:
+                    tracker['age_totals'][age_bin] -= count
+                    bucket_ages[age_bin] = 0
+        tracker['second'] = second
+    
+    index = second % window
+    age_bin = account_age_bin(account_age)
+    tracker['counts'][index] += 1
+    tracker['ages'][index][age_bin] += 1
+    tracker['total'] += 1
+    tracker['age_totals'][age_bin] += 1
+    
+    if tracker['total'] >= JOIN_RAID_SETTINGS['join_limit']:
+        return True
+    
+    young_bins = account_age_bin(JOIN_RAID_SETTINGS['young_account_age'])
+    young_joins = sum(tracker['age_totals'][:young_bins])
+    return young_joins >= JOIN_RAID_SETTINGS['young_join_limit']
+
+# 複数サーバー横断の同一内容検出設定（プロセス全体で共有）
+CROSS_GUILD_SETTINGS = {
+    'enabled': True,          # 横断検出の有効/無効
+    # スケッチの大きさは、1世代に異なる内容が6万件（プロセス全体で200件/秒）入っても衝突で誤検出しないように決めている
+    'width': 1 << 18,         # カウントミンスケッチの列数
+    'depth': 4,               # カウントミンスケッチの行数（ハッシュ関数の数）
+    'seen_bits': 1 << 24,     # (内容, サーバー/ユーザー) の既出判定用ブルームフィルタのビット数（2の累乗）
+    'window': 300,            # 世代を入れ替える間隔（秒、実効窓は1〜2倍）
+    'guild_threshold': 3,     # 何サーバー以上で出現したらスパムとみなすか
+    'author_threshold': 3,    # 何人以上が投稿したらスパムとみなすか
+    'min_length': 20          # 判定対象とする最小文字数（短い挨拶などを除外）
+}
+
+def create_fingerprint_generation():
+    """1世代分のスケッチ（メモリサイズは設定値で固定）"""
+    size = CROSS_GUILD_SETTINGS['width'] * CROSS_GUILD_SETTINGS['depth']
+    return {
+        'guilds': array('B', [0]) * size,   # 内容ごとの出現サーバー数（しきい値と比べるだけなので255で止める）
+        'authors': array('B', [0]) * size,  # 内容ごとの投稿者数（同上）
+        'seen': bytearray(CROSS_GUILD_SETTINGS['seen_bits'] // 8)  # 既出の (内容, サーバー/ユーザー)
+    }
+
+fingerprint_sketch = {
+    'current': create_fingerprint_generation(),
+    'previous': create_fingerprint_generation(),
+    'rotated_at': time.time()
+}
+
+URL_PATTERN = re.compile(r'https?://[^\s<>]+', re.IGNORECASE)
+MENTION_PATTERN = re.compile(r'<@[!&]?\d+>|@everyone|@here')
+EMOJI_PATTERN = re.compile(r'<a?:\w+:\d+>|[\U0001F000-\U0001FAFF\u2600-\u27BF]')
+
+class MessageFeatures:
+    """
+    検出処理が共通で使うメッセージの特徴量
+    on_message で1件につき1回だけ作り、各検出処理に渡します。各値は初めて参照されたときに計算し、以降は使い回します。
+    acted・acted_stage・shadow_results・overload_level はモデレーションのパイプラインがこのメッセージの処理中に使う状態です。
+    """
+    __slots__ = ('content', '_lowered', '_text', '_content_hash', '_urls', '_domains', '_mention_count', '_emoji_count',
+                 'acted', 'acted_stage', 'shadow_results', 'overload_level')
+    
+    def __init__(self, content):
+        self.content = content
+        self._lowered = None
+        self._text = None
+        self._content_hash = None
+        self._urls = None
+        self._domains = None
+        self._mention_count = None
+        self._emoji_count = None
+        self.acted = False          # 実際に対処した段階があるか
+        self.acted_stage = None     # 最初に対処した段階の名前（トレースに記録時の判定として残す）
+        self.shadow_results = None  # シャドーモードの評価結果 [(名前, 想定される対処 or None, 秒)]
+        self.overload_level = 0     # このメッセージに適用する過負荷時の縮退レベル
+    
+    @property
+    def lowered(self):
+        """小文字化した内容"""
+        if self._lowered is None:
+            self._lowered = self.content.lower()
+        return self._lowered
+    
+    @property
+    def text(self):
+        """正規化した内容（小文字化・空白の圧縮）"""
+        if self._text is None:
+            self._text = ' '.join(self.lowered.split())
+        return self._text
+    
+    @property
+    def content_hash(self):
+        """正規化した内容の64ビットハッシュ"""
+        if self._content_hash is None:
+            self._content_hash = hash(self.text) & 0xFFFFFFFFFFFFFFFF
+        return self._content_hash
+    
+    @property
+    def urls(self):
+        """内容に含まれるURLの一覧"""
+        if self._urls is None:
+            self._urls = URL_PATTERN.findall(self.content)
+        return self._urls
+    
+    @property
+    def domains(self):
+        """URLのホスト名（小文字）の一覧"""
+        if self._domains is None:
+            self._domains = [urllib.parse.urlsplit(url).hostname or '' for url in self.urls]
+        return self._domains
+    
+    @property
+    def mention_count(self):
+        """ユーザー・ロール・@everyone/@here のメンション数"""
+        if self._mention_count is None:
+            self._mention_count = len(MENTION_PATTERN.findall(self.content))
+        return self._mention_count
+    
+    @property
+    def emoji_count(self):
+        """カスタム絵文字とUnicode絵文字の数"""
+        if self._emoji_count is None:
+            self._emoji_count = len(EMOJI_PATTERN.findall(self.content))
+        return self._emoji_count
+    
+    def add_shadow_result(self, name, action, seconds):
+        """シャドーモードの検出処理の結果を追加（action は一致した場合の想定される対処、一致しなければNone）"""
+        if self.shadow_results is None:
+            self.shadow_results = []
+        self.shadow_results.append((name, action, seconds))
+
+def mark_fingerprint_seen(current, previous, key):
+    """
+    (内容, サーバー/ユーザー) のキーを既出として記録し、2世代のどちらにもなかったか（初出か）を返す
+    ブルームフィルタ（ハッシュ2つ）なので、誤って既出とみなすことはあっても初出と誤ることはありません。
+    """
+    mask = CROSS_GUILD_SETTINGS['seen_bits'] - 1
+    first = key & mask
+    second = (key >> 32) & mask
+    first_byte, first_bit = first >> 3, 1 << (first & 7)
+    second_byte, second_bit = second >> 3, 1 << (second & 7)
+    if current[first_byte] & first_bit and current[second_byte] & second_bit:
+        return False
+    current[first_byte] |= first_bit
+    current[second_byte] |= second_bit
+    return not (previous[first_byte] & first_bit and previous[second_byte] & second_bit)
+
+def record_message_fingerprint(guild_id, user_id, text, now, fingerprint=None):
+    """正規化済みの内容を記録し、複数サーバー・複数ユーザーで出現していればTrueを返す"""
+    if len(text) < CROSS_GUILD_SETTINGS['min_length']:
+        return False
+    
+    # 一定時間ごとに世代を入れ替えて古い出現を忘れる（時間減衰）
+    if now - fingerprint_sketch['rotated_at'] >= CROSS_GUILD_SETTINGS['window']:
+        fingerprint_sketch['previous'] = fingerprint_sketch['current']
+        fingerprint_sketch['current'] = create_fingerprint_generation()
+        fingerprint_sketch['rotated_at'] = now
+    
+    current = fingerprint_sketch['current']
+    previous = fingerprint_sketch['previous']
+    width = CROSS_GUILD_SETTINGS['width']
+    
+    if fingerprint is None:
+        fingerprint = hash(text) & 0xFFFFFFFFFFFFFFFF
+    step = (fingerprint >> 32) | 1
+    new_guild = mark_fingerprint_seen(current['seen'], previous['seen'], fingerprint ^ ((guild_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF))
+    new_author = mark_fingerprint_seen(current['seen'], previous['seen'], fingerprint ^ ((user_id * 0xC2B2AE3D27D4EB4F) & 0xFFFFFFFFFFFFFFFF))
+    
+    # 保守的更新: 各行のうち最小のカウンタだけを増やす（衝突による過大な数え上げを抑え、誤検出を減らす）
+    indexes = [row * width + (fingerprint + row * step) % width for row in range(CROSS_GUILD_SETTINGS['depth'])]
+    guilds = current['guilds']
+    authors = current['authors']
+    if new_guild:
+        low = min(map(guilds.__getitem__, indexes))
+        if low < 255:
+            for index in indexes:
+                if guilds[index] == low:
+                    guilds[index] = low + 1
+    if new_author:
+        low = min(map(authors.__getitem__, indexes))
+        if low < 255:
+            for index in indexes:
+                if authors[index] == low:
+                    authors[index] = low + 1
+    previous_guilds = previous['guilds']
+    previous_authors = previous['authors']
+    guild_count = author_count = 510
+    for index in indexes:
+        count = guilds[index] + previous_guilds[index]
+        if count < guild_count:
+            guild_count = count
+        count = authors[index] + previous_authors[index]
+        if count < author_count:
+            author_count = count
+    return guild_count >= CROSS_GUILD_SETTINGS['guild_threshold'] and author_count >= CROSS_GUILD_SETTINGS['author_threshold']
+
+# 類似メッセージ（ほぼ重複）検出設定
+NEAR_DUPLICATE_SETTINGS = {
+    'enabled': True,          # 類似メッセージ検出の有効/無効
+    'shingle_size': 3,        # 文字n-gramの長さ
+    'max_chars': 1000,        # 署名計算に使う最大文字数
+    'min_length': 8,          # 判定対象とする最小文字数
+    'signature_size': 16,     # MinHash署名の要素数
+    'bands': 8,               # LSHのバンド数（signature_sizeを割り切れる数）
+    'similarity': 0.75,       # 類似とみなす推定Jaccard係数
+    'window': 60,             # 比較対象とする時間窓（秒）
+    'author_limit': 2,        # 同一ユーザーの類似メッセージがこれ以上あればスパム
+    'channel_limit': 5,       # チャンネル内の類似メッセージがこれ以上ある（他のユーザーも含めた一斉投稿中の）場合は、
+                              # 同一ユーザーの類似メッセージが1件でもあればスパム（1回だけ投稿したユーザーは対象外）
+    'max_entries': 200,       # チャンネルごとに保持する署名数
+    'max_channels': 5000,     # 署名を保持するチャンネル数の上限
+    'cache_size': 2048        # 同一内容の署名キャッシュ数
+}
+
+near_duplicate_index = OrderedDict()  # channel_id -> {'entries': deque, 'buckets': dict}（LRU）
+signature_cache = OrderedDict()       # 正規化済み内容 -> 署名（LRU）
+
+def compute_message_signature(text):
+    """One Permutation MinHashで文字n-gramの署名を計算（同一内容はキャッシュ）"""
+    signature = signature_cache.get(text)
+    if signature is not None:
+        signature_cache.move_to_end(text)
+        return signature
+    
+    size = NEAR_DUPLICATE_SETTINGS['signature_size']
+    n = NEAR_DUPLICATE_SETTINGS['shingle_size']
+    sample = text[:NEAR_DUPLICATE_SETTINGS['max_chars']]
+    
+    # n-gramのハッシュを集合内包表記でまとめて計算し、ビンごとの最小値を取る
+    shingles = {hash(sample[i:i + n]) & 0xFFFFFFFFFFFFFFFF for i in range(len(sample) - n + 1)}
+    mins = [None] * size
+    for value in shingles:
+        slot = value % size
+        current = mins[slot]
+        if current is None or value < current:
+            mins[slot] = value
+    
+    # 空のビンは次の空でないビンの値で埋める（短いメッセージでの誤一致を防ぐ）
+    if shingles:
+        for slot in range(size):
+            offset = 1
+            while mins[slot] is None:
+                mins[slot] = mins[(slot + offset) % size]
+                offset += 1
+    signature = tuple(mins)
+    
+    signature_cache[text] = signature
+    if len(signature_cache) > NEAR_DUPLICATE_SETTINGS['cache_size']:
+        signature_cache.popitem(last=False)
+    return signature
+
+def record_near_duplicate(channel_id, user_id, signature, now):
+    """署名をチャンネルのLSHインデックスに登録し、(同一ユーザーの類似数, チャンネル内の類似数) を返す"""
+    index = near_duplicate_index.get(channel_id)
+    if index is None:
+        index = {'entries': deque(), 'buckets': {}}
+        near_duplicate_index[channel_id] = index
+        if len(near_duplicate_index) > NEAR_DUPLICATE_SETTINGS['max_channels']:
+            near_duplicate_index.popitem(last=False)
+    else:
+        near_duplicate_index.move_to_end(channel_id)
+    
+    entries = index['entries']
+    buckets = index['buckets']
+    
+    # 古い署名を削除（登録順に並んでいるので各バケットの先頭から外せる）
+    while entries and (len(entries) >= NEAR_DUPLICATE_SETTINGS['max_entries'] or
+                       now - entries[0][0] > NEAR_DUPLICATE_SETTINGS['window']):
+        expired = entries.popleft()
+        for key in expired[3]:
+            bucket = buckets[key]
+            bucket.popleft()
+            if not bucket:
+                del buckets[key]
+    
+    # バンドごとのバケットから候補を集める
+    size = NEAR_DUPLICATE_SETTINGS['signature_size']
+    rows = size // NEAR_DUPLICATE_SETTINGS['bands']
+    keys = tuple(hash((band,) + signature[band * rows:(band + 1) * rows]) for band in range(NEAR_DUPLICATE_SETTINGS['bands']))
+    candidates = {}
+    for key in keys:
+        for entry in buckets.get(key, ()):
+            candidates[id(entry)] = entry
+    
+    same_author = total = 0
+    threshold = NEAR_DUPLICATE_SETTINGS['similarity'] * size
+    for entry in candidates.values():
+        matches = sum(1 for a, b in zip(signature, entry[2]) if a == b)
+        if matches >= threshold:
+            total += 1
+            if entry[1] == user_id:
+                same_author += 1
+    
+    entry = (now, user_id, signature, keys)
+    entries.append(entry)
+    for key in keys:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = deque()
+        bucket.append(entry)
+    
+    return same_author, total
+
+async def is_spam(message, features=None):
     """スパムを検出する関数"""
     if not SPAM_SETTINGS['enabled']:
         return False
+    if features is None:
+        features = MessageFeatures(message.content)
     
     user_id = message.author.id
     guild_id = message.guild.id
@@ -71,12 +886,12 @@ async def is_spam(message):
         return False
     
     # 管理者は除外
-    if message.author.guild_permissions.administrator:
+    if get_member_verdict(message.author) & VERDICT_ADMIN:
         return False
     
     # メッセージ履歴に追加（サーバー別にスコープ）
     user_message_history[guild_id][user_id].append(current_time)
-    user_last_messages[guild_id][user_id].append(message.content.lower().strip())
+    user_last_messages[guild_id][user_id].append(features.lowered.strip())
     
     # 1. 短時間での大量投稿チェック
     recent_messages = [t for t in user_message_history[guild_id][user_id] 
@@ -85,12 +900,37 @@ async def is_spam(message):
     if len(recent_messages) >= SPAM_SETTINGS['message_limit']:
         return True
     
+    # 過負荷時は連投の判定だけに絞る
+    overload_level = features.overload_level
+    if overload_level >= OVERLOAD_MINIMAL:
+        return False
+    
     # 2. 同一メッセージの連続投稿チェック
     if len(user_last_messages[guild_id][user_id]) >= SPAM_SETTINGS['duplicate_limit']:
         recent_contents = list(user_last_messages[guild_id][user_id])[-SPAM_SETTINGS['duplicate_limit']:]
         if len(set(recent_contents)) == 1 and recent_contents[0].strip():  # 空文字は除外
             return True
     
+    if overload_level >= OVERLOAD_SKIP_EXPENSIVE:
+        return False
+    
+    text = features.text
+    
+    # 3. 複数サーバーにまたがる同一内容の投稿チェック
+    if CROSS_GUILD_SETTINGS['enabled']:
+        if record_message_fingerprint(guild_id, user_id, text, current_time, features.content_hash):
+            return True
+    
+    # 4. 少しだけ変えた類似メッセージの連続投稿チェック
+    if NEAR_DUPLICATE_SETTINGS['enabled'] and len(text) >= NEAR_DUPLICATE_SETTINGS['min_length']:
+        signature = compute_message_signature(text)
+        same_author, total = record_near_duplicate(message.channel.id, user_id, signature, current_time)
+        # 他のユーザーの類似メッセージだけでは対処しない（同じ挨拶を最後に投稿したユーザーを罰しないため）
+        if same_author >= NEAR_DUPLICATE_SETTINGS['author_limit']:
+            return True
+        if same_author and total >= NEAR_DUPLICATE_SETTINGS['channel_limit']:
+            return True
+    
     return False
 
 def is_whitelisted(member):
@@ -98,11 +938,10 @@ def is_whitelisted(member):
     if not member.guild:
         return False
     
-    guild_id = member.guild.id
-    whitelist = whitelist_data[guild_id]
+    whitelist = whitelist_data.get(member.guild.id)
     
     # ホワイトリスト機能が無効の場合は常にFalse
-    if not whitelist['enabled']:
+    if whitelist is None or not whitelist['enabled']:
         return False
     
     # ユーザーIDがホワイトリストに登録されているかチェック
@@ -116,34 +955,400 @@ def is_whitelisted(member):
     
     return False
 
-def contains_banned_word(message):
+# メンバーごとの判定結果（権限・ホワイトリスト）のキャッシュ。ロールや設定の変更時に破棄する
+VERDICT_ADMIN = 1        # 管理者（スパム検出の対象外）
+VERDICT_WHITELISTED = 2  # ホワイトリストに登録されたユーザー・ロール
+VERDICT_BYPASS = 4       # モデレーションをすべて省略する
+
+member_verdicts = defaultdict(dict)  # guild_id -> member_id -> 判定結果（上記のビットの組み合わせ）
+
+def get_member_verdict(member):
+    """メンバーの判定結果を返す（初回のみ権限とロールを確認し、以降はキャッシュを使う）"""
+    if getattr(member, 'guild_permissions', None) is None:
+        return 0  # Webhookなどサーバーのメンバーでない投稿者
+    verdicts = member_verdicts.get(member.guild.id)
+    verdict = verdicts.get(member.id) if verdicts else None
+    if verdict is None:
+        verdict = 0
+        if member.guild_permissions.administrator:
+            verdict |= VERDICT_ADMIN
+        if is_whitelisted(member):
+            verdict |= VERDICT_WHITELISTED | VERDICT_BYPASS
+        member_verdicts[member.guild.id][member.id] = verdict
+    return verdict
+
+def invalidate_member_verdicts(guild_id, member_id=None):
+    """判定結果のキャッシュを破棄（member_id を省略した場合はサーバー全体）"""
+    if member_id is None:
+        member_verdicts.pop(guild_id, None)
+    elif guild_id in member_verdicts:
+        member_verdicts[guild_id].pop(member_id, None)
+
+def contains_banned_word(message, features=None):
     """メッセージに禁止ワードが含まれているかチェック"""
     if not message.guild:
         return False, None
     
-    guild_id = message.guild.id
-    banword_settings = banword_data[guild_id]
+    banword_settings = banword_data.get(message.guild.id)
     
     # 禁止ワード機能が無効の場合は常にFalse
-    if not banword_settings['enabled']:
+    if banword_settings is None or not banword_settings['enabled']:
         return False, None
     
     # メッセージ内容を取得
-    content = message.content
-    if not content:
+    if features is None:
+        features = MessageFeatures(message.content)
+    if not features.content:
         return False, None
     
-    # 大文字小文字を区別しない場合は小文字に変換
-    if not banword_settings['case_sensitive']:
-        content = content.lower()
+    # 大文字小文字を区別しない場合は小文字にした内容を使う
+    content = features.content if banword_settings['case_sensitive'] else features.lowered
     
     # 各禁止ワードをチェック
-    for banned_word in banword_settings['words']:
-        check_word = banned_word if banword_settings['case_sensitive'] else banned_word.lower()
-        if check_word in content:
-            return True, banned_word
+    version, matcher = get_banword_matcher(message.guild.id, banword_settings)
+    banned_word = match_banwords_inline(message.guild.id, version, matcher, content)
+    return banned_word is not None, banned_word
+
+# 禁止ワードの照合器（設定の変更時に破棄し、次の判定で作り直す。バージョンはワーカーのキャッシュとの照合に使う）
+banword_matchers = {}                 # guild_id -> (バージョン, 照合器)
+banword_matcher_versions = itertools.count(1)
+
+def get_banword_matcher(guild_id, banword_settings):
+    cached = banword_matchers.get(guild_id)
+    if cached is None:
+        matcher = detector_worker.compile_banword_matcher(banword_settings['words'], banword_settings['case_sensitive'])
+        cached = banword_matchers[guild_id] = (next(banword_matcher_versions), matcher)
+    return cached
+
+def invalidate_banword_matcher(guild_id):
+    banword_matchers.pop(guild_id, None)
+    banword_pattern_slow.pop(guild_id, None)
+
+# パターンの禁止ワード（re: で始まるもの・* を含むもの）の設定
+# 登録時に検証しますが、Pythonの正規表現は途中で止められないため、イベントループ上での照合時間も監視し、
+# 遅い照合が一定回数に達したサーバーのパターンは設定が変わるまで停止します（文字列の禁止ワードは引き続き有効）
+BANWORD_PATTERN_SETTINGS = {
+    'max_patterns': 100,    # 1サーバーあたりのパターン数の上限
+    'eval_budget': 0.01,    # 照合1回あたりの時間の目安（秒）
+    'max_slow': 3,          # 目安を超えた回数がこれに達したらパターンを停止
+    'validate_timeout': 5.0  # 登録時の検証（別プロセス）を待つ最大秒数。過ぎたらプロセスを終了して拒否
+}
+
+banword_pattern_slow = {}  # guild_id -> 目安を超えた照合の回数
+
+def match_banwords_inline(guild_id, version, matcher, content):
+    """イベントループ上で照合する（パターンがある場合は時間を計り、遅い照合が一定回数に達したらパターンを停止）"""
+    banned_word = detector_worker.match_literals(matcher, content)
+    if banned_word is not None or matcher['pattern'] is None:
+        return banned_word
+    started_at = time.perf_counter()
+    banned_word = detector_worker.match_patterns(matcher, content)
+    record_pattern_elapsed(guild_id, version, time.perf_counter() - started_at)
+    return banned_word
+
+def record_pattern_elapsed(guild_id, version, elapsed):
+    """パターンの照合時間を記録し、目安を超えた回数が上限に達したらそのサーバーのパターンを停止する（ワーカーでの照合も同じ）"""
+    if elapsed <= BANWORD_PATTERN_SETTINGS['eval_budget']:
+        return
+    slow = banword_pattern_slow[guild_id] = banword_pattern_slow.get(guild_id, 0) + 1
+    current = banword_matchers.get(guild_id)
+    if slow >= BANWORD_PATTERN_SETTINGS['max_slow'] and current is not None and current[0] == version:
+        matcher = current[1]
+        banword_matchers[guild_id] = (next(banword_matcher_versions), dict(matcher, pattern=None, pattern_entries={},
+                                                                        cost=len(matcher['words']), quarantined=True))
+        log_event('warning', 'banword_pattern_quarantined',
+                  f"禁止ワードのパターンの照合が遅いため停止しました: サーバー {guild_id}（{elapsed * 1000:.1f}ms）",
+                  key=f"banword_pattern_quarantined:{guild_id}", guild_id=guild_id, elapsed_ms=round(elapsed * 1000, 1))
+
+async def validate_pattern_in_process(entry, case_sensitive):
+    """
+    パターンの禁止ワードを別プロセスで検証する（問題があれば理由を返す）
+    re の照合はGILを手放さないため、スレッドで検証してもイベントループが止まります。時間内に終わらなければプロセスを終了して拒否します。
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(detector_worker.__file__),
+                                                       stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.DEVNULL)
+    except OSError as e:
+        log_event('error', 'pattern_validate_error', f"パターンの検証プロセスを起動できません: {e}", key='pattern_validate_error')
+        return "パターンを検証できませんでした"
+    request = json.dumps({'entry': entry, 'case_sensitive': case_sensitive}).encode()
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(request), BANWORD_PATTERN_SETTINGS['validate_timeout'])
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return "長いメッセージで処理に時間がかかるパターンです（検証が時間内に終わりませんでした）"
+    if process.returncode != 0:
+        return "パターンを検証できませんでした"
+    return json.loads(stdout)['problem']
+
+# 重い検出処理のプロセスプールへの委譲（イベントループを止めないよう、まとめてワーカーに送る）
+OFFLOAD_SETTINGS = {
+    'workers': int(os.getenv('DETECTOR_WORKERS', '0')),            # ワーカープロセス数（0でイベントループ上で判定）
+    'start_method': os.getenv('DETECTOR_START_METHOD', 'spawn'),  # ワーカーの起動方法（スレッドを持つプロセスのforkを避ける）
+    'inline_max_work': 200000,  # 文字数 × 禁止ワード数（パターンは1件を PATTERN_COST 件分として数える）がこれ以下ならイベントループ上で判定（プロセス間通信のほうが高くつく）
+    'batch_window': 0.002,      # 最初の項目からまとめて送るまで待つ秒数
+    'max_batch': 64,            # 1回にまとめる項目数の上限（ワーカー数で分けて送る）
+    'timeout': 30.0             # ワーカーの結果を待つ最大秒数（過ぎたら一致なしとして扱う）
+}
+
+offload_state = {'executor': None, 'pending': [], 'flush_handle': None}
+offload_stats = {'inline': 0, 'offloaded': 0, 'batches': 0, 'resent': 0, 'fallback': 0, 'timeout': 0}
+
+def start_detector_pool():
+    """ワーカープロセスを起動（1回のみ。workers が0なら何もしない）"""
+    workers = OFFLOAD_SETTINGS['workers']
+    if offload_state['executor'] is not None or workers <= 0:
+        return
+    executor = ProcessPoolExecutor(max_workers=workers,
+                                   mp_context=multiprocessing.get_context(OFFLOAD_SETTINGS['start_method']))
+    for _ in range(workers):
+        executor.submit(detector_worker.warm_up)
+    offload_state['executor'] = executor
+    atexit.register(executor.shutdown, wait=False, cancel_futures=True)
+    log_event('info', 'detector_pool_started', f"🧮 検出処理のワーカーを起動しました: {workers}プロセス", workers=workers)
+
+async def scan_banned_word(message, features):
+    """禁止ワードの判定（重い場合はワーカープロセスに送り、結果を待つ）"""
+    banword_settings = banword_data.get(message.guild.id)
+    if banword_settings is None or not banword_settings['enabled'] or not features.content:
+        return None
+    
+    content = features.content if banword_settings['case_sensitive'] else features.lowered
+    version, matcher = get_banword_matcher(message.guild.id, banword_settings)
+    if offload_state['executor'] is None or len(content) * matcher['cost'] <= OFFLOAD_SETTINGS['inline_max_work']:
+        offload_stats['inline'] += 1
+        return match_banwords_inline(message.guild.id, version, matcher, content)
+    
+    offload_stats['offloaded'] += 1
+    future = asyncio.get_running_loop().create_future()
+    pending = offload_state['pending']
+    pending.append((message.guild.id, version, content, future))
+    if len(pending) >= OFFLOAD_SETTINGS['max_batch']:
+        flush_detector_batch()
+    elif offload_state['flush_handle'] is None:
+        offload_state['flush_handle'] = asyncio.get_running_loop().call_later(OFFLOAD_SETTINGS['batch_window'], flush_detector_batch)
+    try:
+        return await asyncio.wait_for(future, OFFLOAD_SETTINGS['timeout'])
+    except asyncio.TimeoutError:
+        offload_stats['timeout'] += 1
+        log_event('warning', 'detector_timeout', f"検出処理のワーカーが応答しません（{OFFLOAD_SETTINGS['timeout']}秒）", key='detector_timeout')
+        return None
+
+def flush_detector_batch():
+    if offload_state['flush_handle'] is not None:
+        offload_state['flush_handle'].cancel()
+        offload_state['flush_handle'] = None
+    batch = offload_state['pending']
+    offload_state['pending'] = []
+    
+    # ワーカーごとに分けて並列に照合する
+    size = -(-len(batch) // OFFLOAD_SETTINGS['workers'])
+    for start in range(0, len(batch), size):
+        asyncio.create_task(run_detector_batch(batch[start:start + size]))
+
+async def run_detector_batch(batch):
+    """まとめた項目をワーカーで照合し、各項目のFutureに結果を設定する"""
+    loop = asyncio.get_running_loop()
+    executor = offload_state['executor']
+    items = [(guild_id, version, content) for guild_id, version, content, future in batch]
+    offload_stats['batches'] += 1
+    try:
+        results = await loop.run_in_executor(executor, detector_worker.scan_batch, items, {},
+                                             BANWORD_PATTERN_SETTINGS['eval_budget'], BANWORD_PATTERN_SETTINGS['max_slow'])
+        
+        # ワーカーに照合器がなかった項目は、現在の照合器を添えて送り直す
+        missing = [index for index, (result, elapsed) in enumerate(results) if result is detector_worker.MATCHER_MISSING]
+        if missing:
+            retry = []
+            matchers = {}
+            for index in missing:
+                guild_id, version, content = items[index]
+                current = banword_matchers.get(guild_id)
+                if current is None:
+                    results[index] = (None, 0.0)  # 判定までの間に禁止ワードが無効になった
+                    continue
+                matchers[guild_id] = current
+                retry.append((index, (guild_id, current[0], content)))
+            if retry:
+                offload_stats['resent'] += len(retry)
+                retried = await loop.run_in_executor(executor, detector_worker.scan_batch, [item for index, item in retry], matchers,
+                                                     BANWORD_PATTERN_SETTINGS['eval_budget'], BANWORD_PATTERN_SETTINGS['max_slow'])
+                for (index, item), result in zip(retry, retried):
+                    items[index] = item
+                    results[index] = result
+        
+        # 遅いパターンはイベントループ上の照合と同じ基準で停止する
+        for (guild_id, version, content), (result, elapsed) in zip(items, results):
+            if elapsed:
+                record_pattern_elapsed(guild_id, version, elapsed)
+        results = [result for result, elapsed in results]
+    except Exception as e:
+        # ワーカーが落ちた場合はプールを作り直し、この分はイベントループ上で判定する
+        offload_stats['fallback'] += len(batch)
+        log_event('error', 'detector_pool_error', f"検出処理のワーカーエラー: {type(e).__name__}: {e}", key='detector_pool_error')
+        if isinstance(e, BrokenProcessPool) and offload_state['executor'] is executor:
+            offload_state['executor'] = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            start_detector_pool()
+        results = []
+        for guild_id, version, content in items:
+            current = banword_matchers.get(guild_id)
+            results.append(match_banwords_inline(guild_id, current[0], current[1], content) if current else None)
+    
+    for (guild_id, version, content, future), result in zip(batch, results):
+        if not future.done():
+            future.set_result(result)
+
+# モデレーション通知の集約設定（大量投稿時にボット自身の通知でチャンネルや送信枠を埋めないため）
+NOTICE_SETTINGS = {
+    'window': 2.0,            # 同じチャンネルの通知をまとめる時間（秒）
+    'per_minute': 6,          # 1チャンネルあたり1分間に送る通知の上限（超えた分は送らずに数える）
+    'max_listed_users': 15    # まとめた通知に列挙するユーザー数
+}
+
+# 通知の種類 -> (見出し, 対処内容, 表示秒数)
+NOTICE_KINDS = {
+    'spam': ("⚠️ スパム警告", "警告", 10),
+    'banword_delete': ("🚫 禁止ワード検出", "メッセージを削除", 10),
+    'banword_warn': ("⚠️ 禁止ワード警告", "警告", 15),
+    'banword_mute': ("🔇 禁止ワード検出 - ミュート", "メッセージを削除してミュート", 20),
+    'rule': ("📜 ルール違反", "警告", 15)
+}
+
+pending_notices = {}                  # channel_id -> 集約中の通知（window秒後にまとめて送信）
+notice_sent_at = defaultdict(deque)   # channel_id -> 直近1分に送った通知の時刻
+
+def queue_moderation_notice(message, kind, detail=None):
+    """
+    モデレーション通知をチャンネルごとに集約する（送信は window 秒後に1回だけ）
+    detail はスパム警告の警告回数など、ユーザーごとに最新の値を表示する補足です。
+    """
+    channel = message.channel
+    buffer = pending_notices.get(channel.id)
+    if buffer is None:
+        buffer = pending_notices[channel.id] = {'channel': channel, 'guild_id': message.guild.id, 'entries': {}}
+        buffer['task'] = asyncio.create_task(flush_moderation_notices(channel.id))
+    
+    key = (message.author.id, kind)
+    entry = buffer['entries'].get(key)
+    if entry is None:
+        entry = buffer['entries'][key] = {'mention': message.author.mention, 'count': 0, 'detail': None}
+    entry['count'] += 1
+    entry['detail'] = detail
+
+def build_single_notice(kind, entry):
+    """1件だけの場合は従来どおりの通知を作成"""
+    mention = entry['mention']
+    if kind == 'spam':
+        embed = discord.Embed(
+            title="⚠️ スパム警告",
+            description=f"{mention} スパム行為が検出されました。\n警告回数: {entry['detail']}",
+            color=discord.Color.orange()
+        )
+        embed.add_field(
+            name="注意事項", 
+            value="短時間での大量投稿や同じメッセージの繰り返しはスパムとみなされます。", 
+            inline=False
+        )
+    elif kind == 'banword_delete':
+        embed = discord.Embed(
+            title="🚫 禁止ワード検出",
+            description=f"{mention} 禁止されたワードが検出されました。",
+            color=discord.Color.red()
+        )
+        embed.add_field(name="対処", value="メッセージを削除しました。", inline=False)
+        embed.add_field(name="注意事項", value="禁止されたワードを含むメッセージは自動的に削除されます。", inline=False)
+    elif kind == 'banword_warn':
+        embed = discord.Embed(
+            title="⚠️ 禁止ワード警告",
+            description=f"{mention} 禁止されたワードが検出されました。",
+            color=discord.Color.orange()
+        )
+        embed.add_field(name="警告", value="不適切な言葉の使用は控えてください。", inline=False)
+        embed.add_field(name="注意事項", value="今後このような言葉の使用は避けてください。", inline=False)
+    elif kind == 'rule':
+        embed = discord.Embed(
+            title="📜 ルール違反",
+            description=f"{mention} サーバーのルールに違反するメッセージが検出されました。",
+            color=discord.Color.orange()
+        )
+        embed.add_field(name="ルール", value=entry['detail'], inline=False)
+    else:
+        embed = discord.Embed(
+            title="🔇 禁止ワード検出 - ミュート",
+            description=f"{mention} 禁止されたワードの使用によりミュートされました。",
+            color=discord.Color.red()
+        )
+        embed.add_field(name="対処", value="メッセージを削除し、ユーザーを一時的にミュートしました。", inline=False)
+        embed.add_field(name="ミュート解除", value="管理者に解除を依頼するか、一定時間後に自動解除されます。", inline=False)
+    return embed
+
+def build_coalesced_notice(entries, total):
+    """複数件をまとめた通知を作成（種類ごとに対象ユーザーと件数を列挙）"""
+    users = {user_id for user_id, _ in entries}
+    embed = discord.Embed(
+        title="⚠️ モデレーション通知",
+        description=f"直近{NOTICE_SETTINGS['window']:g}秒間に {len(users)}人・{total}件の違反を検出しました。",
+        color=discord.Color.red()
+    )
+    limit = NOTICE_SETTINGS['max_listed_users']
+    for kind, (title, action, _) in NOTICE_KINDS.items():
+        rows = [entry for (_, entry_kind), entry in entries.items() if entry_kind == kind]
+        if not rows:
+            continue
+        rows.sort(key=lambda entry: entry['count'], reverse=True)
+        lines = []
+        for entry in rows[:limit]:
+            detail = f"、{'ルール' if kind == 'rule' else '警告'} {entry['detail']}" if entry['detail'] else ""
+            lines.append(f"{entry['mention']}（{entry['count']}件{detail}）")
+        if len(rows) > limit:
+            lines.append(f"... 他 {len(rows) - limit} 人")
+        embed.add_field(name=f"{title}（{action}）", value="\n".join(lines), inline=False)
+    return embed
+
+def prune_notice_sent_at(now):
+    """直近1分に通知を送っていないチャンネルの送信時刻の記録を削除する"""
+    for channel_id, sent in list(notice_sent_at.items()):
+        while sent and now - sent[0] >= 60:
+            sent.popleft()
+        if not sent:
+            del notice_sent_at[channel_id]
+
+async def flush_moderation_notices(channel_id):
+    """集約した通知を1つの埋め込みとして送信（1分あたりの上限を超えた場合は送らずに数える）"""
+    await asyncio.sleep(NOTICE_SETTINGS['window'])
+    buffer = pending_notices.pop(channel_id, None)
+    if not buffer:
+        return
     
-    return False, None
+    entries = buffer['entries']
+    total = sum(entry['count'] for entry in entries.values())
+    stats = spam_stats[buffer['guild_id']]
+    
+    now = time.time()
+    prune_notice_sent_at(now)
+    sent = notice_sent_at[channel_id]
+    while sent and now - sent[0] >= 60:
+        sent.popleft()
+    if len(sent) >= NOTICE_SETTINGS['per_minute']:
+        stats['notices_suppressed'] += total
+        return
+    sent.append(now)
+    stats['notices_suppressed'] += total - 1
+    
+    if total == 1:
+        (_, kind), entry = next(iter(entries.items()))
+        embed = build_single_notice(kind, entry)
+    else:
+        embed = build_coalesced_notice(entries, total)
+    delete_after = max(NOTICE_KINDS[kind][2] for _, kind in entries)
+    
+    try:
+        await buffer['channel'].send(embed=embed, delete_after=delete_after)
+    except Exception as e:
+        log_event('error', 'notice_error', f"モデレーション通知送信エラー: {e}", key='notice_error', guild_id=buffer['guild_id'])
 
 async def handle_spam_action(message):
     """スパム対処を実行する関数"""
@@ -185,37 +1390,24 @@ async def handle_spam_action(message):
                         if (guild.id, user_id) in pending_unmutes:
                             del pending_unmutes[(guild.id, user_id)]
                     except Exception as e:
-                        print(f"自動ミュート解除エラー: {e}")
+                        log_event('error', 'unmute_error', f"自動ミュート解除エラー: {e}", key='unmute_error', guild_id=guild.id, user_id=user_id)
                 
                 # タスクを作成して追跡
                 task = asyncio.create_task(unmute_after_delay())
                 pending_unmutes[(guild.id, user_id)] = task
                 
             except discord.Forbidden:
-                print(f"ミュート権限不足: {user.name} (サーバー: {guild.name})")
+                log_event('warning', 'mute_forbidden', f"ミュート権限不足: {user.name} (サーバー: {guild.name})", key=f"mute_forbidden:{guild.id}", guild_id=guild.id)
             except Exception as e:
-                print(f"ミュート処理エラー: {e}")
+                log_event('error', 'mute_error', f"ミュート処理エラー: {e}", key='mute_error', guild_id=guild.id)
         else:
-            # 警告メッセージ
-            try:
-                warning_embed = discord.Embed(
-                    title="⚠️ スパム警告",
-                    description=f"{user.mention} スパム行為が検出されました。\n警告回数: {user_warnings[guild.id][user_id]}/{SPAM_SETTINGS['warning_threshold']}",
-                    color=discord.Color.orange()
-                )
-                warning_embed.add_field(
-                    name="注意事項", 
-                    value="短時間での大量投稿や同じメッセージの繰り返しはスパムとみなされます。", 
-                    inline=False
-                )
-                await message.channel.send(embed=warning_embed, delete_after=10)
-            except Exception as e:
-                print(f"警告メッセージ送信エラー: {e}")
+            # 警告メッセージ（チャンネルごとに集約して送信）
+            queue_moderation_notice(message, 'spam', f"{user_warnings[guild.id][user_id]}/{SPAM_SETTINGS['warning_threshold']}")
                 
     except discord.NotFound:
         pass  # メッセージが既に削除されている
     except Exception as e:
-        print(f"スパム対処エラー: {e}")
+        log_event('error', 'spam_action_error', f"スパム対処エラー: {e}", key='spam_action_error', guild_id=guild.id)
 
 async def handle_banned_word_action(message, banned_word):
     """禁止ワード検出時の対処を実行する関数"""
@@ -231,44 +1423,12 @@ async def handle_banned_word_action(message, banned_word):
             # メッセージを削除
             await message.delete()
             
-            # 警告メッセージを送信
-            embed = discord.Embed(
-                title="🚫 禁止ワード検出",
-                description=f"{message.author.mention} 禁止されたワードが検出されました。",
-                color=discord.Color.red()
-            )
-            embed.add_field(
-                name="対処", 
-                value="メッセージを削除しました。", 
-                inline=False
-            )
-            embed.add_field(
-                name="注意事項", 
-                value="禁止されたワードを含むメッセージは自動的に削除されます。", 
-                inline=False
-            )
-            
-            await message.channel.send(embed=embed, delete_after=10)
+            # 警告メッセージ（チャンネルごとに集約して送信）
+            queue_moderation_notice(message, 'banword_delete')
             
         elif action == 'warn':
-            # 警告のみ（メッセージは削除しない）
-            embed = discord.Embed(
-                title="⚠️ 禁止ワード警告",
-                description=f"{message.author.mention} 禁止されたワードが検出されました。",
-                color=discord.Color.orange()
-            )
-            embed.add_field(
-                name="警告", 
-                value="不適切な言葉の使用は控えてください。", 
-                inline=False
-            )
-            embed.add_field(
-                name="注意事項", 
-                value="今後このような言葉の使用は避けてください。", 
-                inline=False
-            )
-            
-            await message.channel.send(embed=embed, delete_after=15)
+            # 警告のみ（メッセージは削除しない、チャンネルごとに集約して送信）
+            queue_moderation_notice(message, 'banword_warn')
             
         elif action == 'mute':
             # メッセージを削除してユーザーをミュート
@@ -288,24 +1448,8 @@ async def handle_banned_word_action(message, banned_word):
             
             await user.add_roles(mute_role, reason=f"禁止ワード使用のため自動ミュート: {banned_word}")
             
-            # 警告メッセージを送信
-            embed = discord.Embed(
-                title="🔇 禁止ワード検出 - ミュート",
-                description=f"{user.mention} 禁止されたワードの使用によりミュートされました。",
-                color=discord.Color.red()
-            )
-            embed.add_field(
-                name="対処", 
-                value="メッセージを削除し、ユーザーを一時的にミュートしました。", 
-                inline=False
-            )
-            embed.add_field(
-                name="ミュート解除", 
-                value="管理者に解除を依頼するか、一定時間後に自動解除されます。", 
-                inline=False
-            )
-            
-            await message.channel.send(embed=embed, delete_after=20)
+            # 警告メッセージ（チャンネルごとに集約して送信）
+            queue_moderation_notice(message, 'banword_mute')
             
             # 30分後に自動ミュート解除
             async def unmute_after_delay():
@@ -313,49 +1457,1391 @@ async def handle_banned_word_action(message, banned_word):
                 try:
                     await user.remove_roles(mute_role, reason="禁止ワード自動ミュート期間終了")
                 except Exception as e:
-                    print(f"禁止ワード自動ミュート解除エラー: {e}")
+                    log_event('error', 'unmute_error', f"禁止ワード自動ミュート解除エラー: {e}", key='unmute_error')
             
             asyncio.create_task(unmute_after_delay())
         
         # ログ出力
-        print(f"🚫 禁止ワード検出: {banned_word} | 対処: {action} | ユーザー: {message.author} | サーバー: {message.guild.name}")
+        log_event('info', 'banword_hit', f"🚫 禁止ワード検出: {banned_word} | 対処: {action} | ユーザー: {message.author} | サーバー: {message.guild.name}",
+                  key=f"banword_hit:{guild_id}", guild_id=guild_id, user_id=message.author.id, action=action)
         
     except discord.NotFound:
         pass  # メッセージが既に削除されている
     except discord.Forbidden:
-        print(f"禁止ワード対処権限不足: {message.guild.name}")
+        log_event('warning', 'banword_forbidden', f"禁止ワード対処権限不足: {message.guild.name}", key=f"banword_forbidden:{guild_id}", guild_id=guild_id)
     except Exception as e:
-        print(f"禁止ワード対処エラー: {e}")
+        log_event('error', 'banword_action_error', f"禁止ワード対処エラー: {e}", key='banword_action_error', guild_id=guild_id)
+
+# 過負荷時の縮退（イベントループ遅延と処理中のメッセージ数からレベルを決め、段階的に検査を減らす）
+OVERLOAD_SKIP_EXPENSIVE = 1  # 重い検出処理（複数サーバー・類似メッセージ・ルール・シャドーモード）を省略
+OVERLOAD_SAMPLE = 2          # 疑わしくない投稿者のメッセージは一部だけ検査し、残りは連投・禁止ワードのみ
+OVERLOAD_DEFER_FUN = 3       # 遊びコマンドを負荷が下がるまで延期
+OVERLOAD_MINIMAL = 4         # すべてのメッセージで連投・禁止ワードの判定のみ
+OVERLOAD_LEVELS = ("通常", "重い検出処理を省略", "投稿者を抽出して検査", "遊びコマンドを延期", "連投・禁止ワードのみ")
+
+OVERLOAD_SETTINGS = {
+    'lag_thresholds': (0.25, 0.5, 1.0, 2.0),     # レベル1-4に上げるイベントループ遅延（秒）
+    'depth_thresholds': (200, 500, 1000, 2000),  # レベル1-4に上げる処理中のメッセージ数
+    'exit_ratio': 0.5,        # 現在のレベルのしきい値のこの割合を下回ったら下げる候補にする
+    'hold_seconds': 10.0,     # 下回った状態がこの秒数続いたら1段階下げる（上げるのは即時）
+    'sample_rate': 10,        # レベル2以上で、疑わしくない投稿者のメッセージを詳しく検査する割合（1/N）
+    'trusted_seconds': 86400, # 参加からこの秒数以上経ち、警告のないメンバーを疑わしくないとみなす
+    'defer_timeout': 30.0,    # 遊びコマンドを延期する最大秒数（過ぎても過負荷なら実行しない）
+    'max_deferred': 200       # 同時に延期できる遊びコマンドの数
+}
+
+overload_state = {
+    'level': 0,
+    'changed_at': time.monotonic(),
+    'calm_since': None,           # 現在のレベルのしきい値を下回り始めた時刻
+    'inflight': 0,                # モデレーションの検査中の on_message の数（コマンドの実行は含めない）
+    'deferred': 0,                # 延期中の遊びコマンドの数
+    'recovered': asyncio.Event()  # 遊びコマンドを実行できる状態か
+}
+overload_state['recovered'].set()
+overload_stats = {'transitions': 0, 'level_seconds': [0.0] * len(OVERLOAD_LEVELS), 'sampled_out': 0, 'deferred': 0, 'shed': 0}
+
+def set_overload_level(level, lag, depth):
+    now = time.monotonic()
+    previous = overload_state['level']
+    overload_stats['level_seconds'][previous] += now - overload_state['changed_at']
+    overload_stats['transitions'] += 1
+    overload_state['level'] = level
+    overload_state['changed_at'] = now
+    if level >= OVERLOAD_DEFER_FUN:
+        overload_state['recovered'].clear()
+    else:
+        overload_state['recovered'].set()
+    log_event('warning' if level > previous else 'info', 'overload_level',
+              f"🚦 過負荷レベル: {previous} → {level}（{OVERLOAD_LEVELS[level]}）| ループ遅延 {format_duration(lag)} / 処理中 {depth}件",
+              overload_level=level, previous_level=previous, lag=lag, depth=depth)
+
+def update_overload_level(lag):
+    """
+    計測したイベントループ遅延から過負荷レベルを更新する
+    しきい値を超えたら即座に上げ、しきい値の exit_ratio を下回る状態が hold_seconds 続いたら1段階ずつ下げます。
+    """
+    depth = overload_state['inflight']
+    level = overload_state['level']
+    target = 0
+    for index, (lag_limit, depth_limit) in enumerate(zip(OVERLOAD_SETTINGS['lag_thresholds'], OVERLOAD_SETTINGS['depth_thresholds']), 1):
+        if lag >= lag_limit or depth >= depth_limit:
+            target = index
+    
+    if target > level:
+        overload_state['calm_since'] = None
+        set_overload_level(target, lag, depth)
+        return
+    if level == 0:
+        return
+    
+    exit_ratio = OVERLOAD_SETTINGS['exit_ratio']
+    if (lag < OVERLOAD_SETTINGS['lag_thresholds'][level - 1] * exit_ratio
+            and depth < OVERLOAD_SETTINGS['depth_thresholds'][level - 1] * exit_ratio):
+        now = time.monotonic()
+        if overload_state['calm_since'] is None:
+            overload_state['calm_since'] = now
+        elif now - overload_state['calm_since'] >= OVERLOAD_SETTINGS['hold_seconds']:
+            overload_state['calm_since'] = now  # 次の段階を下げるにも同じ時間待つ
+            set_overload_level(level - 1, lag, depth)
+    else:
+        overload_state['calm_since'] = None
+
+def get_message_overload_level(message, level):
+    """過負荷レベルから、このメッセージに適用する縮退レベルを決める"""
+    if level >= OVERLOAD_MINIMAL:
+        return OVERLOAD_MINIMAL
+    if level >= OVERLOAD_SAMPLE and random.random() * OVERLOAD_SETTINGS['sample_rate'] >= 1 and is_trusted_author(message.author):
+        overload_stats['sampled_out'] += 1
+        return OVERLOAD_MINIMAL
+    return OVERLOAD_SKIP_EXPENSIVE
+
+def is_trusted_author(member):
+    """警告がなく、参加から一定時間経ったメンバーか（過負荷時の抽出検査の対象）"""
+    warnings = user_warnings.get(member.guild.id)
+    if warnings and warnings.get(member.id):
+        return False
+    joined_at = getattr(member, 'joined_at', None)
+    return joined_at is not None and (discord.utils.utcnow() - joined_at).total_seconds() >= OVERLOAD_SETTINGS['trusted_seconds']
+
+# モデレーションのパイプライン（検出処理をコストの小さい順に実行し、最初に違反と判定した段階で止める）
+moderation_stages = []                         # 登録された段階（実行順に並べ替え済み）
+moderation_stage_overrides = defaultdict(dict)  # guild_id -> 段階名 -> True/False/'shadow'（未設定なら有効）
+
+def register_moderation_stage(name, detect, act, order, cost, feature=0, metric=None, description="",
+                              describe=None, has_shadow=None, shed_level=None):
+    """
+    検出処理をパイプラインに登録する
+    detect(message, features) は違反なら判定結果（None以外）を返すコルーチン、act(message, verdict) はその対処。
+    cost は1件あたりの目安の処理時間（µs）で、小さい順に実行します（同じなら order の小さい順）。
+    feature を指定した場合は、そのサーバーで機能が有効なときだけ実行します。
+    describe(message, verdict) はシャドーモードで記録する「想定される対処」の説明、
+    has_shadow(guild_id) は段階の中にシャドーモードの項目（ルールなど）があるかを返します。
+    shed_level を指定した場合は、メッセージの縮退レベルがそれ以上のときに省略します。
+    """
+    moderation_stages[:] = [stage for stage in moderation_stages if stage['name'] != name]
+    moderation_stages.append({
+        'name': name,
+        'detect': detect,
+        'act': act,
+        'order': order,
+        'cost': cost,
+        'feature': feature,
+        'metric': metric or name,  # 処理時間を記録するキー（stage:<metric>）
+        'description': description,
+        'describe': describe or (lambda message, verdict: description),
+        'has_shadow': has_shadow,
+        'shed_level': shed_level or len(OVERLOAD_LEVELS)
+    })
+    moderation_stages.sort(key=lambda stage: (stage['cost'], stage['order']))
+
+def get_stage_mode(stage, guild_id, enabled_features):
+    """段階の実行モード（'live' または 'shadow'、実行しない場合はNone）"""
+    if stage['feature'] and not enabled_features & stage['feature']:
+        return None
+    overrides = moderation_stage_overrides.get(guild_id)
+    mode = overrides.get(stage['name'], True) if overrides else True
+    if mode is True:
+        return 'live'
+    return 'shadow' if mode == 'shadow' else None
+
+async def run_moderation_pipeline(message, features, enabled_features):
+    """
+    有効な段階を順に実行し、違反と判定した段階で対処する（対処した場合はTrueを返す）
+    対処した後はシャドーモードの段階・ルールだけを評価します（対処はせず、結果だけを記録）。
+    過負荷時はシャドーモードと shed_level に達した段階を省略します。
+    """
+    guild_id = message.guild.id
+    overload_level = features.overload_level
+    for stage in moderation_stages:
+        mode = get_stage_mode(stage, guild_id, enabled_features)
+        if mode is None or overload_level >= stage['shed_level'] or (overload_level and mode == 'shadow'):
+            continue
+        if features.acted and mode == 'live' and not (stage['has_shadow'] and stage['has_shadow'](guild_id)):
+            continue
+        started_at = time.perf_counter()
+        verdict = await stage['detect'](message, features)
+        elapsed = time.perf_counter() - started_at
+        record_stage_latency(stage['metric'], elapsed)
+        if mode == 'shadow':
+            features.add_shadow_result(stage['name'], None if verdict is None else stage['describe'](message, verdict), elapsed)
+        elif verdict is not None:
+            await stage['act'](message, verdict)
+            features.acted = True
+            if features.acted_stage is None:
+                features.acted_stage = stage['name']
+    if features.shadow_results:
+        record_shadow_results(message, features.shadow_results, features.acted)
+    return features.acted
+
+async def detect_spam(message, features):
+    return True if await is_spam(message, features) else None
+
+async def act_on_spam(message, verdict):
+    await handle_spam_action(message)
+
+async def detect_banned_word(message, features):
+    return await scan_banned_word(message, features)
+
+def describe_banned_word(message, banned_word):
+    action = (banword_data.get(message.guild.id) or create_banword_settings())['action']
+    return f"{action}（{banned_word}）"
+
+register_moderation_stage('spam', detect_spam, act_on_spam, order=10, cost=10,
+                          metric='is_spam', description="大量投稿・連投・複数サーバー・類似メッセージ",
+                          describe=lambda message, verdict: "削除・警告（しきい値でミュート）")
+register_moderation_stage('banword', detect_banned_word, handle_banned_word_action, order=20, cost=20,
+                          feature=FEATURE_BANWORD, metric='contains_banned_word', description="禁止ワード",
+                          describe=describe_banned_word)
+
+# シャドーモード（対処せずに評価だけ行い、一致率・処理時間・既存の検出との重複を記録する）
+SHADOW_SETTINGS = {
+    'retention_minutes': 1440,  # 1分ごとの集計を保持する分数
+    'report_minutes': 60,       # n!antispam shadow report の既定の集計期間（分）
+    'sample_size': 5            # 検出処理ごとに保持する直近の一致例の件数
+}
+
+shadow_stats = defaultdict(dict)  # guild_id -> 検出処理名 -> {'minutes': deque[[分, 評価, 一致, 重複, 合計秒, 最大秒]], 'samples': deque}
+
+def record_shadow_results(message, results, acted):
+    """シャドーモードの評価結果を1分ごとに集計（acted は実際の検出処理がこのメッセージに対処したか）"""
+    guild_stats = shadow_stats[message.guild.id]
+    now = time.time()
+    minute = int(now // 60)
+    for name, action, seconds in results:
+        entry = guild_stats.get(name)
+        if entry is None:
+            entry = guild_stats[name] = {'minutes': deque(maxlen=SHADOW_SETTINGS['retention_minutes']),
+                                         'samples': deque(maxlen=SHADOW_SETTINGS['sample_size'])}
+        buckets = entry['minutes']
+        if not buckets or buckets[-1][0] != minute:
+            buckets.append([minute, 0, 0, 0, 0.0, 0.0])
+        bucket = buckets[-1]
+        bucket[1] += 1
+        bucket[4] += seconds
+        if seconds > bucket[5]:
+            bucket[5] = seconds
+        if action is not None:
+            bucket[2] += 1
+            if acted:
+                bucket[3] += 1
+            entry['samples'].append((now, message.author.id, message.channel.id, action, acted))
+            log_event('debug', 'shadow_hit', f"👻 シャドー一致: {name} | 想定される対処: {action} | ユーザー: {message.author}",
+                      key=f"shadow_hit:{message.guild.id}:{name}", guild_id=message.guild.id, user_id=message.author.id,
+                      detector=name, action=action, overlap=acted)
+
+def summarize_shadow_stats(guild_id, minutes):
+    """直近minutes分の集計を検出処理ごとに返す [(名前, 評価, 一致, 重複, 合計秒, 最大秒, 直近の一致例)]"""
+    since = int(time.time() // 60) - minutes
+    rows = []
+    for name, entry in list(shadow_stats.get(guild_id, {}).items()):
+        evaluated = hits = overlaps = 0
+        total = worst = 0.0
+        for minute, bucket_evaluated, bucket_hits, bucket_overlaps, bucket_total, bucket_worst in list(entry['minutes']):
+            if minute > since:
+                evaluated += bucket_evaluated
+                hits += bucket_hits
+                overlaps += bucket_overlaps
+                total += bucket_total
+                worst = max(worst, bucket_worst)
+        if evaluated:
+            rows.append((name, evaluated, hits, overlaps, total, worst, list(entry['samples'])))
+    return rows
+
+# 宣言的なモデレーションルール（サーバーごとのJSONを判定用の構造にコンパイルし、代入1回で差し替える）
+RULE_SETTINGS = {
+    'directory': os.getenv('RULES_DIR', 'rules'),  # <guild_id>.json を読み込むディレクトリ
+    'max_rules': 50,        # 1サーバーあたりのルール数の上限
+    'max_history': 20,      # 連投・重複の判定に保持する1ユーザーあたりのメッセージ数の上限
+    'max_timeout': 2419200, # タイムアウトの上限（秒、Discordの上限の28日）
+    'max_file_size': 65536  # n!rules set で添付できるファイルの上限（バイト）
+}
+
+# 条件の種類 -> 評価の目安コスト（ルール内ではコストの小さい条件から評価する）
+RULE_CONDITION_COSTS = {
+    'channels': 1, 'mentions': 2, 'account_age': 2, 'duplicates': 3, 'rate': 3, 'link_domains': 5, 'banword': 10
+}
+RULE_ACTIONS = ('delete', 'warn', 'timeout', 'ban', 'log')
+# 対処 -> ルールを設定するユーザーに必要な権限（n!ban などのコマンドと同じ権限がない限り設定できない）
+RULE_ACTION_PERMISSIONS = {'timeout': 'moderate_members', 'ban': 'ban_members'}
+
+guild_rules = {}                   # guild_id -> コンパイル済みのルール
+rule_state = {'files_loaded': False}
+rule_activity = defaultdict(dict)  # guild_id -> user_id -> deque[(時刻, 内容のハッシュ)]（ルールが連投・重複を使う場合のみ）
+
+def parse_rule_condition(name, kind, value):
+    """条件を検証し、ルール間で共有できるよう正規化したタプルにする"""
+    max_history = RULE_SETTINGS['max_history']
+    if kind == 'channels':
+        if not isinstance(value, list) or not value or not all(str(channel_id).isdigit() for channel_id in value):
+            raise ValueError(f"{name}: channels にはチャンネルIDの配列を指定してください")
+        return ('channels', frozenset(int(channel_id) for channel_id in value))
+    if kind in ('mentions', 'account_age'):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise ValueError(f"{name}: {kind} には1以上の整数を指定してください")
+        return (kind, value)
+    if kind == 'duplicates':
+        if not isinstance(value, int) or isinstance(value, bool) or not 2 <= value <= max_history:
+            raise ValueError(f"{name}: duplicates には2-{max_history}の整数を指定してください")
+        return ('duplicates', value)
+    if kind == 'rate':
+        count = value.get('count') if isinstance(value, dict) else None
+        seconds = value.get('seconds') if isinstance(value, dict) else None
+        if (not isinstance(count, int) or isinstance(count, bool) or not 2 <= count <= max_history
+                or not isinstance(seconds, (int, float)) or not 0 < seconds <= 3600):
+            raise ValueError(f"{name}: rate には {{\"count\": 2-{max_history}, \"seconds\": 1-3600}} を指定してください")
+        return ('rate', count, float(seconds))
+    if kind == 'link_domains':
+        if not isinstance(value, list) or not value or not all(isinstance(domain, str) and domain for domain in value):
+            raise ValueError(f"{name}: link_domains にはドメインの配列を指定してください")
+        return ('link_domains', tuple(sorted({domain.lower().lstrip('.') for domain in value})))
+    if kind == 'banword':
+        if value is not True:
+            raise ValueError(f"{name}: banword には true を指定してください")
+        return ('banword',)
+    raise ValueError(f"{name}: 不明な条件です: {kind}（使用可能: {', '.join(RULE_CONDITION_COSTS)}）")
+
+def parse_rule_action(name, action):
+    """対処を検証してタプルにする（"delete" などの文字列、または {"timeout": 秒数}）"""
+    if isinstance(action, str) and action in RULE_ACTIONS and action != 'timeout':
+        return (action,)
+    if isinstance(action, dict) and list(action) == ['timeout']:
+        seconds = action['timeout']
+        if isinstance(seconds, int) and not isinstance(seconds, bool) and 1 <= seconds <= RULE_SETTINGS['max_timeout']:
+            return ('timeout', seconds)
+    raise ValueError(f"{name}: 不明な対処です: {json.dumps(action, ensure_ascii=False)}（使用可能: delete, warn, ban, log, {{\"timeout\": 秒数}}）")
+
+def compile_rules(text, set_by=None):
+    """
+    ルール定義（JSON）を検証し、判定用の構造にコンパイルする（不正な場合は ValueError）
+    同じ条件は複数のルールで共有し、メッセージごとに1回だけ評価します。
+    set_by はルールを設定したユーザーのID（タイムアウト・バンはこのユーザーの権限と階層で実行）。
+    省略した場合は定義中の set_by（共有ストア・ルールファイル）を使い、どちらもなければボットの権限で実行します。
+    """
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSONの形式が正しくありません: {e}")
+    rules = data.get('rules') if isinstance(data, dict) else data
+    if not isinstance(rules, list) or not rules:
+        raise ValueError("rules にルールの配列を指定してください")
+    if len(rules) > RULE_SETTINGS['max_rules']:
+        raise ValueError(f"ルールは{RULE_SETTINGS['max_rules']}件までです")
+    if set_by is None and isinstance(data, dict):
+        set_by = data.get('set_by')
+        if set_by is not None and (not isinstance(set_by, int) or isinstance(set_by, bool)):
+            raise ValueError("set_by にはユーザーIDを指定してください")
+    if set_by is not None:
+        data = dict(data, set_by=set_by) if isinstance(data, dict) else {'rules': rules, 'set_by': set_by}
+    
+    conditions = {}  # 正規化した条件 -> 番号
+    compiled = []
+    history = 0
+    for index, rule in enumerate(rules, 1):
+        if not isinstance(rule, dict):
+            raise ValueError(f"{index}件目のルールがオブジェクトではありません")
+        name = str(rule.get('name') or f"rule{index}")
+        when = rule.get('when')
+        then = rule.get('then')
+        if not isinstance(when, dict) or not when:
+            raise ValueError(f"{name}: when に条件を指定してください")
+        if not isinstance(then, list) or not then:
+            raise ValueError(f"{name}: then に対処の配列を指定してください")
+        
+        costs = {}  # 条件の番号 -> 評価の目安コスト
+        for kind, value in when.items():
+            condition = parse_rule_condition(name, kind, value)
+            costs[conditions.setdefault(condition, len(conditions))] = RULE_CONDITION_COSTS[kind]
+            if kind in ('rate', 'duplicates'):
+                history = max(history, condition[1])
+        shadow = rule.get('shadow', False)
+        if not isinstance(shadow, bool):
+            raise ValueError(f"{name}: shadow には true または false を指定してください")
+        compiled.append({
+            'name': name,
+            'conditions': tuple(sorted(costs, key=costs.get)),
+            'actions': tuple(parse_rule_action(name, action) for action in then),
+            'shadow': shadow  # 対処せず、一致したかだけを記録する
+        })
+    
+    return {
+        'source': json.dumps(data, ensure_ascii=False, sort_keys=True),
+        'conditions': list(conditions),  # 番号順
+        'rules': compiled,
+        'history': history,
+        'shadow': any(rule['shadow'] for rule in compiled),
+        'set_by': set_by,
+        'hits': [0] * len(compiled),
+        'loaded_at': time.time()
+    }
+
+def install_guild_rules(guild_id, ruleset):
+    """コンパイル済みのルールに差し替える（None で削除）。判定中の処理は差し替え前の構造を最後まで使う"""
+    if ruleset is None:
+        guild_rules.pop(guild_id, None)
+        rule_activity.pop(guild_id, None)
+    else:
+        guild_rules[guild_id] = ruleset
+    refresh_guild_features(guild_id)
+
+def load_rule_file(guild_id):
+    """ルールファイル（<directory>/<guild_id>.json）を読み込んで差し替える。ファイルがなければFalse"""
+    path = os.path.join(RULE_SETTINGS['directory'], f"{guild_id}.json")
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r', encoding='utf-8') as f:
+        install_guild_rules(guild_id, compile_rules(f.read()))
+    return True
+
+def load_all_rule_files():
+    """担当サーバーのルールファイルをすべて読み込む（不正なファイルはログに残して読み飛ばす）"""
+    loaded = 0
+    for path in glob.glob(os.path.join(RULE_SETTINGS['directory'], '*.json')):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if not name.isdigit() or not owns_guild(int(name)):
+            continue
+        try:
+            loaded += load_rule_file(int(name))
+        except (OSError, ValueError) as e:
+            log_event('error', 'rules_error', f"ルールファイル読み込みエラー: {path} ({e})", key='rules_error', path=path)
+    return loaded
+
+def evaluate_rule_condition(condition, message, features, history, now):
+    kind = condition[0]
+    if kind == 'channels':
+        return message.channel.id in condition[1]
+    if kind == 'mentions':
+        return features.mention_count >= condition[1]
+    if kind == 'account_age':
+        created_at = getattr(message.author, 'created_at', None)
+        return created_at is not None and now - created_at.timestamp() < condition[1]
+    if kind == 'duplicates':
+        count = condition[1]
+        if len(history) < count:
+            return False
+        fingerprint = features.content_hash
+        return all(history[-offset][1] == fingerprint for offset in range(1, count + 1))
+    if kind == 'rate':
+        count, seconds = condition[1], condition[2]
+        return len(history) >= count and now - history[-count][0] <= seconds
+    if kind == 'link_domains':
+        return any(domain == target or domain.endswith('.' + target)
+                   for domain in features.domains for target in condition[1])
+    return contains_banned_word(message, features)[0]  # banword
+
+async def detect_rule_violation(message, features):
+    """サーバーのルールを順に評価し、最初に一致したルールを返す（条件の評価結果はルール間で共有）"""
+    ruleset = guild_rules.get(message.guild.id)
+    if ruleset is None or get_member_verdict(message.author) & VERDICT_ADMIN:
+        return None
+    
+    now = time.time()
+    history = None
+    if ruleset['history']:
+        users = rule_activity[message.guild.id]
+        history = users.get(message.author.id)
+        if history is None or history.maxlen != ruleset['history']:
+            history = users[message.author.id] = deque(history or (), maxlen=ruleset['history'])
+        history.append((now, features.content_hash))
+    
+    conditions = ruleset['conditions']
+    results = [None] * len(conditions)
+    if not ruleset['shadow']:
+        for index, rule in enumerate(ruleset['rules']):
+            if rule_matches(rule, conditions, results, message, features, history, now):
+                ruleset['hits'][index] += 1
+                return rule
+        return None
+    
+    # シャドールールは他のルール・段階の一致に関係なく評価し、結果だけを記録する
+    matched = None
+    for index, rule in enumerate(ruleset['rules']):
+        if not rule['shadow']:
+            if matched is None and not features.acted and rule_matches(rule, conditions, results, message, features, history, now):
+                ruleset['hits'][index] += 1
+                matched = rule
+            continue
+        started_at = time.perf_counter()
+        hit = rule_matches(rule, conditions, results, message, features, history, now)
+        if hit:
+            ruleset['hits'][index] += 1
+        features.add_shadow_result(f"rule:{rule['name']}", describe_rule(message, rule) if hit else None,
+                                   time.perf_counter() - started_at)
+    return matched
+
+def rule_matches(rule, conditions, results, message, features, history, now):
+    """ルールのすべての条件を満たすか（評価結果は results に記録し、他のルールと共有する）"""
+    for key in rule['conditions']:
+        result = results[key]
+        if result is None:
+            result = results[key] = evaluate_rule_condition(conditions[key], message, features, history, now)
+        if not result:
+            return False
+    return True
+
+def describe_rule(message, rule):
+    actions = ", ".join(f"timeout {action[1]}秒" if action[0] == 'timeout' else action[0] for action in rule['actions'])
+    return f"{rule['name']}: {actions}"
+
+def check_rule_action(guild, member, action):
+    """
+    タイムアウト・バンを実行できるか確認し、できない場合は理由を返す
+    ルールを設定したユーザー（いなければボット）が現在もその権限を持ち、対象より上位である必要があります。
+    """
+    permission = RULE_ACTION_PERMISSIONS.get(action[0])
+    if permission is None:
+        return None
+    ruleset = guild_rules.get(guild.id)
+    set_by = ruleset and ruleset['set_by']
+    actor = guild.get_member(set_by) if set_by else guild.me
+    if actor is None:
+        return "ルールを設定したユーザーがサーバーにいません"
+    if not getattr(actor.guild_permissions, permission):
+        return f"ルールを設定したユーザーに {permission} 権限がありません"
+    return check_ban_hierarchy(guild, actor, member)
+
+async def act_on_rule(message, rule):
+    """一致したルールの対処を順に実行（1つが失敗しても残りは実行する）"""
+    guild = message.guild
+    member = message.author
+    reason = f"ルール違反: {rule['name']}"
+    for action in rule['actions']:
+        try:
+            problem = check_rule_action(guild, member, action)
+            if problem:
+                log_event('warning', 'rule_action_denied', f"ルール対処を実行しません: {action[0]} ({problem}) | ユーザー: {member} | サーバー: {guild.name}",
+                          key=f"rule_action_denied:{guild.id}", guild_id=guild.id, user_id=member.id, rule=rule['name'], action=action[0])
+                continue
+            if action[0] == 'delete':
+                await message.delete()
+                spam_stats[guild.id]['messages_deleted'] += 1
+            elif action[0] == 'warn':
+                user_warnings[guild.id][member.id] += 1
+                spam_stats[guild.id]['warnings_given'] += 1
+                queue_moderation_notice(message, 'rule', rule['name'])
+            elif action[0] == 'timeout':
+                await member.timeout(timedelta(seconds=action[1]), reason=reason)
+                spam_stats[guild.id]['mutes_applied'] += 1
+            elif action[0] == 'ban':
+                await guild.ban(member, reason=reason, delete_message_seconds=0)
+            else:
+                log_event('info', 'rule_hit', f"📜 ルール一致: {rule['name']} | ユーザー: {member} | サーバー: {guild.name}",
+                          key=f"rule_hit:{guild.id}", guild_id=guild.id, user_id=member.id, channel_id=message.channel.id, rule=rule['name'])
+        except discord.NotFound:
+            pass  # メッセージが既に削除されている・メンバーが退出済み
+        except discord.Forbidden:
+            log_event('warning', 'rule_forbidden', f"ルール対処権限不足: {action[0]} (サーバー: {guild.name})", key=f"rule_forbidden:{guild.id}", guild_id=guild.id)
+        except Exception as e:
+            log_event('error', 'rule_action_error', f"ルール対処エラー: {action[0]} ({e})", key='rule_action_error', guild_id=guild.id)
+
+register_moderation_stage('rules', detect_rule_violation, act_on_rule, order=30, cost=15,
+                          feature=FEATURE_RULES, description="サーバーごとのルール", describe=describe_rule,
+                          shed_level=OVERLOAD_SKIP_EXPENSIVE,
+                          has_shadow=lambda guild_id: guild_id in guild_rules and guild_rules[guild_id]['shadow'])
+
+# メトリクス公開設定（Prometheus形式、ループバックのみ）
+METRICS_SETTINGS = {
+    'host': '127.0.0.1',                          # 待ち受けアドレス（外部公開しない）
+    'port': int(os.getenv('METRICS_PORT', '9108')),  # 待ち受けポート（0で無効）
+    'lag_interval': 0.5                           # イベントループ遅延の計測間隔（秒）
+}
+
+# レイテンシヒストグラムの境界（秒）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def create_histogram():
+    return {
+        'buckets': [0] * (len(LATENCY_BUCKETS) + 1),  # 最後の要素は+Inf
+        'sum': 0.0,
+        'count': 0
+    }
+
+stage_latency = defaultdict(create_histogram)    # on_messageの処理段階名 -> ヒストグラム
+command_latency = defaultdict(create_histogram)  # コマンド名 -> ヒストグラム
+command_errors = defaultdict(int)                # コマンド名 -> エラー回数
+event_loop_lag = {'last': 0.0, 'histogram': create_histogram()}
+metrics_state = {'runner': None, 'lag_task': None}
+
+def observe_latency(histogram, seconds):
+    """ヒストグラムに所要時間を記録する"""
+    histogram['buckets'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+
+async def sample_event_loop_lag():
+    """一定間隔でスリープし、予定より遅れた時間をイベントループ遅延として記録"""
+    interval = METRICS_SETTINGS['lag_interval']
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - start - interval)
+        event_loop_lag['last'] = lag
+        observe_latency(event_loop_lag['histogram'], lag)
+        record_perf('loop:lag', lag)
+        update_overload_level(lag)
+        
+        # シャードごとのゲートウェイ遅延（ハートビートの往復時間）
+        for shard_id, state in get_shard_states().items():
+            if state['connected'] and math.isfinite(state['latency']):
+                record_perf(f'shard:{shard_id}', state['latency'])
+
+def get_shard_states():
+    """シャードごとの接続状態を返す"""
+    shards = getattr(bot, 'shards', None)
+    if shards:
+        return {shard_id: {'connected': not shard.is_closed(), 'latency': shard.latency}
+                for shard_id, shard in shards.items()}
+    return {0: {'connected': bot.is_ready() and not bot.is_closed(), 'latency': bot.latency}}
+
+def render_histogram(lines, name, label, histogram):
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram["count"]}')
+    lines.append(f'{name}_sum{{{label}}} {histogram["sum"]}')
+    lines.append(f'{name}_count{{{label}}} {histogram["count"]}')
+
+def render_metrics():
+    """Prometheusのテキスト形式でメトリクスを出力"""
+    lines = []
+    
+    lines.append('# HELP levelcannies_stage_latency_seconds on_messageの処理段階ごとの所要時間')
+    lines.append('# TYPE levelcannies_stage_latency_seconds histogram')
+    for stage, histogram in list(stage_latency.items()):
+        render_histogram(lines, 'levelcannies_stage_latency_seconds', f'stage="{stage}"', histogram)
+    
+    lines.append('# HELP levelcannies_command_latency_seconds コマンドごとの所要時間')
+    lines.append('# TYPE levelcannies_command_latency_seconds histogram')
+    for command_name, histogram in list(command_latency.items()):
+        render_histogram(lines, 'levelcannies_command_latency_seconds', f'command="{command_name}"', histogram)
+    
+    lines.append('# HELP levelcannies_command_errors_total コマンドごとのエラー回数')
+    lines.append('# TYPE levelcannies_command_errors_total counter')
+    for command_name, count in list(command_errors.items()):
+        lines.append(f'levelcannies_command_errors_total{{command="{command_name}"}} {count}')
+    
+    # モデレーション統計は全サーバーの合計を出力
+    totals = defaultdict(int)
+    for stats in list(spam_stats.values()):
+        for key, count in stats.items():
+            totals[key] += count
+    lines.append('# HELP levelcannies_moderation_actions_total スパム対策による処理件数')
+    lines.append('# TYPE levelcannies_moderation_actions_total counter')
+    for key, count in totals.items():
+        lines.append(f'levelcannies_moderation_actions_total{{action="{key}"}} {count}')
+    
+    lines.append('# HELP levelcannies_event_loop_lag_seconds イベントループの遅延')
+    lines.append('# TYPE levelcannies_event_loop_lag_seconds gauge')
+    lines.append(f'levelcannies_event_loop_lag_seconds {event_loop_lag["last"]}')
+    lines.append('# TYPE levelcannies_event_loop_lag_distribution_seconds histogram')
+    render_histogram(lines, 'levelcannies_event_loop_lag_distribution_seconds', 'loop="main"', event_loop_lag['histogram'])
+    
+    lines.append('# HELP levelcannies_gateway_latency_seconds ゲートウェイのハートビート遅延')
+    lines.append('# TYPE levelcannies_gateway_latency_seconds gauge')
+    for shard_id, state in get_shard_states().items():
+        if state['latency'] == state['latency'] and state['latency'] != float('inf'):  # NaN/未接続を除外
+            lines.append(f'levelcannies_gateway_latency_seconds{{shard="{shard_id}"}} {state["latency"]}')
+    
+    lines.append('# HELP levelcannies_guilds 参加しているサーバー数')
+    lines.append('# TYPE levelcannies_guilds gauge')
+    lines.append(f'levelcannies_guilds {len(bot.guilds)}')
+    
+    lines.append('# HELP levelcannies_log_dropped_total キューが満杯で破棄されたログレコード数')
+    lines.append('# TYPE levelcannies_log_dropped_total counter')
+    lines.append(f'levelcannies_log_dropped_total {log_state["dropped"]}')
+    lines.append('# HELP levelcannies_log_suppressed_total 間引かれたログレコード数')
+    lines.append('# TYPE levelcannies_log_suppressed_total counter')
+    lines.append(f'levelcannies_log_suppressed_total {log_state["suppressed"]}')
+    
+    lines.append('# HELP levelcannies_outbound_queue_depth 分類ごとの送信待ちリクエスト数')
+    lines.append('# TYPE levelcannies_outbound_queue_depth gauge')
+    for name, waiting in outbound_queues.items():
+        lines.append(f'levelcannies_outbound_queue_depth{{class="{name}"}} {len(waiting)}')
+    lines.append('# HELP levelcannies_outbound_requests_total 分類ごとの送信リクエスト数')
+    lines.append('# TYPE levelcannies_outbound_requests_total counter')
+    for name, stats in outbound_stats.items():
+        lines.append(f'levelcannies_outbound_requests_total{{class="{name}"}} {stats["requests"]}')
+    lines.append('# HELP levelcannies_outbound_shed_total 過負荷で受け付けなかったコマンド数')
+    lines.append('# TYPE levelcannies_outbound_shed_total counter')
+    for name, stats in outbound_stats.items():
+        lines.append(f'levelcannies_outbound_shed_total{{class="{name}"}} {stats["shed"]}')
+    lines.append('# HELP levelcannies_outbound_wait_seconds 分類ごとの送信待ち時間')
+    lines.append('# TYPE levelcannies_outbound_wait_seconds histogram')
+    for name, stats in outbound_stats.items():
+        render_histogram(lines, 'levelcannies_outbound_wait_seconds', f'class="{name}"', stats['wait'])
+    
+    lines.append('# HELP levelcannies_detector_scans_total 禁止ワードの照合の実行場所ごとの件数（inline: イベントループ上、offloaded: ワーカー）')
+    lines.append('# TYPE levelcannies_detector_scans_total counter')
+    for mode in ('inline', 'offloaded', 'fallback', 'timeout'):
+        lines.append(f'levelcannies_detector_scans_total{{mode="{mode}"}} {offload_stats[mode]}')
+    lines.append('# HELP levelcannies_detector_batches_total ワーカーに送ったバッチ数')
+    lines.append('# TYPE levelcannies_detector_batches_total counter')
+    lines.append(f'levelcannies_detector_batches_total {offload_stats["batches"]}')
+    lines.append('# HELP levelcannies_detector_resent_total ワーカーに照合器がなく、照合器を添えて送り直した項目数')
+    lines.append('# TYPE levelcannies_detector_resent_total counter')
+    lines.append(f'levelcannies_detector_resent_total {offload_stats["resent"]}')
+    
+    lines.append('# HELP levelcannies_overload_level 現在の過負荷レベル（0: 通常 - 4: 連投・禁止ワードのみ）')
+    lines.append('# TYPE levelcannies_overload_level gauge')
+    lines.append(f'levelcannies_overload_level {overload_state["level"]}')
+    lines.append('# HELP levelcannies_overload_level_seconds_total 過負荷レベルごとの滞在時間')
+    lines.append('# TYPE levelcannies_overload_level_seconds_total counter')
+    current = time.monotonic() - overload_state['changed_at']
+    for level, seconds in enumerate(overload_stats['level_seconds']):
+        if level == overload_state['level']:
+            seconds += current
+        lines.append(f'levelcannies_overload_level_seconds_total{{level="{level}"}} {seconds:.3f}')
+    lines.append('# HELP levelcannies_overload_transitions_total 過負荷レベルの変更回数')
+    lines.append('# TYPE levelcannies_overload_transitions_total counter')
+    lines.append(f'levelcannies_overload_transitions_total {overload_stats["transitions"]}')
+    lines.append('# HELP levelcannies_overload_inflight_messages モデレーションの検査中のメッセージ数')
+    lines.append('# TYPE levelcannies_overload_inflight_messages gauge')
+    lines.append(f'levelcannies_overload_inflight_messages {overload_state["inflight"]}')
+    lines.append('# HELP levelcannies_overload_sampled_out_total 過負荷時に抽出されず連投・禁止ワードのみ検査したメッセージ数')
+    lines.append('# TYPE levelcannies_overload_sampled_out_total counter')
+    lines.append(f'levelcannies_overload_sampled_out_total {overload_stats["sampled_out"]}')
+    lines.append('# HELP levelcannies_overload_deferred_total 過負荷で延期した遊びコマンド数')
+    lines.append('# TYPE levelcannies_overload_deferred_total counter')
+    lines.append(f'levelcannies_overload_deferred_total {overload_stats["deferred"]}')
+    lines.append('# HELP levelcannies_overload_shed_total 過負荷が続いたため実行しなかった遊びコマンド数')
+    lines.append('# TYPE levelcannies_overload_shed_total counter')
+    lines.append(f'levelcannies_overload_shed_total {overload_stats["shed"]}')
+    
+    return '\n'.join(lines) + '\n'
+
+async def handle_metrics_request(request):
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+async def handle_health_request(request):
+    """準備完了状態とシャードの接続状態を返す（未接続なら503）"""
+    shards = get_shard_states()
+    ready = bot.is_ready() and all(state['connected'] for state in shards.values())
+    body = {
+        'ready': ready,
+        'guilds': len(bot.guilds),
+        'shards': {str(shard_id): state['connected'] for shard_id, state in shards.items()}
+    }
+    return web.json_response(body, status=200 if ready else 503)
+
+async def start_metrics_server():
+    """メトリクス用HTTPサーバーとイベントループ遅延の計測を開始（1回のみ）"""
+    if metrics_state['lag_task'] is None:
+        metrics_state['lag_task'] = asyncio.create_task(sample_event_loop_lag())
+        start_slow_callback_watchdog()
+    
+    if metrics_state['runner'] is not None or not METRICS_SETTINGS['port']:
+        return
+    
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics_request)
+    app.router.add_get('/health', handle_health_request)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_SETTINGS['host'], METRICS_SETTINGS['port']).start()
+        metrics_state['runner'] = runner
+        log_event('info', 'metrics_started', f"📈 メトリクスを公開しました: http://{METRICS_SETTINGS['host']}:{METRICS_SETTINGS['port']}/metrics")
+    except OSError as e:
+        await runner.cleanup()
+        log_event('error', 'metrics_error', f"メトリクスサーバー起動エラー: {e}")
+
+# パフォーマンス計測設定（n!perf用）
+PERF_SETTINGS = {
+    'bucket_base': 0.00001,       # 最小バケットの上限（秒、10µs）
+    'bucket_growth': 1.25,        # バケット境界の倍率（相対誤差 約12%）
+    'bucket_count': 64,           # バケット数（約13秒まで）
+    'retention_minutes': 60,      # 保持する分数（1分ごとのリングバッファ）
+    'slow_callback_threshold': 0.05,  # 遅いコールバックとみなす実行時間（秒）
+    'slow_callback_log_size': 500     # 保持する遅いコールバックの件数
+}
+
+perf_sketches = {}  # 計測キー -> {'minutes': [...], 'counts': array, 'until': 記録中の分の終わり（時刻）, 'offset': その分の位置}
+slow_callbacks = deque(maxlen=PERF_SETTINGS['slow_callback_log_size'])  # (時刻, 処理名, ループが止まっていた時間)
+# バケットの上限（バケット0は bucket_base 以下、最後のバケットはそれ以上すべて）
+PERF_BUCKET_BOUNDS = tuple(PERF_SETTINGS['bucket_base'] * PERF_SETTINGS['bucket_growth'] ** bucket
+                           for bucket in range(PERF_SETTINGS['bucket_count'] - 1))
+
+def get_perf_sketch(key):
+    sketch = perf_sketches.get(key)
+    if sketch is None:
+        retention = PERF_SETTINGS['retention_minutes']
+        sketch = perf_sketches[key] = {
+            'minutes': [-1] * retention,
+            'counts': array('I', [0]) * (retention * PERF_SETTINGS['bucket_count']),
+            'until': 0.0,
+            'offset': 0
+        }
+    return sketch
+
+def record_perf(key, seconds):
+    """分単位のリングバッファ上の対数バケットに所要時間を記録（HDR形式）"""
+    record_perf_sketch(get_perf_sketch(key), seconds)
+
+def record_perf_sketch(sketch, seconds):
+    now = time.time()
+    if now >= sketch['until']:
+        advance_perf_sketch(sketch, now)
+    sketch['counts'][sketch['offset'] + bisect_left(PERF_BUCKET_BOUNDS, seconds)] += 1
+
+def advance_perf_sketch(sketch, now):
+    """記録する分の位置を求め直す（分が変わったときのみ）。古い分のデータは使い回す前にクリア"""
+    bucket_count = PERF_SETTINGS['bucket_count']
+    minute = int(now // 60)
+    slot = minute % len(sketch['minutes'])
+    offset = slot * bucket_count
+    if sketch['minutes'][slot] != minute:
+        sketch['minutes'][slot] = minute
+        for index in range(offset, offset + bucket_count):
+            sketch['counts'][index] = 0
+    sketch['until'] = (minute + 1) * 60
+    sketch['offset'] = offset
+
+def query_perf(key, minutes, quantiles=(0.5, 0.99)):
+    """直近minutes分の件数と分位点（秒）を返す"""
+    sketch = perf_sketches.get(key)
+    if sketch is None:
+        return 0, [0.0] * len(quantiles)
+    
+    bucket_count = PERF_SETTINGS['bucket_count']
+    current_minute = int(time.time() // 60)
+    merged = [0] * bucket_count
+    for slot, minute in enumerate(sketch['minutes']):
+        if current_minute - minutes < minute <= current_minute:
+            offset = slot * bucket_count
+            for bucket in range(bucket_count):
+                merged[bucket] += sketch['counts'][offset + bucket]
+    
+    total = sum(merged)
+    results = []
+    for quantile in quantiles:
+        target = quantile * total
+        cumulative = 0
+        value = 0.0
+        for bucket, count in enumerate(merged):
+            cumulative += count
+            if count and cumulative >= target:
+                value = PERF_SETTINGS['bucket_base'] * PERF_SETTINGS['bucket_growth'] ** bucket  # バケットの上限
+                break
+        results.append(value)
+    return total, results
+
+stage_recorders = {}  # 処理段階名 -> (ヒストグラム, n!perf のスケッチ)（記録ごとのキーの組み立てと検索を省く）
+
+def record_stage_latency(stage, seconds):
+    """on_messageの処理段階の所要時間を記録"""
+    recorder = stage_recorders.get(stage)
+    if recorder is None:
+        recorder = stage_recorders[stage] = (stage_latency[stage], get_perf_sketch(f"stage:{stage}"))
+    histogram, sketch = recorder
+    histogram['buckets'][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+    
+    # record_perf_sketch と同じ処理（関数呼び出しを省くため展開）
+    now = time.time()
+    if now >= sketch['until']:
+        advance_perf_sketch(sketch, now)
+    sketch['counts'][sketch['offset'] + bisect_left(PERF_BUCKET_BOUNDS, seconds)] += 1
+
+def describe_frame(frame):
+    """イベントループのスレッドで実行中の処理名（このファイルの関数を優先し、なければ最も内側の関数）"""
+    innermost = None
+    while frame is not None:
+        innermost = innermost or frame.f_code.co_qualname
+        if frame.f_code.co_filename == __file__:
+            return frame.f_code.co_qualname
+        frame = frame.f_back
+    return innermost or '不明'
+
+def watch_event_loop(loop, loop_thread_id):
+    """
+    イベントループを止めた処理を記録する監視スレッド
+    一定間隔でループにコールバックを送り、しきい値を過ぎても実行されなければ、その時点でループのスレッドが
+    実行している処理を記録します（ループ上の各コールバックには計測の処理を追加しない）。
+    """
+    threshold = PERF_SETTINGS['slow_callback_threshold']
+    while not loop.is_closed():
+        done = threading.Event()
+        started_at = time.perf_counter()
+        try:
+            loop.call_soon_threadsafe(done.set)
+        except RuntimeError:
+            return  # ループが終了した
+        if not done.wait(threshold):
+            name = describe_frame(sys._current_frames().get(loop_thread_id))
+            while not done.wait(1.0):
+                if loop.is_closed() or not loop.is_running():
+                    return
+            slow_callbacks.append((time.time(), name, time.perf_counter() - started_at))
+        time.sleep(threshold)
+
+def start_slow_callback_watchdog():
+    """監視スレッドを開始（イベントループ上から呼ぶ）"""
+    threading.Thread(target=watch_event_loop, args=(asyncio.get_running_loop(), threading.get_ident()),
+                     name='slow-callback-watchdog', daemon=True).start()
+
+def format_duration(seconds):
+    if seconds >= 1:
+        return f"{seconds:.2f}s"
+    if seconds >= 0.001:
+        return f"{seconds * 1000:.1f}ms"
+    return f"{seconds * 1000000:.0f}µs"
+
+# 送信リクエストの優先度制御（全体・ルートごとの上限に近づいたら、モデレーション → モデレーターへの返信 → 遊びコマンドの順に送信）
+OUTBOUND_SETTINGS = {
+    'global_limit': 50,    # Discordの全体の上限（件/秒）
+    'headroom': 0.8,       # 直近1秒の送信数が上限のこの割合を超えたら優先度順に送信
+    'route_reserve': 1,    # ルートの残り枠がこの件数以下なら優先度順に送信
+    'shed_backlog': 20     # モデレーションの待ちがこの件数以上なら遊びコマンドを受け付けない
+}
+OUTBOUND_CLASSES = ('moderation', 'moderator', 'fun')  # 優先度の高い順
+OUTBOUND_FUN_COMMANDS = {'dice', 'fizzbuzz', 'supurito', 'serverinfo', 'userinfo', 'ping', 'helpbot'}
+
+# 実行中の処理の分類（イベント処理はモデレーション、コマンドは global check で設定。タスクに引き継がれる）
+outbound_class = contextvars.ContextVar('outbound_class', default='moderation')
+outbound_sent = deque()                                       # 直近1秒に送信を開始した時刻
+outbound_queues = {name: deque() for name in OUTBOUND_CLASSES}  # 分類 -> 送信待ちのFuture
+outbound_stats = {name: {'requests': 0, 'queued': 0, 'shed': 0, 'wait': create_histogram()} for name in OUTBOUND_CLASSES}
+outbound_state = {'drainer': None, 'route_info_missing': False}
+
+def outbound_budget_delay(limit):
+    """直近1秒の送信数が limit 未満になるまでの秒数（0なら今すぐ送信できる）"""
+    now = time.monotonic()
+    while outbound_sent and now - outbound_sent[0] >= 1.0:
+        outbound_sent.popleft()
+    if len(outbound_sent) < limit:
+        return 0.0
+    return outbound_sent[len(outbound_sent) - limit] + 1.0 - now
+
+def outbound_route_exhausted(http, route):
+    """
+    discord.py が把握しているルートの残り枠が少ないか（未知のルートは空きありとみなす）
+    discord.py の内部の属性を読むため、バージョンの違いで属性がない場合も空きありとみなします（すべてのAPI呼び出しを止めないため）。
+    """
+    bucket_hashes = getattr(http, '_bucket_hashes', None)
+    buckets = getattr(http, '_buckets', None)
+    if bucket_hashes is None or buckets is None:
+        if not outbound_state['route_info_missing']:
+            outbound_state['route_info_missing'] = True
+            log_event('warning', 'outbound_route_info_missing',
+                      "discord.py のレート制限の情報を参照できないため、ルートごとの残り枠を考慮せずに送信します")
+        return False
+    ratelimit = buckets.get(f"{bucket_hashes.get(route.key) or route.key}:{route.major_parameters}")
+    return (ratelimit is not None and not ratelimit.is_expired()
+            and ratelimit.remaining <= OUTBOUND_SETTINGS['route_reserve'])
+
+def outbound_moderation_backlog():
+    return len(outbound_queues['moderation']) + len(outbound_queues['moderator'])
+
+async def drain_outbound_queues():
+    """全体の上限の範囲で、優先度の高い分類から順に送信待ちを解放する"""
+    while any(outbound_queues.values()):
+        delay = outbound_budget_delay(OUTBOUND_SETTINGS['global_limit'])
+        if delay > 0:
+            await asyncio.sleep(delay)
+            continue
+        for name in OUTBOUND_CLASSES:
+            waiting = outbound_queues[name]
+            while waiting and waiting[0].done():
+                waiting.popleft()  # キャンセル済み
+            if waiting:
+                outbound_sent.append(time.monotonic())
+                waiting.popleft().set_result(None)
+                break
+        await asyncio.sleep(0)
+    outbound_state['drainer'] = None
+
+async def acquire_outbound_slot(http, route):
+    """送信の順番を待つ。余裕があればすぐに送信し、上限に近い場合は優先度順の待ち行列に入る"""
+    name = outbound_class.get()
+    stats = outbound_stats[name]
+    stats['requests'] += 1
+    
+    limit = int(OUTBOUND_SETTINGS['global_limit'] * OUTBOUND_SETTINGS['headroom'])
+    if (not any(outbound_queues.values()) and outbound_budget_delay(limit) == 0
+            and not outbound_route_exhausted(http, route)):
+        outbound_sent.append(time.monotonic())
+        observe_latency(stats['wait'], 0.0)
+        record_perf(f'outbound:{name}', 0.0)
+        return
+    
+    stats['queued'] += 1
+    future = asyncio.get_running_loop().create_future()
+    outbound_queues[name].append(future)
+    if outbound_state['drainer'] is None:
+        outbound_state['drainer'] = asyncio.create_task(drain_outbound_queues())
+    started_at = time.perf_counter()
+    await future
+    waited = time.perf_counter() - started_at
+    observe_latency(stats['wait'], waited)
+    record_perf(f'outbound:{name}', waited)
+
+def install_outbound_scheduler(http):
+    """HTTPClient.request を差し替え、すべてのAPI呼び出しを送信スケジューラ経由にする（1回のみ）"""
+    if getattr(http, 'outbound_original_request', None):
+        return
+    original_request = http.request
+    
+    async def scheduled_request(route, **kwargs):
+        await acquire_outbound_slot(http, route)
+        return await original_request(route, **kwargs)
+    
+    http.outbound_original_request = original_request
+    http.request = scheduled_request
+
+install_outbound_scheduler(bot.http)
+
+@bot.check
+async def classify_outbound_requests(ctx):
+    """コマンドの送信リクエストを分類し、モデレーションの待ちが多いときは遊びコマンドを受け付けない"""
+    if ctx.command is None or ctx.invoked_with != ctx.command.name:
+        return True  # n!help の一覧表示などの確認では何もしない
+    name = 'fun' if ctx.command.name in OUTBOUND_FUN_COMMANDS else 'moderator'
+    outbound_class.set(name)
+    if name == 'fun' and outbound_moderation_backlog() >= OUTBOUND_SETTINGS['shed_backlog']:
+        outbound_stats['fun']['shed'] += 1
+        ctx.outbound_shed = True
+        return False
+    if name == 'fun' and not overload_state['recovered'].is_set():
+        return await defer_fun_command(ctx)
+    return True
+
+async def defer_fun_command(ctx):
+    """過負荷の間は遊びコマンドを延期し、負荷が下がらないまま時間が過ぎたら実行しない"""
+    if overload_state['deferred'] < OVERLOAD_SETTINGS['max_deferred']:
+        overload_state['deferred'] += 1
+        overload_stats['deferred'] += 1
+        try:
+            await asyncio.wait_for(overload_state['recovered'].wait(), OVERLOAD_SETTINGS['defer_timeout'])
+            return True
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            overload_state['deferred'] -= 1
+    overload_stats['shed'] += 1
+    outbound_stats['fun']['shed'] += 1
+    ctx.outbound_shed = True
+    return False
+
+# 遊びコマンドのクールダウン（トークンバケット: rate回まで続けて使え、per秒でrate回分回復）
+COOLDOWN_DEFAULTS = {
+    'dice': {'scope': 'user', 'rate': 5, 'per': 10.0},
+    'fizzbuzz': {'scope': 'user', 'rate': 5, 'per': 10.0},
+    'supurito': {'scope': 'user', 'rate': 2, 'per': 30.0},
+    'serverinfo': {'scope': 'channel', 'rate': 2, 'per': 30.0},
+    'userinfo': {'scope': 'user', 'rate': 3, 'per': 30.0}
+}
+COOLDOWN_SCOPES = {'user': "ユーザー", 'channel': "チャンネル", 'guild': "サーバー"}
+COOLDOWN_SETTINGS = {
+    'sweep_interval': 60.0,   # 満タンに戻ったバケットを回収する間隔（秒）
+    'notice_interval': 5.0    # クールダウン中の返信を送る最小間隔（チャンネルごと、秒）
+}
+cooldown_data = defaultdict(dict)  # guild_id -> コマンド名 -> 上書き設定（rate 0 でクールダウンなし）
+
+# バケット本体はフラットな配列に持ち、(コマンド名, スコープID) からスロット番号を引く
+cooldown_slots = {}             # (コマンド名, サーバーID, スコープID) -> スロット番号
+cooldown_tokens = array('d')    # スロット -> 残りトークン
+cooldown_updated = array('d')   # スロット -> 最後に更新した時刻
+cooldown_full_at = array('d')   # スロット -> 満タンに戻る時刻（過ぎたら回収できる）
+cooldown_free = []              # 回収済みの空きスロット
+cooldown_state = {'swept_at': 0.0, 'limited': 0}
+cooldown_notice_at = {}         # channel_id -> 最後にクールダウン中の返信をした時刻
+
+def get_cooldown(guild_id, command_name):
+    """サーバーの設定を反映したクールダウン設定（クールダウンなしなら None）"""
+    settings = COOLDOWN_DEFAULTS.get(command_name)
+    overrides = cooldown_data.get(guild_id)
+    if overrides and command_name in overrides:
+        settings = overrides[command_name]
+    return settings if settings and settings['rate'] else None
+
+def sweep_cooldowns(now):
+    """満タンに戻ったバケットを回収する（満タンのバケットは存在しないのと同じ）"""
+    cooldown_state['swept_at'] = now
+    expired = [key for key, slot in cooldown_slots.items() if cooldown_full_at[slot] <= now]
+    for key in expired:
+        cooldown_free.append(cooldown_slots.pop(key))
+
+def take_cooldown_token(key, rate, per, now):
+    """トークンを1つ使う。足りなければ次の1回分が回復するまでの秒数を返す（0.0 なら実行できる）"""
+    if now - cooldown_state['swept_at'] >= COOLDOWN_SETTINGS['sweep_interval']:
+        sweep_cooldowns(now)
+    
+    slot = cooldown_slots.get(key)
+    if slot is None or cooldown_full_at[slot] <= now:
+        tokens = float(rate)
+    else:
+        tokens = min(rate, cooldown_tokens[slot] + (now - cooldown_updated[slot]) * rate / per)
+    if tokens < 1.0:
+        return (1.0 - tokens) * per / rate
+    tokens -= 1.0
+    
+    if slot is None:
+        if cooldown_free:
+            slot = cooldown_free.pop()
+        else:
+            slot = len(cooldown_tokens)
+            cooldown_tokens.append(0.0)
+            cooldown_updated.append(0.0)
+            cooldown_full_at.append(0.0)
+        cooldown_slots[key] = slot
+    cooldown_tokens[slot] = tokens
+    cooldown_updated[slot] = now
+    cooldown_full_at[slot] = now + (rate - tokens) * per / rate
+    return 0.0
+
+@bot.check
+async def check_command_cooldown(ctx):
+    """遊びコマンドのクールダウン（コマンドの処理を始める前に確認）"""
+    if ctx.command is None or ctx.invoked_with != ctx.command.name:
+        return True  # n!help の一覧表示などの確認では消費しない
+    guild_id = ctx.guild.id if ctx.guild else 0
+    settings = get_cooldown(guild_id, ctx.command.name)
+    if settings is None:
+        return True
+    
+    # rate・per はサーバーごとに上書きできるため、ユーザー・チャンネル単位でもサーバーごとに別の枠にする
+    scope_ids = {'user': ctx.author.id, 'channel': ctx.channel.id, 'guild': guild_id or ctx.channel.id}
+    retry_after = take_cooldown_token((ctx.command.name, guild_id, scope_ids[settings['scope']]),
+                                      settings['rate'], settings['per'], time.monotonic())
+    if retry_after:
+        cooldown_state['limited'] += 1
+        ctx.cooldown_retry_after = retry_after
+        return False
+    return True
+
+def should_send_cooldown_notice(channel_id):
+    """クールダウン中の返信はチャンネルごとに notice_interval 秒に1回まで"""
+    now = time.monotonic()
+    if now - cooldown_notice_at.get(channel_id, -math.inf) < COOLDOWN_SETTINGS['notice_interval']:
+        return False
+    if len(cooldown_notice_at) >= 10000:
+        for key in [key for key, sent_at in cooldown_notice_at.items() if now - sent_at >= COOLDOWN_SETTINGS['notice_interval']]:
+            del cooldown_notice_at[key]
+    cooldown_notice_at[channel_id] = now
+    return True
+
+@bot.before_invoke
+async def record_command_start(ctx):
+    ctx.metrics_started_at = time.perf_counter()
+
+@bot.after_invoke
+async def record_command_finish(ctx):
+    started_at = getattr(ctx, 'metrics_started_at', None)
+    if started_at is not None and ctx.command:
+        elapsed = time.perf_counter() - started_at
+        observe_latency(command_latency[ctx.command.qualified_name], elapsed)
+        record_perf(f"command:{ctx.command.qualified_name}", elapsed)
+    
+    # ホワイトリストの変更はメンバーごとの判定結果に影響する
+    if ctx.guild and ctx.command and ctx.command.name == 'whitelist':
+        invalidate_member_verdicts(ctx.guild.id)
+    
+    # 機能の有効/無効を変更しうるコマンドの後は、ビットマスクを再計算する
+    if ctx.guild and ctx.command and ctx.command.name in ('whitelist', 'banword', 'raidguard'):
+        refresh_guild_features(ctx.guild.id)
+    
+    # 禁止ワードの変更後は照合器を作り直す（ワーカーにはバージョンが変わったことで伝わる）
+    if ctx.guild and ctx.command and ctx.command.name == 'banword':
+        invalidate_banword_matcher(ctx.guild.id)
+    
+    # 設定を変更しうるコマンドの後は、変更があれば共有ストアに書き込む
+    kind = ctx.command and SHARED_CONFIG_COMMANDS.get(ctx.command.name)
+    if kind and ctx.guild and shared_state['db'] is not None:
+        try:
+            await publish_config(0 if kind == 'spam_settings' else ctx.guild.id, kind)
+        except sqlite3.Error as e:
+            log_event('error', 'shared_state_error', f"共有ストア書き込みエラー: {e}", key='shared_state_error')
+
+# メモリ使用量の計測対象（n!memory と benchmarks/bench_memory.py 用）
+MEMORY_STRUCTURES = (
+    'user_message_history', 'user_last_messages', 'user_warnings', 'spam_stats',
+    'whitelist_data', 'banword_data', 'join_trackers', 'raid_guard_data',
+    'fingerprint_sketch', 'near_duplicate_index', 'notice_sent_at', 'signature_cache', 'perf_sketches',
+    'cooldown_slots', 'cooldown_tokens', 'banword_matchers', 'member_verdicts', 'guild_features', 'rule_activity', 'shadow_stats'
+)
+
+async def measure_state_memory(names=MEMORY_STRUCTURES, yield_every=10000):
+    """
+    構造体ごとに、そこから辿れるオブジェクトの sys.getsizeof の合計（バイト）を返す
+    複数の構造体から参照されるオブジェクトは最初に辿った構造体にだけ数えます。
+    大きな状態でもイベントループを止めないよう、yield_every個ごとに制御を返します。
+    """
+    seen = set()
+    results = {}
+    visited = 0
+    for name in names:
+        total = 0
+        stack = [globals()[name]]
+        while stack:
+            obj = stack.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            total += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+                stack.extend(obj)
+            
+            visited += 1
+            if visited % yield_every == 0:
+                await asyncio.sleep(0)
+        results[name] = total
+    return results
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.2f}GB"
+
+# メッセージトレース記録設定（リプレイによるオフライン検証用）
+TRACE_SETTINGS = {
+    'directory': 'traces',                      # トレースファイルの保存先
+    'content_mode': 'hash',                     # 'hash': 単語（空白区切り）ごとに同じ長さの匿名トークンへ置換, 'length': 長さのみ保持
+    'salt': os.getenv('TRACE_SALT', '').encode() or os.urandom(16),  # 匿名化用の鍵（ファイルには書き込まない）
+    'flush_interval': 500,                      # 何件ごとにファイルへ書き出すか
+    'token_cache_size': 50000                   # 匿名化済みトークンのキャッシュ数
+}
+
+trace_recorder = {'file': None, 'path': None, 'records': 0, 'pending': 0, 'started_at': 0.0}
+scrubbed_tokens = {}  # 元の単語 -> 匿名化済みトークン
+
+def scrub_token(token, salt):
+    """単語を同じ長さの匿名トークンに変換（同じ単語は同じトークンになる）"""
+    letters = []
+    counter = 0
+    while len(letters) < len(token):
+        digest = hashlib.blake2b(token.encode(), key=salt, digest_size=64, person=counter.to_bytes(16, 'little')).digest()
+        letters.extend(chr(97 + byte % 26) for byte in digest)
+        counter += 1
+    return ''.join(letters[:len(token)])
+
+def scrub_text(text, salt=None, mode=None):
+    """プライバシー保護のためメッセージ内容を匿名化（コマンド名は保持）"""
+    mode = mode or TRACE_SETTINGS['content_mode']
+    if mode == 'length':
+        return 'x' * len(text)
+    
+    # 既定の鍵で匿名化する場合のみキャッシュを使う
+    cache = scrubbed_tokens if salt is None else {}
+    salt = salt or TRACE_SETTINGS['salt']
+    scrubbed = []
+    for index, token in enumerate(text.split(' ')):
+        if index == 0 and token.startswith(bot.command_prefix):
+            scrubbed.append(token)  # コマンド名は匿名化しない
+            continue
+        result = cache.get(token)
+        if result is None:
+            result = scrub_token(token, salt)
+            if len(cache) >= TRACE_SETTINGS['token_cache_size']:
+                cache.clear()
+            cache[token] = result
+        scrubbed.append(result)
+    return ' '.join(scrubbed)
+
+def write_trace_record(record):
+    trace_recorder['file'].write(json.dumps(record, ensure_ascii=False) + '\n')
+    trace_recorder['records'] += 1
+    trace_recorder['pending'] += 1
+    if trace_recorder['pending'] >= TRACE_SETTINGS['flush_interval']:
+        trace_recorder['file'].flush()
+        trace_recorder['pending'] = 0
+
+def start_trace_recording():
+    """トレースの記録を開始し、各サーバーの匿名化済み設定をヘッダーとして書き込む"""
+    os.makedirs(TRACE_SETTINGS['directory'], exist_ok=True)
+    path = os.path.join(TRACE_SETTINGS['directory'], f"trace-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+    trace_recorder.update({'file': open(path, 'w', encoding='utf-8'), 'path': path, 'records': 0, 'pending': 0, 'started_at': time.time()})
+    
+    banwords = {}
+    for guild_id, settings in list(banword_data.items()):
+        if settings['words']:
+            banwords[str(guild_id)] = {
+                'enabled': settings['enabled'],
+                'action': settings['action'],
+                'words': [scrub_text(word if settings['case_sensitive'] else word.lower()) for word in settings['words']
+                          if not detector_worker.is_pattern_entry(word)]  # パターンは匿名化できないため記録しない
+            }
+    write_trace_record({
+        'type': 'header',
+        'content_mode': TRACE_SETTINGS['content_mode'],
+        'spam_settings': SPAM_SETTINGS,
+        'banwords': banwords
+    })
+    return path
+
+def stop_trace_recording():
+    """トレースの記録を終了し、記録件数を返す"""
+    if trace_recorder['file']:
+        trace_recorder['file'].close()
+    records = trace_recorder['records']
+    trace_recorder.update({'file': None, 'records': 0, 'pending': 0})
+    return records
+
+def record_trace_event(message, features):
+    """メッセージイベントを匿名化してトレースに記録"""
+    author = message.author
+    permissions = getattr(author, 'guild_permissions', None)
+    write_trace_record({
+        'type': 'message',
+        't': message.created_at.timestamp() if message.created_at else time.time(),
+        'g': message.guild.id if message.guild else None,
+        'c': message.channel.id,
+        'a': author.id,
+        'bot': author.bot,
+        'admin': bool(permissions and permissions.administrator),
+        'text': scrub_text(features.lowered),
+        'v': features.acted_stage  # 記録時に対処した段階（リプレイの判定と比べるため）
+    })
 
 @bot.event
 async def on_message(message):
     """メッセージ受信時のイベント"""
+    # 検出処理が共通で使う特徴量（必要になった値だけ計算される）
+    features = MessageFeatures(message.content)
+    
+    # 過負荷の判定に使う処理中の数はモデレーションの検査だけを数える
+    # （確認待ちやAPIの送信枠待ちのコマンドで過負荷と判定しないため）
+    overload_state['inflight'] += 1
+    try:
+        acted = await moderate_message(message, features)
+    finally:
+        overload_state['inflight'] -= 1
+    
+    # トレース記録（有効な場合のみ。リプレイと比べられるように、このメッセージに対処した段階も記録する）
+    if trace_recorder['file']:
+        record_trace_event(message, features)
+    
+    # 通常のコマンド処理（違反があった場合はスキップ）
+    if not acted:
+        started_at = time.perf_counter()
+        await bot.process_commands(message)
+        record_stage_latency('process_commands', time.perf_counter() - started_at)
+
+async def moderate_message(message, features):
+    """モデレーションの検査と対処を行い、違反に対処したか（コマンド処理をスキップするか）を返す"""
     # ボットメッセージは無視
     if message.author.bot:
-        await bot.process_commands(message)
-        return
+        return False
+    
+    # 有効な機能がないサーバー（大半）は設定を引かずにコマンド処理へ
+    enabled_features = guild_features.get(message.guild.id, 0) if message.guild else 0
+    if not enabled_features and not SPAM_SETTINGS['enabled']:
+        return False
     
-    # スパム検出
-    if message.guild and await is_spam(message):
-        await handle_spam_action(message)
-        return  # スパムの場合はコマンド処理をスキップ
+    # ホワイトリストのメンバーはモデレーションを省略
+    if enabled_features & FEATURE_WHITELIST and get_member_verdict(message.author) & VERDICT_BYPASS:
+        return False
     
-    # 禁止ワード検出
-    if message.guild:
-        contains_banned, banned_word = contains_banned_word(message)
-        if contains_banned:
-            await handle_banned_word_action(message, banned_word)
-            return  # 禁止ワードの場合はコマンド処理をスキップ
+    # 過負荷時は検査を減らす
+    if overload_state['level'] and message.guild:
+        features.overload_level = get_message_overload_level(message, overload_state['level'])
     
-    # 通常のコマンド処理
-    await bot.process_commands(message)
+    # スパム・禁止ワードなどの検出
+    return bool(message.guild) and await run_moderation_pipeline(message, features, enabled_features)
 
 @bot.event
 async def on_ready():
     if bot.user:
-        print(f'{bot.user} としてログインしました！')
-        print(f'Bot ID: {bot.user.id}')
-    print('ボットが準備完了です！')
+        log_event('info', 'login', f'{bot.user} としてログインしました！', bot_id=bot.user.id)
+    log_event('info', 'ready', 'ボットが準備完了です！')
+    
+    # ルールファイルを読み込む（初回のみ。共有ストアの設定のほうが新しいため先に読み込む）
+    if not rule_state['files_loaded']:
+        rule_state['files_loaded'] = True
+        loaded = load_all_rule_files()
+        if loaded:
+            log_event('info', 'rules_loaded', f"📜 ルールファイルを読み込みました: {loaded} 件", count=loaded)
+    
+    # クラスタの共有ストアに接続（cluster.py から起動された場合のみ）
+    await start_shared_state()
+    
+    # メトリクスサーバーを開始
+    await start_metrics_server()
+    
+    # 重い検出処理のワーカープロセスを起動（DETECTOR_WORKERS が設定されている場合のみ）
+    start_detector_pool()
+    
+    # 中断された一括バンジョブを再開
+    await resume_mass_ban_jobs()
+    
+    # 単一接続の場合、2回目以降の on_ready はセッションの再作成（シャード0の再接続）
+    if bot.shard_count is None:
+        if 0 in ready_shards:
+            await rehydrate_shard(0)
+        ready_shards.add(0)
+
+@bot.event
+async def on_shard_ready(shard_id):
+    """シャードの準備完了時のイベント（AutoShardedBotのみ）"""
+    if shard_id in ready_shards:
+        await rehydrate_shard(shard_id)
+    ready_shards.add(shard_id)
 
 @bot.event
 async def on_guild_join(guild):
@@ -367,17 +2853,16 @@ async def on_guild_join(guild):
             try:
                 bot_member = await guild.fetch_member(bot.user.id)
             except discord.NotFound:
-                print(f"❌ サーバー '{guild.name}' でボット自身が見つかりませんでした")
+                log_event('error', 'guild_join_error', f"❌ サーバー '{guild.name}' でボット自身が見つかりませんでした", guild_id=guild.id)
                 return
         
         if not bot_member:
-            print(f"❌ サーバー '{guild.name}' でボット情報を取得できませんでした")
+            log_event('error', 'guild_join_error', f"❌ サーバー '{guild.name}' でボット情報を取得できませんでした", guild_id=guild.id)
             return
         
         # 必要な権限をチェック
         if not bot_member.guild_permissions.manage_roles:
-            print(f"❌ サーバー '{guild.name}' でロール管理権限がありません")
-            print(f"管理者にロール管理権限の付与を依頼してください")
+            log_event('warning', 'guild_join_forbidden', f"❌ サーバー '{guild.name}' でロール管理権限がありません（管理者にロール管理権限の付与を依頼してください）", guild_id=guild.id)
             return
         
         # 既存のロールをチェック
@@ -386,16 +2871,15 @@ async def on_guild_join(guild):
         if existing_role:
             # 既存ロールの階層をチェック
             if existing_role >= bot_member.top_role:
-                print(f"❌ サーバー '{guild.name}' でロール '{ROLE_NAME}' はボットより上位にあります")
-                print(f"管理者にボットのロールを '{ROLE_NAME}' より上に移動してもらってください")
+                log_event('warning', 'guild_join_role_hierarchy', f"❌ サーバー '{guild.name}' でロール '{ROLE_NAME}' はボットより上位にあります（管理者にボットのロールを '{ROLE_NAME}' より上に移動してもらってください）", guild_id=guild.id)
                 return
             
             # 既存のロールがある場合は付与
             if existing_role not in bot_member.roles:
                 await bot_member.add_roles(existing_role, reason="ボット参加時の自動ロール付与")
-                print(f"✅ サーバー '{guild.name}' で既存のロール '{ROLE_NAME}' を付与しました")
+                log_event('info', 'guild_join_role', f"✅ サーバー '{guild.name}' で既存のロール '{ROLE_NAME}' を付与しました", guild_id=guild.id)
             else:
-                print(f"✅ サーバー '{guild.name}' でロール '{ROLE_NAME}' は既に付与済みです")
+                log_event('info', 'guild_join_role', f"✅ サーバー '{guild.name}' でロール '{ROLE_NAME}' は既に付与済みです", guild_id=guild.id)
         else:
             # ロールが存在しない場合は作成して付与
             try:
@@ -410,20 +2894,20 @@ async def on_guild_join(guild):
                     try:
                         await new_role.edit(position=max(1, bot_member.top_role.position - 1))
                     except discord.HTTPException:
-                        print(f"⚠️ サーバー '{guild.name}' でロール位置の調整に失敗しました")
+                        log_event('warning', 'guild_join_role_position', f"⚠️ サーバー '{guild.name}' でロール位置の調整に失敗しました", guild_id=guild.id)
                 
                 await bot_member.add_roles(new_role, reason="ボット参加時の自動ロール付与")
-                print(f"✅ サーバー '{guild.name}' でロール '{ROLE_NAME}' を作成・付与しました")
+                log_event('info', 'guild_join_role', f"✅ サーバー '{guild.name}' でロール '{ROLE_NAME}' を作成・付与しました", guild_id=guild.id)
                 
             except discord.Forbidden:
-                print(f"❌ サーバー '{guild.name}' でロール作成権限が不足しています")
+                log_event('warning', 'guild_join_forbidden', f"❌ サーバー '{guild.name}' でロール作成権限が不足しています", guild_id=guild.id)
             except discord.HTTPException as e:
-                print(f"❌ サーバー '{guild.name}' でロール作成中にHTTPエラー: {e}")
+                log_event('error', 'guild_join_error', f"❌ サーバー '{guild.name}' でロール作成中にHTTPエラー: {e}", guild_id=guild.id)
                 
     except discord.Forbidden:
-        print(f"❌ サーバー '{guild.name}' で権限が不足しています")
+        log_event('warning', 'guild_join_forbidden', f"❌ サーバー '{guild.name}' で権限が不足しています", guild_id=guild.id)
     except Exception as e:
-        print(f"❌ サーバー '{guild.name}' 参加時に予期しないエラーが発生: {type(e).__name__}: {e}")
+        log_event('error', 'guild_join_error', f"❌ サーバー '{guild.name}' 参加時に予期しないエラーが発生: {type(e).__name__}: {e}", guild_id=guild.id)
 
 @bot.event
 async def on_guild_remove(guild):
@@ -431,16 +2915,289 @@ async def on_guild_remove(guild):
     try:
         # ロールを削除（ボットが退出しているので直接削除はできないが、
         # 他のボットや管理者によって削除される可能性を考慮してログ出力）
-        print(f"🚪 サーバー '{guild.name}' から退出しました")
-        print(f"注意: ロール '{ROLE_NAME}' が残っている場合は手動で削除してください")
+        log_event('info', 'guild_remove', f"🚪 サーバー '{guild.name}' から退出しました（ロール '{ROLE_NAME}' が残っている場合は手動で削除してください）", guild_id=guild.id)
+        drop_guild_state(guild.id)
         
     except Exception as e:
-        print(f"❌ サーバー '{guild.name}' 退出時にエラーが発生: {e}")
+        log_event('error', 'guild_remove_error', f"❌ サーバー '{guild.name}' 退出時にエラーが発生: {e}", guild_id=guild.id)
+
+async def start_raid_lockdown(guild):
+    """参加レイド検出時にサーバーをロックダウンする"""
+    settings = raid_guard_data[guild.id]
+    lockdown = {
+        'until': time.time() + JOIN_RAID_SETTINGS['lockdown_duration'],
+        'previous_verification': None,
+        'invites_paused': False,
+        'task': None
+    }
+    raid_lockdowns[guild.id] = lockdown
+    
+    try:
+        # 認証レベルを引き上げる
+        if settings['verification'] and guild.verification_level < discord.VerificationLevel.high:
+            lockdown['previous_verification'] = guild.verification_level
+            await guild.edit(verification_level=discord.VerificationLevel.high, reason="参加レイド検出によるロックダウン")
+        
+        # 招待を一時停止する
+        if settings['pause_invites'] and not guild.invites_paused():
+            await guild.edit(invites_disabled=True, reason="参加レイド検出によるロックダウン")
+            lockdown['invites_paused'] = True
+    except discord.Forbidden:
+        log_event('warning', 'raid_lockdown_forbidden', f"ロックダウン権限不足: {guild.name}", guild_id=guild.id)
+    except discord.HTTPException as e:
+        log_event('error', 'raid_lockdown_error', f"ロックダウンエラー: {e}", guild_id=guild.id)
+    
+    # バースト中に参加したメンバーをさかのぼってタイムアウト
+    if settings['timeout']:
+        window_start = time.time() - JOIN_RAID_SETTINGS['window_seconds']
+        for joined_at, user_id in list(join_trackers[guild.id]['recent']):
+            member = guild.get_member(user_id)
+            if member and joined_at >= window_start:
+                await timeout_raid_member(member)
+    
+    log_event('warning', 'raid_lockdown', f"🚨 参加レイド検出: サーバー '{guild.name}' をロックダウンしました（{JOIN_RAID_SETTINGS['lockdown_duration']}秒）", guild_id=guild.id)
+    lockdown['task'] = asyncio.create_task(end_raid_lockdown_after_delay(guild))
+
+async def end_raid_lockdown(guild):
+    """ロックダウンを解除し、変更した設定を元に戻す"""
+    lockdown = raid_lockdowns.pop(guild.id, None)
+    if not lockdown:
+        return
+    
+    try:
+        if lockdown['previous_verification'] is not None:
+            await guild.edit(verification_level=lockdown['previous_verification'], reason="参加レイドロックダウン終了")
+        if lockdown['invites_paused']:
+            await guild.edit(invites_disabled=False, reason="参加レイドロックダウン終了")
+        log_event('info', 'raid_lockdown_end', f"🔓 参加レイドロックダウン解除: サーバー '{guild.name}'", guild_id=guild.id)
+    except discord.HTTPException as e:
+        log_event('error', 'raid_lockdown_error', f"ロックダウン解除エラー: {e}", guild_id=guild.id)
+
+async def end_raid_lockdown_after_delay(guild):
+    await asyncio.sleep(JOIN_RAID_SETTINGS['lockdown_duration'])
+    await end_raid_lockdown(guild)
+
+async def timeout_raid_member(member):
+    """バースト中の参加者をタイムアウトする"""
+    try:
+        await member.timeout(
+            discord.utils.utcnow() + timedelta(seconds=JOIN_RAID_SETTINGS['timeout_duration']),
+            reason="参加レイド検出による自動タイムアウト"
+        )
+    except discord.HTTPException as e:
+        log_event('error', 'raid_timeout_error', f"参加レイドタイムアウトエラー: {member} ({e})", key=f"raid_timeout_error:{member.guild.id}", guild_id=member.guild.id)
+
+@bot.event
+async def on_member_join(member):
+    """メンバーがサーバーに参加した時のイベント"""
+    guild = member.guild
+    if not guild_features.get(guild.id, 0) & FEATURE_RAID_GUARD:
+        return
+    
+    now = time.time()
+    tracker = join_trackers[guild.id]
+    tracker['recent'].append((now, member.id))
+    account_age = now - member.created_at.timestamp()
+    is_flood = record_member_join(tracker, account_age, now)
+    
+    if guild.id in raid_lockdowns:
+        # ロックダウン中の参加者はタイムアウト
+        if raid_guard_data[guild.id]['timeout']:
+            await timeout_raid_member(member)
+    elif is_flood:
+        await start_raid_lockdown(guild)
+
+@bot.event
+async def on_member_update(before, after):
+    # ロールの変更で権限・ホワイトリストの判定が変わる
+    if before.roles != after.roles:
+        invalidate_member_verdicts(after.guild.id, after.id)
+
+@bot.event
+async def on_member_remove(member):
+    invalidate_member_verdicts(member.guild.id, member.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    # ロールの権限が変わると、そのロールを持つ全メンバーの判定が変わる
+    if before.permissions != after.permissions:
+        invalidate_member_verdicts(after.guild.id)
+
+@bot.event
+async def on_guild_role_delete(role):
+    invalidate_member_verdicts(role.guild.id)
+
+@bot.event
+async def on_guild_update(before, after):
+    # サーバーの所有者は常に管理者として扱われる
+    if before.owner_id != after.owner_id:
+        invalidate_member_verdicts(after.id)
 
 @bot.command(name='ping')
 async def ping(ctx):
     """Botの応答時間を確認"""
-    await ctx.send(f'Pong! {round(bot.latency * 1000)}ms')
+    if bot.shard_count is None:
+        await ctx.send(f'Pong! {round(bot.latency * 1000)}ms')
+        return
+    
+    # シャーディング時はこのサーバーのシャードの遅延と、全シャードの平均・最大を表示
+    shard_id = ctx.guild.shard_id if ctx.guild else 0
+    latencies = dict(bot.latencies)
+    finite = [latency for latency in latencies.values() if math.isfinite(latency)]
+    own = latencies.get(shard_id, float('nan'))
+    own_text = f"{round(own * 1000)}ms" if math.isfinite(own) else "未接続"
+    summary = f"平均 {round(sum(finite) / len(finite) * 1000)}ms / 最大 {round(max(finite) * 1000)}ms" if finite else "計測中"
+    await ctx.send(f'Pong! {own_text}（シャード {shard_id}/{bot.shard_count}、全シャード: {summary}）')
+
+@bot.command(name='perf')
+@commands.has_permissions(manage_messages=True)
+async def perf(ctx):
+    """
+    ボットの処理性能を表示するコマンド
+    使用例: n!perf
+    """
+    # シャーディング時は全シャードの平均（未接続のシャードがあるとNaNになる）
+    gateway = f"{round(bot.latency * 1000)}ms" if math.isfinite(bot.latency) else "計測中"
+    embed = discord.Embed(
+        title="📈 パフォーマンス",
+        description=f"ゲートウェイ遅延: **{gateway}** | イベントループ遅延: **{format_duration(event_loop_lag['last'])}**\n"
+                    f"🚦 過負荷レベル: **{overload_state['level']}**（{OVERLOAD_LEVELS[overload_state['level']]}）",
+        color=discord.Color.blue() if not overload_state['level'] else discord.Color.orange()
+    )
+    
+    now = time.time()
+    for minutes in (1, 5, 60):
+        # 処理段階・コマンドをp99の大きい順に表示
+        rows = []
+        for key in list(perf_sketches):
+            if key.startswith(('loop:', 'shard:', 'outbound:')):
+                continue
+            count, (p50, p99) = query_perf(key, minutes)
+            if count:
+                rows.append((p99, p50, count, key))
+        rows.sort(reverse=True)
+        
+        lines = [f"`{key}` p50 {format_duration(p50)} / p99 {format_duration(p99)} ({count}件)"
+                 for p99, p50, count, key in rows[:5]]
+        
+        count, (lag_p50, lag_p99) = query_perf('loop:lag', minutes)
+        if count:
+            lines.append(f"ループ遅延 p50 {format_duration(lag_p50)} / p99 {format_duration(lag_p99)}")
+        
+        # 遅いコールバックを回数順に集計
+        slow = defaultdict(lambda: [0, 0.0])
+        for recorded_at, name, elapsed in list(slow_callbacks):
+            if now - recorded_at <= minutes * 60:
+                slow[name][0] += 1
+                slow[name][1] = max(slow[name][1], elapsed)
+        for name, (slow_count, worst) in sorted(slow.items(), key=lambda item: item[1][0], reverse=True)[:3]:
+            lines.append(f"🐢 `{name}` {slow_count}回（最大 {format_duration(worst)}）")
+        
+        embed.add_field(
+            name=f"⏱️ 直近{minutes}分",
+            value="\n".join(lines) if lines else "データなし",
+            inline=False
+        )
+    
+    # シャードごとのゲートウェイ遅延（現在値と直近5分のp99）
+    if bot.shard_count is not None:
+        guild_counts = defaultdict(int)
+        for guild in bot.guilds:
+            guild_counts[guild.shard_id] += 1
+        lines = []
+        for shard_id, state in sorted(get_shard_states().items())[:20]:
+            count, (p99,) = query_perf(f'shard:{shard_id}', 5, (0.99,))
+            current = format_duration(state['latency']) if state['connected'] and math.isfinite(state['latency']) else "未接続"
+            p99_text = f" / p99 {format_duration(p99)}" if count else ""
+            lines.append(f"{'🟢' if state['connected'] else '🔴'} シャード{shard_id}: {current}{p99_text}（{guild_counts[shard_id]}サーバー）")
+        embed.add_field(name=f"🛰️ シャード（{bot.shard_count}）", value="\n".join(lines) or "データなし", inline=False)
+    
+    # 送信リクエストの分類ごとの待ち（現在の待ち件数と直近5分の待ち時間）
+    lines = []
+    for name, label in (('moderation', "モデレーション"), ('moderator', "モデレーター"), ('fun', "遊び")):
+        stats = outbound_stats[name]
+        count, (p50, p99) = query_perf(f'outbound:{name}', 5)
+        wait_text = f" / 待ち p50 {format_duration(p50)}・p99 {format_duration(p99)}" if count else ""
+        shed_text = f" / 受付停止 {stats['shed']}件" if stats['shed'] else ""
+        lines.append(f"{label}: 待ち {len(outbound_queues[name])}件 / 送信 {stats['requests']}件{wait_text}{shed_text}")
+    embed.add_field(name="📤 送信キュー", value="\n".join(lines), inline=False)
+    
+    # クラスタの各プロセスの統計（直近5分）
+    cluster = await read_cluster_stats()
+    if cluster:
+        lines = []
+        for cluster_id, stats in list(cluster.items())[:10]:
+            shard_ids = stats['shard_ids']
+            shard_text = f"{shard_ids[0]}-{shard_ids[-1]}" if len(shard_ids) > 1 else str(shard_ids[0])
+            stage_text = " / ".join(
+                f"{key.split(':', 1)[1]} p99 {format_duration(stats['stages'][key][2])}"
+                for key in ('stage:is_spam', 'loop:lag') if key in stats['stages']
+            )
+            lines.append(f"プロセス{cluster_id}: シャード{shard_text}・{stats['guilds']}サーバー" + (f"（{stage_text}）" if stage_text else ""))
+        
+        # 全プロセスの処理件数と最悪のp99
+        merged = {}
+        for stats in cluster.values():
+            for key, (count, p50, p99) in stats['stages'].items():
+                total, worst = merged.get(key, (0, 0.0))
+                merged[key] = (total + count, max(worst, p99))
+        for key in ('stage:is_spam', 'stage:contains_banned_word'):
+            if key in merged:
+                lines.append(f"全体 `{key}` {merged[key][0]}件 / 最悪p99 {format_duration(merged[key][1])}")
+        embed.add_field(name=f"🧩 クラスタ（{len(cluster)}プロセス、直近5分）", value="\n".join(lines), inline=False)
+    
+    embed.set_footer(text=f"🐢 = {int(PERF_SETTINGS['slow_callback_threshold'] * 1000)}ms以上イベントループを止めた処理 | 要求者: {ctx.author.display_name}")
+    await ctx.send(embed=embed)
+
+@perf.error
+async def perf_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send('❌ このコマンドはメッセージ管理権限を持つユーザーのみ使用できます')
+
+@bot.command(name='memory')
+@commands.has_permissions(administrator=True)
+async def memory(ctx):
+    """
+    ボットが保持している状態のメモリ使用量を表示するデバッグ用コマンド
+    使用例: n!memory
+    環境変数 PYTHONTRACEMALLOC=1 で起動した場合は、tracemallocによる確保量と確保箇所も表示します。
+    """
+    status_message = await ctx.send('🔍 メモリ使用量を計測しています...')
+    started_at = time.perf_counter()
+    sizes = await measure_state_memory()
+    elapsed = time.perf_counter() - started_at
+    
+    embed = discord.Embed(
+        title="🧠 メモリ使用量",
+        description=f"状態の合計: **{format_bytes(sum(sizes.values()))}** | サーバー数: **{len(bot.guilds)}**",
+        color=discord.Color.blue()
+    )
+    
+    lines = []
+    for name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        structure = globals()[name]
+        entries = len(structure) if hasattr(structure, '__len__') else 0
+        lines.append(f"`{name}` {format_bytes(size)}（{entries}件）")
+    embed.add_field(name="📦 構造体別（sys.getsizeofの合計）", value="\n".join(lines), inline=False)
+    
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics('lineno')[:5]
+        top = [f"`{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}` {format_bytes(stat.size)}"
+               for stat in statistics]
+        embed.add_field(
+            name="📊 tracemalloc",
+            value=f"現在: {format_bytes(current)} / ピーク: {format_bytes(peak)}\n" + "\n".join(top),
+            inline=False
+        )
+    
+    embed.set_footer(text=f"計測時間: {format_duration(elapsed)} | 要求者: {ctx.author.display_name}")
+    await status_message.edit(content=None, embed=embed)
+
+@memory.error
+async def memory_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send('❌ このコマンドは管理者のみ使用できます')
 
 @bot.command(name='dice')
 async def dice_roll(ctx, dice_notation=None):
@@ -901,7 +3658,7 @@ async def whitelist(ctx, action: str = "status", target_type: Optional[str] = No
             
     except Exception as e:
         await ctx.send(f'❌ ホワイトリストコマンドの実行中にエラーが発生しました: {e}')
-        print(f"ホワイトリストコマンドエラー: {type(e).__name__}: {e}")
+        log_event('error', 'command_error', f"ホワイトリストコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
 
 @whitelist.error
 async def whitelist_error(ctx, error):
@@ -918,6 +3675,8 @@ async def banword(ctx, action: str = "status", *, target: Optional[str] = None):
     n!banword enable - 禁止ワードを有効にする
     n!banword disable - 禁止ワードを無効にする
     n!banword add 単語 - 禁止ワードを追加
+    n!banword add f*ck - ワイルドカード（* は空白以外の0-10文字）の禁止ワードを追加
+    n!banword add re:fr[e3]{1,3} - 正規表現の禁止ワードを追加
     n!banword remove 単語 - 禁止ワードを削除
     n!banword list - 禁止ワードリストを表示
     n!banword clear - 禁止ワードをクリア
@@ -944,6 +3703,14 @@ async def banword(ctx, action: str = "status", *, target: Optional[str] = None):
             
             embed.add_field(name="禁止ワード数", value=f"{len(banword_settings['words'])}個", inline=True)
             
+            pattern_count = sum(1 for word in banword_settings['words'] if detector_worker.is_pattern_entry(word))
+            if pattern_count:
+                cached = banword_matchers.get(guild_id)
+                pattern_text = f"{pattern_count}個"
+                if cached and cached[1].get('quarantined'):
+                    pattern_text += "（⚠️ 照合が遅いため停止中。禁止ワードを変更すると再開します）"
+                embed.add_field(name="パターン", value=pattern_text, inline=True)
+            
             action_text = {
                 'delete': '🗑️ 削除',
                 'warn': '⚠️ 警告',
@@ -999,10 +3766,23 @@ async def banword(ctx, action: str = "status", *, target: Optional[str] = None):
                 await ctx.send(f'❌ 「{word}」は既に禁止ワードに登録されています。')
                 return
             
+            # パターン（re: で始まるもの・* を含むもの）は処理時間が急激に増えうるものを拒否
+            is_pattern = detector_worker.is_pattern_entry(word)
+            if is_pattern:
+                pattern_count = sum(1 for w in banword_settings['words'] if detector_worker.is_pattern_entry(w))
+                if pattern_count >= BANWORD_PATTERN_SETTINGS['max_patterns']:
+                    await ctx.send(f"❌ パターンは1サーバーあたり{BANWORD_PATTERN_SETTINGS['max_patterns']}個までです。")
+                    return
+                # 検証用の入力での照合は時間がかかりうるため、イベントループを止めないよう別プロセスで実行
+                problem = await validate_pattern_in_process(word, banword_settings['case_sensitive'])
+                if problem:
+                    await ctx.send(f'❌ パターンを登録できません: {problem}')
+                    return
+            
             banword_settings['words'].add(word)
             embed = discord.Embed(
                 title="✅ 禁止ワード追加完了",
-                description=f"「{word}」を禁止ワードに追加しました。",
+                description=f"「{word}」を禁止ワード{'（パターン）' if is_pattern else ''}に追加しました。",
                 color=discord.Color.green()
             )
             embed.add_field(name="現在の禁止ワード数", value=f"{len(banword_settings['words'])}個", inline=True)
@@ -1202,7 +3982,7 @@ async def banword(ctx, action: str = "status", *, target: Optional[str] = None):
             
     except Exception as e:
         await ctx.send(f'❌ 禁止ワードコマンドの実行中にエラーが発生しました: {e}')
-        print(f"禁止ワードコマンドエラー: {type(e).__name__}: {e}")
+        log_event('error', 'command_error', f"禁止ワードコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
 
 @banword.error
 async def banword_error(ctx, error):
@@ -1224,9 +4004,15 @@ async def help_command(ctx):
 `n!ban @ユーザー 理由` - ユーザーをバン
 `n!ban 123456789 理由` - IDでバン（サーバー外も可）
 `n!unban 123456789 理由` - バンを解除
+`n!massban ID ID ... 理由` - 複数ユーザーを一括バン（ID列挙ファイルの添付も可）
+`n!massunban ID ID ... 理由` - 複数ユーザーのバンを一括解除
 `n!role_status` - ボットのロール状態を確認
 `n!cleanup_role` - 管理者専用ロール削除
 `n!antispam` - スパム対策の設定・管理
+`n!raidguard` - 参加レイド対策の設定・管理
+`n!cooldown` - 遊びコマンドのクールダウンの設定・管理
+`n!pipeline` - モデレーションの段階の有効/無効・シャドーモードと処理時間
+`n!rules` - サーバーごとのモデレーションルール（JSON）の設定
 `n!whitelist` - ホワイトリスト管理（詳細は後述）
 `n!banword` - 禁止ワード管理（詳細は後述）
         """,
@@ -1240,6 +4026,8 @@ async def help_command(ctx):
 `n!serverinfo` - サーバーの詳細情報を表示
 `n!auditlog` - サーバーの監査ログを表示
 `n!userinfo` - ユーザー情報を表示（自分または指定ユーザー）
+`n!perf` - 処理時間（p50/p99）とイベントループ遅延を表示
+`n!memory` - 状態のメモリ使用量を表示（管理者のみ）
         """,
         inline=False
     )
@@ -1273,6 +4061,7 @@ async def help_command(ctx):
 `n!whitelist list` - 登録されたユーザーとロールを表示
 `n!whitelist clear` - ホワイトリストをクリア
 **権限:** サーバー管理権限が必要
+**機能:** 登録されたユーザー・ロールはスパム検出と禁止ワードの対象外
         """,
         inline=False
     )
@@ -1392,6 +4181,29 @@ async def cleanup_role_error(ctx, error):
     if isinstance(error, commands.MissingPermissions):
         await ctx.send('❌ このコマンドは管理者のみ使用できます')
 
+def check_ban_hierarchy(guild, author, target):
+    """バン対象の権限階層をチェックし、バンできない場合は理由を返す"""
+    # 自分自身やボットをバンしようとした場合
+    if target.id == author.id:
+        return '自分自身をバンすることはできません'
+    
+    if bot.user and target.id == bot.user.id:
+        return 'ボット自身をバンすることはできません'
+    
+    # サーバーの所有者をバンしようとした場合
+    if target.id == guild.owner_id:
+        return 'サーバーの所有者をバンすることはできません'
+    
+    # メンバーの場合、権限階層をチェック
+    if isinstance(target, discord.Member):
+        if target.top_role >= author.top_role and author.id != guild.owner_id:
+            return 'あなたより上位または同等の権限を持つユーザーをバンすることはできません'
+        
+        if target.top_role >= guild.me.top_role:
+            return 'ボットより上位または同等の権限を持つユーザーをバンすることはできません'
+    
+    return None
+
 @bot.command(name='ban')
 @commands.has_permissions(ban_members=True)
 async def ban_user(ctx, target, *, reason="理由が指定されていません"):
@@ -1465,30 +4277,12 @@ async def ban_user(ctx, target, *, reason="理由が指定されていません"
             await ctx.send('❌ ユーザーを特定できませんでした')
             return
         
-        # 自分自身やボットをバンしようとした場合
-        if user_to_ban.id == ctx.author.id:
-            await ctx.send('❌ 自分自身をバンすることはできません')
-            return
-        
-        if bot.user and user_to_ban.id == bot.user.id:
-            await ctx.send('❌ ボット自身をバンすることはできません')
-            return
-        
-        # サーバーの所有者をバンしようとした場合
-        if user_to_ban.id == ctx.guild.owner_id:
-            await ctx.send('❌ サーバーの所有者をバンすることはできません')
+        # 自分自身・ボット・所有者・権限階層をチェック
+        hierarchy_error = check_ban_hierarchy(ctx.guild, ctx.author, user_to_ban)
+        if hierarchy_error:
+            await ctx.send(f'❌ {hierarchy_error}')
             return
         
-        # メンバーの場合、権限階層をチェック
-        if isinstance(user_to_ban, discord.Member):
-            if user_to_ban.top_role >= ctx.author.top_role and ctx.author.id != ctx.guild.owner_id:
-                await ctx.send('❌ あなたより上位または同等の権限を持つユーザーをバンすることはできません')
-                return
-            
-            if user_to_ban.top_role >= ctx.guild.me.top_role:
-                await ctx.send('❌ ボットより上位または同等の権限を持つユーザーをバンすることはできません')
-                return
-        
         # 既にバンされているかチェック
         try:
             ban_entry = await ctx.guild.fetch_ban(user_to_ban)
@@ -1569,7 +4363,8 @@ async def ban_user(ctx, target, *, reason="理由が指定されていません"
             await ctx.send(embed=success_embed)
             
             # ログ出力
-            print(f"🔨 バン実行: {user_to_ban} (ID: {user_to_ban.id}) | 理由: {reason} | 実行者: {ctx.author}")
+            log_event('info', 'ban', f"🔨 バン実行: {user_to_ban} (ID: {user_to_ban.id}) | 理由: {reason} | 実行者: {ctx.author}",
+                      guild_id=ctx.guild.id, user_id=user_to_ban.id, moderator_id=ctx.author.id)
             
         except asyncio.TimeoutError:
             await ctx.send('⏰ 確認がタイムアウトしました。バンがキャンセルされました')
@@ -1580,7 +4375,7 @@ async def ban_user(ctx, target, *, reason="理由が指定されていません"
         await ctx.send(f'❌ バン実行中にエラーが発生しました: {e}')
     except Exception as e:
         await ctx.send(f'❌ 予期しないエラーが発生しました: {e}')
-        print(f"バンコマンドエラー: {type(e).__name__}: {e}")
+        log_event('error', 'command_error', f"バンコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
 
 @ban_user.error
 async def ban_user_error(ctx, error):
@@ -1608,72 +4403,455 @@ async def unban_user(ctx, user_id: int, *, reason="理由が指定されてい
         return
     
     try:
-        # ユーザーがバンされているかチェック
-        ban_entry = await ctx.guild.fetch_ban(discord.Object(id=user_id))
-        banned_user = ban_entry.user
+        # ユーザーがバンされているかチェック
+        ban_entry = await ctx.guild.fetch_ban(discord.Object(id=user_id))
+        banned_user = ban_entry.user
+        
+        # 確認メッセージ
+        embed = discord.Embed(
+            title="🔓 バン解除確認",
+            description=f"本当に {banned_user} のバンを解除しますか？",
+            color=discord.Color.green()
+        )
+        embed.add_field(name="対象ユーザー", value=f"{banned_user} (ID: {banned_user.id})", inline=False)
+        embed.add_field(name="現在のバン理由", value=ban_entry.reason or "理由なし", inline=False)
+        embed.add_field(name="解除理由", value=reason, inline=False)
+        embed.add_field(name="実行者", value=ctx.author.mention, inline=True)
+        embed.set_footer(text="続行する場合は 'yes' と入力してください（30秒以内）")
+        
+        await ctx.send(embed=embed)
+        
+        # 確認待ち
+        def check(message):
+            return (message.author == ctx.author and 
+                   message.channel == ctx.channel and 
+                   message.content.lower() == 'yes')
+        
+        try:
+            confirmation = await bot.wait_for('message', check=check, timeout=30.0)
+            
+            # バン解除の実行
+            await ctx.guild.unban(banned_user, reason=f"実行者: {ctx.author} | 理由: {reason}")
+            
+            # 成功メッセージ
+            success_embed = discord.Embed(
+                title="✅ バン解除完了",
+                description=f"{banned_user} のバンを解除しました",
+                color=discord.Color.green()
+            )
+            success_embed.add_field(name="解除理由", value=reason, inline=False)
+            success_embed.add_field(name="実行者", value=ctx.author.mention, inline=True)
+            
+            await ctx.send(embed=success_embed)
+            
+            # ログ出力
+            log_event('info', 'unban', f"🔓 バン解除: {banned_user} (ID: {banned_user.id}) | 理由: {reason} | 実行者: {ctx.author}",
+                      guild_id=ctx.guild.id, user_id=banned_user.id, moderator_id=ctx.author.id)
+            
+        except asyncio.TimeoutError:
+            await ctx.send('⏰ 確認がタイムアウトしました。バン解除がキャンセルされました')
+        
+    except discord.NotFound:
+        await ctx.send(f'❌ ID `{user_id}` のユーザーはバンされていません')
+    except discord.Forbidden:
+        await ctx.send('❌ バン解除権限が不足しています')
+    except discord.HTTPException as e:
+        await ctx.send(f'❌ バン解除中にエラーが発生しました: {e}')
+    except Exception as e:
+        await ctx.send(f'❌ 予期しないエラーが発生しました: {e}')
+        log_event('error', 'command_error', f"アンバンコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
+
+@unban_user.error
+async def unban_user_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send('❌ このコマンドはメンバーをバンする権限を持つユーザーのみ使用できます')
+    elif isinstance(error, commands.MissingRequiredArgument):
+        await ctx.send('❌ バン解除するユーザーのIDを指定してください\n'
+                      '使用例: `!unban 123456789 解除理由`')
+    elif isinstance(error, commands.BadArgument):
+        await ctx.send('❌ 有効なユーザーIDを指定してください（数字のみ）')
+
+# 一括バン設定
+MASS_BAN_SETTINGS = {
+    'max_targets': 1000,            # 1回のジョブで指定できる最大ID数
+    'max_file_size': 1024 * 1024,   # 添付ファイルの最大サイズ（バイト）
+    'concurrency': 3,               # 同時に実行するワーカー数
+    'request_interval': 0.5,        # ワーカーごとのリクエスト間隔（秒）
+    'max_retries': 3,               # レート制限時の最大リトライ回数
+    'progress_interval': 3.0,       # 進捗メッセージの更新間隔（秒）
+    'job_file': 'mass_ban_jobs.json'  # 再起動後の再開用ジョブ保存ファイル（cluster.py から起動した場合はプロセス番号を付ける）
+}
+
+mass_ban_jobs = {}   # job_id -> ジョブ状態（JSONで保存可能な形式）
+mass_ban_tasks = {}  # job_id -> 実行中のasyncio.Task
+
+MASS_BAN_ID_PATTERN = re.compile(r'^<@!?(\d{15,20})>$|^(\d{15,20})$')
+
+def parse_mass_ban_arguments(text):
+    """引数文字列からユーザーIDのリストと理由を取り出す"""
+    user_ids = []
+    reason_words = []
+    for token in (text or '').split():
+        match = MASS_BAN_ID_PATTERN.match(token.strip(','))
+        if match:
+            user_ids.append(int(match.group(1) or match.group(2)))
+        else:
+            reason_words.append(token)
+    return user_ids, ' '.join(reason_words)
+
+async def read_mass_ban_attachments(message):
+    """添付されたテキストファイルからユーザーIDを読み込む"""
+    user_ids = []
+    for attachment in message.attachments:
+        is_text = (attachment.content_type or '').startswith('text/') or attachment.filename.endswith(('.txt', '.csv'))
+        if not is_text or attachment.size > MASS_BAN_SETTINGS['max_file_size']:
+            continue
+        data = await attachment.read()
+        text = data.decode('utf-8', errors='ignore')
+        user_ids.extend(int(match) for match in re.findall(r'\d{15,20}', text))
+    return user_ids
+
+def mass_ban_job_path():
+    """
+    このプロセスの一括バンジョブ保存ファイル
+    cluster.py から起動された各プロセスは担当するサーバーのジョブだけを持つため、ファイルをプロセスごとに分けます
+    （同じファイルを共有すると、他のプロセスのジョブを上書きや削除で消してしまうため）。
+    """
+    path = MASS_BAN_SETTINGS['job_file']
+    if 'CLUSTER_ID' not in os.environ:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.{CLUSTER_SETTINGS['cluster_id']}{extension}"
+
+def save_mass_ban_jobs():
+    """未完了の一括バンジョブをファイルに保存（再起動後の再開用）"""
+    path = mass_ban_job_path()
+    try:
+        if not mass_ban_jobs:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(mass_ban_jobs, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+    except OSError as e:
+        log_event('error', 'mass_ban_error', f"一括バンジョブ保存エラー: {e}", key='mass_ban_save_error')
+
+def load_mass_ban_jobs():
+    """保存された一括バンジョブを読み込む"""
+    path = mass_ban_job_path()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        log_event('error', 'mass_ban_error', f"一括バンジョブ読み込みエラー: {e}")
+        return {}
+
+def get_mass_ban_progress(job):
+    """ジョブの進捗を集計する"""
+    results = job['results']
+    counts = {'done': 0, 'skipped': 0, 'failed': 0}
+    for result in results.values():
+        counts[result] += 1
+    counts['pending'] = len(job['targets']) - len(results)
+    return counts
+
+def build_mass_ban_status_embed(job, finished=False):
+    """一括バンの進捗表示用Embedを作成"""
+    counts = get_mass_ban_progress(job)
+    total = len(job['targets'])
+    processed = total - counts['pending']
+    label = "一括バン" if job['action'] == 'ban' else "一括バン解除"
+    
+    if finished:
+        title = f"✅ {label}完了"
+        color = discord.Color.green() if counts['failed'] == 0 else discord.Color.orange()
+    else:
+        title = f"⏳ {label}実行中"
+        color = discord.Color.blue()
+    
+    embed = discord.Embed(title=title, description=f"進捗: **{processed}/{total}** 件", color=color)
+    embed.add_field(name="成功", value=f"{counts['done']}件", inline=True)
+    embed.add_field(name="スキップ", value=f"{counts['skipped']}件", inline=True)
+    embed.add_field(name="失敗", value=f"{counts['failed']}件", inline=True)
+    embed.add_field(name="理由", value=job['reason'], inline=False)
+    embed.set_footer(text=f"ジョブID: {job['id']} | 実行者: {job['author_name']}")
+    return embed
+
+async def execute_mass_ban_target(guild, job, user_id, rate_limit):
+    """1件分のバン/バン解除を実行し、結果（done/skipped/failed）を返す"""
+    target = discord.Object(id=user_id)
+    
+    for attempt in range(MASS_BAN_SETTINGS['max_retries'] + 1):
+        # 他のワーカーがレート制限を受けている場合は待機
+        wait = rate_limit['resume_at'] - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        
+        try:
+            if job['action'] == 'ban':
+                await guild.ban(target, reason=job['audit_reason'], delete_message_seconds=0)
+            else:
+                await guild.unban(target, reason=job['audit_reason'])
+            return 'done'
+        except discord.NotFound:
+            return 'skipped'  # ユーザーが存在しない、またはバンされていない
+        except discord.Forbidden:
+            return 'failed'
+        except discord.HTTPException as e:
+            if e.status == 429 and attempt < MASS_BAN_SETTINGS['max_retries']:
+                # 全ワーカーで共有するバックオフを設定
+                retry_after = getattr(e, 'retry_after', None) or 2 ** attempt
+                rate_limit['resume_at'] = max(rate_limit['resume_at'], time.monotonic() + retry_after)
+                continue
+            return 'failed'
+    
+    return 'failed'
+
+async def run_mass_ban_job(job):
+    """一括バンジョブを上限付きの並列ワーカーで実行する"""
+    guild = bot.get_guild(job['guild_id'])
+    if not guild:
+        log_event('warning', 'mass_ban_discarded', f"一括バンジョブ {job['id']} のサーバーが見つからないため破棄します", job_id=job['id'])
+        mass_ban_jobs.pop(job['id'], None)
+        mass_ban_tasks.pop(job['id'], None)
+        save_mass_ban_jobs()
+        return
+    
+    # 進捗表示用メッセージを取得（再開時は既存メッセージを再利用）
+    status_message = None
+    channel = guild.get_channel(job['channel_id'])
+    if channel:
+        try:
+            status_message = await channel.fetch_message(job['status_message_id'])
+        except discord.HTTPException:
+            try:
+                status_message = await channel.send(embed=build_mass_ban_status_embed(job))
+                job['status_message_id'] = status_message.id
+            except discord.HTTPException:
+                status_message = None
+    
+    queue = asyncio.Queue()
+    for user_id in job['targets']:
+        if str(user_id) not in job['results']:
+            queue.put_nowait(user_id)
+    
+    rate_limit = {'resume_at': 0.0}
+    
+    async def worker():
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            job['results'][str(user_id)] = await execute_mass_ban_target(guild, job, user_id, rate_limit)
+            await asyncio.sleep(MASS_BAN_SETTINGS['request_interval'])
+    
+    async def report_progress():
+        while True:
+            await asyncio.sleep(MASS_BAN_SETTINGS['progress_interval'])
+            save_mass_ban_jobs()
+            if status_message:
+                try:
+                    await status_message.edit(embed=build_mass_ban_status_embed(job))
+                except discord.HTTPException:
+                    pass
+    
+    progress_task = asyncio.create_task(report_progress())
+    try:
+        workers = [asyncio.create_task(worker()) for _ in range(MASS_BAN_SETTINGS['concurrency'])]
+        await asyncio.gather(*workers)
+    finally:
+        progress_task.cancel()
+    
+    # 完了したジョブを削除して最終結果を表示
+    mass_ban_jobs.pop(job['id'], None)
+    mass_ban_tasks.pop(job['id'], None)
+    save_mass_ban_jobs()
+    
+    if status_message:
+        try:
+            await status_message.edit(embed=build_mass_ban_status_embed(job, finished=True))
+        except discord.HTTPException:
+            pass
+    
+    counts = get_mass_ban_progress(job)
+    log_event('info', 'mass_ban_finished', f"🔨 一括{'バン' if job['action'] == 'ban' else 'バン解除'}完了: 成功 {counts['done']} / スキップ {counts['skipped']} / 失敗 {counts['failed']} | サーバー: {guild.name} | 実行者: {job['author_name']}",
+              job_id=job['id'], guild_id=guild.id, **counts)
+
+def start_mass_ban_job(job):
+    """ジョブを登録して実行タスクを開始"""
+    mass_ban_jobs[job['id']] = job
+    save_mass_ban_jobs()
+    mass_ban_tasks[job['id']] = asyncio.create_task(run_mass_ban_job(job))
+
+async def resume_mass_ban_jobs(shard_id=None):
+    """再起動前に中断された一括バンジョブを再開（shard_idを指定した場合はそのシャードのサーバーのみ）"""
+    for job_id, job in load_mass_ban_jobs().items():
+        if job_id in mass_ban_tasks:
+            continue  # 再接続時など、既に実行中
+        if shard_id is not None and guild_shard_id(job['guild_id']) != shard_id:
+            continue
+        if not owns_guild(job['guild_id']):
+            continue  # 他のプロセスが担当するサーバーのジョブ
+        log_event('info', 'mass_ban_resumed', f"🔁 一括バンジョブを再開: {job_id} (残り {get_mass_ban_progress(job)['pending']} 件)", job_id=job_id)
+        start_mass_ban_job(job)
+
+async def prepare_mass_ban(ctx, action, args):
+    """一括バン/バン解除の対象を解析し、確認後にジョブを開始する"""
+    if not ctx.guild:
+        await ctx.send('❌ このコマンドはサーバー内でのみ使用できます')
+        return
+    
+    # ボットの権限をチェック
+    if not ctx.guild.me.guild_permissions.ban_members:
+        await ctx.send('❌ ボットにメンバーをバンする権限がありません')
+        return
+    
+    if any(job['guild_id'] == ctx.guild.id for job in mass_ban_jobs.values()):
+        await ctx.send('❌ このサーバーでは既に一括バンジョブが実行中です。完了するまでお待ちください')
+        return
+    
+    try:
+        user_ids, reason = parse_mass_ban_arguments(args)
+        user_ids.extend(await read_mass_ban_attachments(ctx.message))
+        user_ids = list(dict.fromkeys(user_ids))  # 重複を除去（順序は維持）
+        reason = reason or "理由が指定されていません"
         
-        # 確認メッセージ
+        if not user_ids:
+            await ctx.send('❌ 対象のユーザーIDを指定するか、IDを列挙したテキストファイルを添付してください')
+            return
+        
+        if len(user_ids) > MASS_BAN_SETTINGS['max_targets']:
+            await ctx.send(f"❌ 一度に指定できるのは最大{MASS_BAN_SETTINGS['max_targets']}件です（指定: {len(user_ids)}件）")
+            return
+        
+        # 現在のバンリストを取得
+        banned_ids = set()
+        async for ban_entry in ctx.guild.bans(limit=None):
+            banned_ids.add(ban_entry.user.id)
+        
+        targets = []
+        already_done = 0
+        rejected = []
+        for user_id in user_ids:
+            if action == 'ban':
+                if user_id in banned_ids:
+                    already_done += 1
+                    continue
+                # 権限階層をチェック（確認は一括で行う）
+                target = ctx.guild.get_member(user_id) or discord.Object(id=user_id)
+                hierarchy_error = check_ban_hierarchy(ctx.guild, ctx.author, target)
+                if hierarchy_error:
+                    rejected.append((user_id, hierarchy_error))
+                    continue
+            elif user_id not in banned_ids:
+                already_done += 1
+                continue
+            targets.append(user_id)
+        
+        label = "一括バン" if action == 'ban' else "一括バン解除"
+        skip_label = "既にバン済み" if action == 'ban' else "バンされていない"
+        
+        if not targets:
+            await ctx.send(f'❌ 実行対象のユーザーがいません（{skip_label}: {already_done}件 / 対象外: {len(rejected)}件）')
+            return
+        
+        # 確認メッセージ（1回のみ）
         embed = discord.Embed(
-            title="🔓 バン解除確認",
-            description=f"本当に {banned_user} のバンを解除しますか？",
-            color=discord.Color.green()
+            title=f"🔨 {label}確認",
+            description=f"本当に **{len(targets)}** 人を{'バン' if action == 'ban' else 'バン解除'}しますか？",
+            color=discord.Color.red() if action == 'ban' else discord.Color.green()
         )
-        embed.add_field(name="対象ユーザー", value=f"{banned_user} (ID: {banned_user.id})", inline=False)
-        embed.add_field(name="現在のバン理由", value=ban_entry.reason or "理由なし", inline=False)
-        embed.add_field(name="解除理由", value=reason, inline=False)
+        embed.add_field(name="指定されたID", value=f"{len(user_ids)}件", inline=True)
+        embed.add_field(name=skip_label, value=f"{already_done}件", inline=True)
+        embed.add_field(name="対象外", value=f"{len(rejected)}件", inline=True)
+        if rejected:
+            rejected_text = "\n".join(f"`{user_id}`: {error}" for user_id, error in rejected[:5])
+            if len(rejected) > 5:
+                rejected_text += f"\n... 他 {len(rejected) - 5} 件"
+            embed.add_field(name="対象外の内訳", value=rejected_text, inline=False)
+        embed.add_field(name="理由", value=reason, inline=False)
         embed.add_field(name="実行者", value=ctx.author.mention, inline=True)
         embed.set_footer(text="続行する場合は 'yes' と入力してください（30秒以内）")
         
         await ctx.send(embed=embed)
         
-        # 確認待ち
         def check(message):
             return (message.author == ctx.author and 
                    message.channel == ctx.channel and 
                    message.content.lower() == 'yes')
         
         try:
-            confirmation = await bot.wait_for('message', check=check, timeout=30.0)
-            
-            # バン解除の実行
-            await ctx.guild.unban(banned_user, reason=f"実行者: {ctx.author} | 理由: {reason}")
-            
-            # 成功メッセージ
-            success_embed = discord.Embed(
-                title="✅ バン解除完了",
-                description=f"{banned_user} のバンを解除しました",
-                color=discord.Color.green()
-            )
-            success_embed.add_field(name="解除理由", value=reason, inline=False)
-            success_embed.add_field(name="実行者", value=ctx.author.mention, inline=True)
-            
-            await ctx.send(embed=success_embed)
-            
-            # ログ出力
-            print(f"🔓 バン解除: {banned_user} (ID: {banned_user.id}) | 理由: {reason} | 実行者: {ctx.author}")
-            
+            await bot.wait_for('message', check=check, timeout=30.0)
         except asyncio.TimeoutError:
-            await ctx.send('⏰ 確認がタイムアウトしました。バン解除がキャンセルされました')
+            await ctx.send(f'⏰ 確認がタイムアウトしました。{label}がキャンセルされました')
+            return
+        
+        # 理由の長さ制限（Discord API制限対応）
+        audit_reason = f"実行者: {ctx.author} | 理由: {reason} ({label})"
+        if len(audit_reason) > 512:
+            audit_reason = audit_reason[:509] + "..."
+        
+        job = {
+            'id': f"{ctx.guild.id}-{int(time.time() * 1000)}",
+            'action': action,
+            'guild_id': ctx.guild.id,
+            'channel_id': ctx.channel.id,
+            'status_message_id': 0,
+            'author_id': ctx.author.id,
+            'author_name': str(ctx.author),
+            'reason': reason,
+            'audit_reason': audit_reason,
+            'targets': targets,
+            'results': {}  # str(user_id) -> 'done' / 'skipped' / 'failed'
+        }
+        status_message = await ctx.send(embed=build_mass_ban_status_embed(job))
+        job['status_message_id'] = status_message.id
+        start_mass_ban_job(job)
         
-    except discord.NotFound:
-        await ctx.send(f'❌ ID `{user_id}` のユーザーはバンされていません')
     except discord.Forbidden:
-        await ctx.send('❌ バン解除権限が不足しています')
+        await ctx.send('❌ バンリストの取得に必要な権限が不足しています')
     except discord.HTTPException as e:
-        await ctx.send(f'❌ バン解除中にエラーが発生しました: {e}')
+        await ctx.send(f'❌ 一括処理の準備中にエラーが発生しました: {e}')
     except Exception as e:
         await ctx.send(f'❌ 予期しないエラーが発生しました: {e}')
-        print(f"アンバンコマンドエラー: {type(e).__name__}: {e}")
+        log_event('error', 'command_error', f"一括バンコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
 
-@unban_user.error
-async def unban_user_error(ctx, error):
+@bot.command(name='massban')
+@commands.has_permissions(ban_members=True)
+async def mass_ban(ctx, *, args: Optional[str] = None):
+    """
+    複数のユーザーを一括でバンするコマンド
+    使用例:
+    n!massban 123456789012345678 234567890123456789 荒らし対策
+    n!massban 荒らし対策 (IDを列挙したテキストファイルを添付)
+    """
+    await prepare_mass_ban(ctx, 'ban', args)
+
+@mass_ban.error
+async def mass_ban_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send('❌ このコマンドはメンバーをバンする権限を持つユーザーのみ使用できます')
+
+@bot.command(name='massunban')
+@commands.has_permissions(ban_members=True)
+async def mass_unban(ctx, *, args: Optional[str] = None):
+    """
+    複数のユーザーのバンを一括で解除するコマンド
+    使用例:
+    n!massunban 123456789012345678 234567890123456789 誤バンのため
+    n!massunban 誤バンのため (IDを列挙したテキストファイルを添付)
+    """
+    await prepare_mass_ban(ctx, 'unban', args)
+
+@mass_unban.error
+async def mass_unban_error(ctx, error):
     if isinstance(error, commands.MissingPermissions):
         await ctx.send('❌ このコマンドはメンバーをバンする権限を持つユーザーのみ使用できます')
-    elif isinstance(error, commands.MissingRequiredArgument):
-        await ctx.send('❌ バン解除するユーザーのIDを指定してください\n'
-                      '使用例: `!unban 123456789 解除理由`')
-    elif isinstance(error, commands.BadArgument):
-        await ctx.send('❌ 有効なユーザーIDを指定してください（数字のみ）')
 
 @bot.command(name='serverinfo')
 async def server_info(ctx):
@@ -1835,6 +5013,16 @@ async def server_info(ctx):
                 inline=False
         )
         
+        # クラスタで動作している場合はボット全体の規模を表示
+        cluster = await read_cluster_stats()
+        if len(cluster) > 1:
+            embed.add_field(
+                name="🧩 ボット全体",
+                value=f"{sum(stats['guilds'] for stats in cluster.values())}サーバー / "
+                      f"{sum(stats['members'] for stats in cluster.values())}メンバー（{len(cluster)}プロセス）",
+                inline=False
+            )
+        
         # フッター
         embed.set_footer(
             text=f"情報取得者: {ctx.author}",
@@ -1845,7 +5033,7 @@ async def server_info(ctx):
         
     except Exception as e:
         await ctx.send(f'❌ サーバー情報の取得中にエラーが発生しました: {e}')
-        print(f"サーバー情報コマンドエラー: {type(e).__name__}: {e}")
+        log_event('error', 'command_error', f"サーバー情報コマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
 
 @bot.command(name='supurito')
 async def supurito(ctx):
@@ -1874,7 +5062,7 @@ async def supurito(ctx):
         # 画像ファイルが存在するかチェック
         if not image_files:
             await ctx.send('❌ Sprite画像が見つかりません。管理者に連絡してください。')
-            print(f"Sprite画像が見つかりません。ディレクトリ: {sprite_dir}")
+            log_event('warning', 'sprite_missing', f"Sprite画像が見つかりません。ディレクトリ: {sprite_dir}", key='sprite_missing')
             return
         
         # ランダムに1枚選択
@@ -1883,14 +5071,14 @@ async def supurito(ctx):
         # ファイルが存在するかチェック
         if not os.path.exists(selected_image):
             await ctx.send('❌ 選択された画像ファイルが見つかりません。')
-            print(f"画像ファイルが見つかりません: {selected_image}")
+            log_event('warning', 'sprite_missing', f"画像ファイルが見つかりません: {selected_image}", key='sprite_missing')
             return
         
         # ファイルサイズをチェック（Discord制限: 8MB）
         file_size = os.path.getsize(selected_image)
         if file_size > 8 * 1024 * 1024:  # 8MB
             await ctx.send('❌ 選択された画像ファイルが大きすぎます（8MB制限）')
-            print(f"ファイルサイズが大きすぎます: {selected_image} ({file_size} bytes)")
+            log_event('warning', 'sprite_too_large', f"ファイルサイズが大きすぎます: {selected_image} ({file_size} bytes)", key='sprite_too_large')
             return
         
         # ファイル名を取得（表示用）
@@ -1914,14 +5102,14 @@ async def supurito(ctx):
             await ctx.send(file=picture, embed=embed)
             
         # ログ出力
-        print(f"🥤 Sprite画像送信: {filename} | 要求者: {ctx.author}")
+        log_event('debug', 'sprite_sent', f"🥤 Sprite画像送信: {filename} | 要求者: {ctx.author}", key='sprite_sent', user_id=ctx.author.id)
         
     except discord.HTTPException as e:
         await ctx.send(f'❌ 画像の送信中にエラーが発生しました: {e}')
-        print(f"Discord HTTPエラー: {e}")
+        log_event('error', 'command_error', f"Discord HTTPエラー: {e}", key='command_error:supurito', command='supurito')
     except Exception as e:
         await ctx.send(f'❌ 予期しないエラーが発生しました: {e}')
-        print(f"Supuraitoコマンドエラー: {type(e).__name__}: {e}")
+        log_event('error', 'command_error', f"Supuraitoコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
 
 @bot.command(name='auditlog')
 async def auditlog(ctx, limit: int = 10):
@@ -2044,14 +5232,14 @@ async def auditlog(ctx, limit: int = 10):
         await ctx.send(embed=embed)
         
         # ログ出力
-        print(f"📋 監査ログ表示: {len(audit_logs)}件 | 要求者: {ctx.author}")
+        log_event('info', 'auditlog_view', f"📋 監査ログ表示: {len(audit_logs)}件 | 要求者: {ctx.author}", guild_id=ctx.guild.id, user_id=ctx.author.id)
         
     except discord.Forbidden:
         await ctx.send('❌ ボットに監査ログへのアクセス権限がありません。管理者に権限付与を依頼してください。')
-        print(f"監査ログアクセス権限不足: {ctx.guild.name}")
+        log_event('warning', 'auditlog_forbidden', f"監査ログアクセス権限不足: {ctx.guild.name}", guild_id=ctx.guild.id)
     except Exception as e:
         await ctx.send(f'❌ 監査ログの取得中にエラーが発生しました: {e}')
-        print(f"監査ログコマンドエラー: {type(e).__name__}: {e}")
+        log_event('error', 'command_error', f"監査ログコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
 
 @bot.command(name='userinfo')
 async def userinfo(ctx, user: Optional[discord.Member] = None):
@@ -2225,11 +5413,11 @@ async def userinfo(ctx, user: Optional[discord.Member] = None):
         await ctx.send(embed=embed)
         
         # ログ出力
-        print(f"👤 ユーザー情報表示: {target_user.name} (ID: {target_user.id}) | 要求者: {ctx.author}")
+        log_event('debug', 'userinfo_view', f"👤 ユーザー情報表示: {target_user.name} (ID: {target_user.id}) | 要求者: {ctx.author}", user_id=ctx.author.id)
         
     except Exception as e:
         await ctx.send(f'❌ ユーザー情報の取得中にエラーが発生しました: {e}')
-        print(f"ユーザー情報コマンドエラー: {type(e).__name__}: {e}")
+        log_event('error', 'command_error', f"ユーザー情報コマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
 
 @bot.command(name='antispam')
 async def antispam(ctx, action: str = "status", *, value: Optional[str] = None):
@@ -2242,6 +5430,7 @@ async def antispam(ctx, action: str = "status", *, value: Optional[str] = None):
     !antispam reset @ユーザー - ユーザーの警告をリセット
     !antispam unmute @ユーザー - ユーザーのミュートを解除
     !antispam stats - サーバーのスパム統計を表示
+    !antispam shadow report [分] - シャドーモードの検出処理の一致率・処理時間を表示
     """
     
     # 管理者権限チェック
@@ -2278,13 +5467,14 @@ async def antispam(ctx, action: str = "status", *, value: Optional[str] = None):
             )
             
             # 統計情報
-            stats = spam_stats[ctx.guild.id]
+            stats = spam_stats.get(ctx.guild.id) or spam_stats.default_factory()
             embed.add_field(
                 name="📈 統計情報",
                 value=f"""
 削除されたメッセージ: {stats['messages_deleted']}件
 発行された警告: {stats['warnings_given']}回
 適用されたミュート: {stats['mutes_applied']}回
+集約・抑制した通知: {stats['notices_suppressed']}件
                 """,
                 inline=False
             )
@@ -2317,6 +5507,8 @@ async def antispam(ctx, action: str = "status", *, value: Optional[str] = None):
                 value=f"""
 🔄 **短時間大量投稿**: {SPAM_SETTINGS['time_window']}秒間で{SPAM_SETTINGS['message_limit']}件以上
 🔁 **重複メッセージ**: 同じ内容を{SPAM_SETTINGS['duplicate_limit']}回連続
+🔀 **類似メッセージ**: 同じユーザーの類似投稿{NEAR_DUPLICATE_SETTINGS['author_limit'] + 1}回、またはチャンネル内で{NEAR_DUPLICATE_SETTINGS['channel_limit'] + 1}回の一斉投稿中に同じユーザーが2回（{NEAR_DUPLICATE_SETTINGS['window']}秒以内）
+🌐 **複数サーバー同一内容**: {CROSS_GUILD_SETTINGS['guild_threshold']}サーバー・{CROSS_GUILD_SETTINGS['author_threshold']}人以上（{CROSS_GUILD_SETTINGS['window']}秒以内）
 ⚠️ **警告しきい値**: {SPAM_SETTINGS['warning_threshold']}回でミュート
 🔇 **ミュート時間**: {SPAM_SETTINGS['mute_duration']}秒 ({SPAM_SETTINGS['mute_duration']//60}分)
                 """,
@@ -2419,7 +5611,7 @@ async def antispam(ctx, action: str = "status", *, value: Optional[str] = None):
                 
         elif action == "stats":
             # 詳細統計を表示
-            stats = spam_stats[ctx.guild.id]
+            stats = spam_stats.get(ctx.guild.id) or spam_stats.default_factory()
             embed = discord.Embed(
                 title="📊 スパム対策統計",
                 color=discord.Color.blue()
@@ -2431,6 +5623,7 @@ async def antispam(ctx, action: str = "status", *, value: Optional[str] = None):
 🗑️ 削除メッセージ: **{stats['messages_deleted']}** 件
 ⚠️ 発行警告: **{stats['warnings_given']}** 回
 🔇 適用ミュート: **{stats['mutes_applied']}** 回
+📭 集約・抑制した通知: **{stats['notices_suppressed']}** 件
                 """,
                 inline=False
             )
@@ -2455,21 +5648,473 @@ async def antispam(ctx, action: str = "status", *, value: Optional[str] = None):
             embed.set_footer(text=f"要求者: {ctx.author.display_name}")
             await ctx.send(embed=embed)
             
+        elif action == "shadow":
+            # シャドーモードの検出処理のレポート
+            args = (value or "report").split()
+            if args[0].lower() != "report" or len(args) > 2 or (len(args) == 2 and not args[1].isdigit()):
+                await ctx.send('❌ 使用例: `n!antispam shadow report` または `n!antispam shadow report 1440`（集計する分数）')
+                return
+            minutes = min(int(args[1]) if len(args) == 2 else SHADOW_SETTINGS['report_minutes'], SHADOW_SETTINGS['retention_minutes'])
+            
+            embed = discord.Embed(
+                title="👻 シャドーモードのレポート",
+                description=f"直近{minutes}分に対処せずに評価した検出処理の結果です。",
+                color=discord.Color.blue()
+            )
+            rows = summarize_shadow_stats(ctx.guild.id, minutes)
+            for name, evaluated, hits, overlaps, total, worst, samples in sorted(rows, key=lambda row: row[2], reverse=True)[:20]:
+                lines = [
+                    f"評価 **{evaluated}** 件 / 一致 **{hits}** 件（{hits / evaluated * 100:.2f}%）",
+                    f"既存の検出と重複: {overlaps}件（一致の{overlaps / hits * 100:.0f}%）" if hits else "既存の検出と重複: -",
+                    f"処理時間: 平均 {format_duration(total / evaluated)} / 最大 {format_duration(worst)}（合計 {format_duration(total)}）"
+                ]
+                for recorded_at, user_id, channel_id, would_do, overlap in reversed(samples[-3:]):
+                    lines.append(f"<t:{int(recorded_at)}:R> <@{user_id}> <#{channel_id}> → {would_do}{'（重複）' if overlap else ''}")
+                embed.add_field(name=f"`{name}`", value="\n".join(lines)[:1024], inline=False)
+            if not rows:
+                embed.add_field(
+                    name="データなし",
+                    value="`n!pipeline shadow 段階名` またはルールの `\"shadow\": true` でシャドーモードにできます。",
+                    inline=False
+                )
+            embed.set_footer(text=f"重複 = 実際の検出処理も対処したメッセージ | 要求者: {ctx.author.display_name}")
+            await ctx.send(embed=embed)
+            
         else:
             # 無効なアクション
-            await ctx.send(f'❌ 無効なアクションです: `{action}`\n使用可能: status, toggle, settings, reset, unmute, stats')
+            await ctx.send(f'❌ 無効なアクションです: `{action}`\n使用可能: status, toggle, settings, reset, unmute, stats, shadow')
             
     except Exception as e:
         await ctx.send(f'❌ スパム対策コマンドの実行中にエラーが発生しました: {e}')
-        print(f"スパム対策コマンドエラー: {type(e).__name__}: {e}")
+        log_event('error', 'command_error', f"スパム対策コマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
+
+@bot.command(name='raidguard')
+@commands.has_permissions(manage_guild=True)
+async def raidguard(ctx, action: str = "status", *, value: Optional[str] = None):
+    """
+    参加レイド対策管理コマンド
+    使用例:
+    n!raidguard status - 参加レイド対策の状態を表示
+    n!raidguard enable - 参加レイド対策を有効にする
+    n!raidguard disable - 参加レイド対策を無効にする
+    n!raidguard verification on/off - ロックダウン時の認証レベル引き上げを設定
+    n!raidguard invites on/off - ロックダウン時の招待一時停止を設定
+    n!raidguard timeout on/off - バースト中の参加者のタイムアウトを設定
+    n!raidguard unlock - ロックダウンを手動で解除
+    """
+    if not ctx.guild:
+        await ctx.send('❌ このコマンドはサーバー内でのみ使用できます')
+        return
+    
+    settings = raid_guard_data[ctx.guild.id]
+    action = action.lower()
+    option_names = {
+        'verification': ('verification', '認証レベル引き上げ'),
+        'invites': ('pause_invites', '招待の一時停止'),
+        'timeout': ('timeout', '参加者のタイムアウト')
+    }
+    
+    try:
+        if action == "status":
+            embed = discord.Embed(
+                title="🚨 参加レイド対策ステータス",
+                color=discord.Color.green() if settings['enabled'] else discord.Color.red()
+            )
+            
+            status = "🟢 有効" if settings['enabled'] else "🔴 無効"
+            embed.add_field(name="現在の状態", value=status, inline=True)
+            
+            lockdown = raid_lockdowns.get(ctx.guild.id)
+            lockdown_text = f"🔒 ロックダウン中（残り{int(lockdown['until'] - time.time())}秒）" if lockdown else "なし"
+            embed.add_field(name="ロックダウン", value=lockdown_text, inline=True)
+            
+            embed.add_field(
+                name="📊 検出条件",
+                value=f"""
+参加数: {JOIN_RAID_SETTINGS['window_seconds']}秒間で{JOIN_RAID_SETTINGS['join_limit']}人以上
+新規アカウント: {JOIN_RAID_SETTINGS['window_seconds']}秒間で{JOIN_RAID_SETTINGS['young_join_limit']}人以上（作成後{JOIN_RAID_SETTINGS['young_account_age'] // 3600}時間未満）
+                """,
+                inline=False
+            )
+            
+            actions_text = "\n".join(
+                f"{'✅' if settings[key] else '❌'} {label}" for key, label in option_names.values()
+            )
+            embed.add_field(name="ロックダウン時の対処", value=actions_text, inline=False)
+            
+            tracker = join_trackers.get(ctx.guild.id)
+            if tracker:
+                age_labels = ["1時間未満", "1日未満", "7日未満", "30日未満", "30日以上"]
+                age_text = "\n".join(f"{label}: {count}人" for label, count in zip(age_labels, tracker['age_totals']))
+                embed.add_field(name="直近の参加者のアカウント年齢", value=age_text, inline=False)
+            
+            embed.set_footer(text=f"要求者: {ctx.author.display_name}")
+            await ctx.send(embed=embed)
+            
+        elif action in ("enable", "disable"):
+            settings['enabled'] = action == "enable"
+            embed = discord.Embed(
+                title="✅ 参加レイド対策有効化" if settings['enabled'] else "🔴 参加レイド対策無効化",
+                description=f"参加レイド対策を{'有効' if settings['enabled'] else '無効'}にしました。",
+                color=discord.Color.green() if settings['enabled'] else discord.Color.red()
+            )
+            await ctx.send(embed=embed)
+            
+        elif action in option_names:
+            if not value or value.lower() not in ['on', 'off']:
+                await ctx.send(f'❌ on または off を指定してください。\n使用例: `n!raidguard {action} on`')
+                return
+            
+            key, label = option_names[action]
+            settings[key] = value.lower() == 'on'
+            await ctx.send(f"✅ {label}を{'有効' if settings[key] else '無効'}にしました。")
+            
+        elif action == "unlock":
+            if ctx.guild.id not in raid_lockdowns:
+                await ctx.send('❌ 現在ロックダウンは行われていません。')
+                return
+            
+            lockdown = raid_lockdowns[ctx.guild.id]
+            if lockdown['task']:
+                lockdown['task'].cancel()
+            await end_raid_lockdown(ctx.guild)
+            await ctx.send('🔓 ロックダウンを解除しました。')
+            
+        else:
+            await ctx.send(f'❌ 無効なアクションです: `{action}`\n'
+                          f'使用可能: status, enable, disable, verification, invites, timeout, unlock')
+            
+    except Exception as e:
+        await ctx.send(f'❌ 参加レイド対策コマンドの実行中にエラーが発生しました: {e}')
+        log_event('error', 'command_error', f"参加レイド対策コマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
+
+@raidguard.error
+async def raidguard_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send('❌ このコマンドはサーバー管理権限を持つユーザーのみ使用できます')
+
+@bot.command(name='cooldown')
+@commands.has_permissions(manage_guild=True)
+async def cooldown(ctx, action: str = "status", command_name: Optional[str] = None, *, value: Optional[str] = None):
+    """
+    遊びコマンドのクールダウン管理コマンド
+    使用例:
+    n!cooldown status - クールダウンの設定を表示
+    n!cooldown set dice 3/10 - dice を10秒あたり3回までにする
+    n!cooldown set supurito 1/60 channel - supurito をチャンネルごとに60秒あたり1回までにする
+    n!cooldown off dice - dice のクールダウンをなくす
+    n!cooldown reset dice - dice を既定の設定に戻す
+    """
+    if not ctx.guild:
+        await ctx.send('❌ このコマンドはサーバー内でのみ使用できます')
+        return
+    
+    action = action.lower()
+    command_name = command_name.lower() if command_name else None
+    
+    try:
+        if action == "status":
+            embed = discord.Embed(title="⏳ クールダウン設定", color=discord.Color.blue())
+            lines = []
+            for name, default in COOLDOWN_DEFAULTS.items():
+                settings = get_cooldown(ctx.guild.id, name)
+                changed = " ✏️" if name in cooldown_data.get(ctx.guild.id, {}) else ""
+                if settings:
+                    lines.append(f"`{name}` {COOLDOWN_SCOPES[settings['scope']]}ごとに {settings['per']:g}秒あたり{settings['rate']}回{changed}")
+                else:
+                    lines.append(f"`{name}` なし{changed}")
+            embed.add_field(name="コマンド", value="\n".join(lines), inline=False)
+            embed.add_field(name="📊 統計", value=f"制限したコマンド: {cooldown_state['limited']}件 / 追跡中: {len(cooldown_slots)}件", inline=False)
+            embed.set_footer(text=f"✏️ = このサーバーで変更済み | 要求者: {ctx.author.display_name}")
+            await ctx.send(embed=embed)
+            
+        elif action in ("set", "off", "reset"):
+            if command_name not in COOLDOWN_DEFAULTS:
+                await ctx.send(f'❌ コマンド名を指定してください: {", ".join(COOLDOWN_DEFAULTS)}\n使用例: `n!cooldown {action} dice`')
+                return
+            
+            overrides = cooldown_data[ctx.guild.id]
+            if action == "reset":
+                overrides.pop(command_name, None)
+                await ctx.send(f"✅ `{command_name}` のクールダウンを既定の設定に戻しました。")
+                return
+            if action == "off":
+                overrides[command_name] = {'scope': 'user', 'rate': 0, 'per': 1.0}
+                await ctx.send(f"✅ `{command_name}` のクールダウンをなくしました。")
+                return
+            
+            match = re.match(r'^(\d+)/(\d+(?:\.\d+)?)(?:\s+(user|channel|guild))?$', (value or "").strip().lower())
+            if not match or not 1 <= int(match.group(1)) <= 100 or not 1 <= float(match.group(2)) <= 3600:
+                await ctx.send('❌ 回数/秒数（1-100回、1-3600秒）と、必要に応じてスコープ（user/channel/guild）を指定してください。\n'
+                              f'使用例: `n!cooldown set {command_name} 3/10 user`')
+                return
+            
+            scope = match.group(3) or COOLDOWN_DEFAULTS[command_name]['scope']
+            overrides[command_name] = {'scope': scope, 'rate': int(match.group(1)), 'per': float(match.group(2))}
+            await ctx.send(f"✅ `{command_name}` を{COOLDOWN_SCOPES[scope]}ごとに {float(match.group(2)):g}秒あたり{int(match.group(1))}回までにしました。")
+            
+        else:
+            await ctx.send(f'❌ 無効なアクションです: `{action}`\n'
+                          f'使用可能: status, set, off, reset')
+            
+    except Exception as e:
+        await ctx.send(f'❌ クールダウンコマンドの実行中にエラーが発生しました: {e}')
+        log_event('error', 'command_error', f"クールダウンコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
+
+@cooldown.error
+async def cooldown_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send('❌ このコマンドはサーバー管理権限を持つユーザーのみ使用できます')
+
+@bot.command(name='pipeline')
+@commands.has_permissions(manage_guild=True)
+async def pipeline(ctx, action: str = "status", stage_name: Optional[str] = None):
+    """
+    モデレーションのパイプライン管理コマンド
+    使用例:
+    n!pipeline status - 段階の実行順・有効/無効・処理時間を表示
+    n!pipeline disable banword - このサーバーで禁止ワードの段階を無効にする
+    n!pipeline enable banword - このサーバーで禁止ワードの段階を有効にする
+    n!pipeline shadow banword - 対処せずに評価だけ行う（結果は n!antispam shadow report で確認）
+    """
+    if not ctx.guild:
+        await ctx.send('❌ このコマンドはサーバー内でのみ使用できます')
+        return
+    
+    action = action.lower()
+    stage_names = [stage['name'] for stage in moderation_stages]
+    
+    try:
+        if action == "status":
+            enabled_features = guild_features.get(ctx.guild.id, 0)
+            overrides = moderation_stage_overrides.get(ctx.guild.id, {})
+            lines = []
+            for index, stage in enumerate(moderation_stages, 1):
+                mode = get_stage_mode(stage, ctx.guild.id, enabled_features)
+                if overrides.get(stage['name'], True) is False:
+                    state = "🔴 無効"
+                elif mode == 'live':
+                    state = "🟢 有効"
+                elif mode == 'shadow':
+                    state = "👻 シャドー"
+                else:
+                    state = "⚪ 機能が無効"
+                count, (p50, p99) = query_perf(f"stage:{stage['metric']}", 5)
+                timing = f" / p50 {format_duration(p50)}・p99 {format_duration(p99)}（{count}件）" if count else ""
+                lines.append(f"{index}. `{stage['name']}` {state} - {stage['description']}（目安 {stage['cost']}µs{timing}）")
+            
+            embed = discord.Embed(
+                title="🧪 モデレーションのパイプライン",
+                description="処理の軽い段階から順に実行し、最初に違反と判定した段階で止めます。",
+                color=discord.Color.blue()
+            )
+            embed.add_field(name="段階（実行順）", value="\n".join(lines) or "なし", inline=False)
+            embed.set_footer(text=f"処理時間は全サーバーの直近5分 | 要求者: {ctx.author.display_name}")
+            await ctx.send(embed=embed)
+            
+        elif action in ("enable", "disable", "shadow"):
+            if stage_name not in stage_names:
+                await ctx.send(f'❌ 段階名を指定してください: {", ".join(stage_names)}\n使用例: `n!pipeline {action} banword`')
+                return
+            
+            overrides = moderation_stage_overrides[ctx.guild.id]
+            if action == "enable":
+                overrides.pop(stage_name, None)
+            else:
+                overrides[stage_name] = 'shadow' if action == "shadow" else False
+            if not overrides:
+                del moderation_stage_overrides[ctx.guild.id]
+            state = {'enable': '有効', 'disable': '無効', 'shadow': 'シャドーモード（対処せずに評価だけ行う）'}[action]
+            await ctx.send(f"✅ このサーバーで `{stage_name}` の段階を{state}にしました。")
+            
+        else:
+            await ctx.send(f'❌ 無効なアクションです: `{action}`\n'
+                          f'使用可能: status, enable, disable, shadow')
+            
+    except Exception as e:
+        await ctx.send(f'❌ パイプラインコマンドの実行中にエラーが発生しました: {e}')
+        log_event('error', 'command_error', f"パイプラインコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
+
+@pipeline.error
+async def pipeline_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send('❌ このコマンドはサーバー管理権限を持つユーザーのみ使用できます')
+
+@bot.command(name='rules')
+@commands.has_permissions(manage_guild=True)
+async def rules(ctx, action: str = "status", *, value: Optional[str] = None):
+    """
+    モデレーションルール管理コマンド
+    使用例:
+    n!rules status - 読み込まれているルールと一致回数を表示
+    n!rules show - ルール定義（JSON）を表示
+    n!rules set {"rules": [...]} - ルールを設定（JSONファイルの添付も可）
+    n!rules reload - ルールファイル（rules/<サーバーID>.json）から読み込み直す
+    n!rules clear - ルールを削除
+    """
+    if not ctx.guild:
+        await ctx.send('❌ このコマンドはサーバー内でのみ使用できます')
+        return
+    
+    guild_id = ctx.guild.id
+    action = action.lower()
+    
+    try:
+        if action == "status":
+            ruleset = guild_rules.get(guild_id)
+            embed = discord.Embed(
+                title="📜 モデレーションルール",
+                color=discord.Color.green() if ruleset else discord.Color.red()
+            )
+            if ruleset:
+                lines = []
+                for rule, hits in zip(ruleset['rules'][:20], ruleset['hits']):
+                    conditions = ", ".join(ruleset['conditions'][key][0] for key in rule['conditions'])
+                    actions = ", ".join(action[0] for action in rule['actions'])
+                    lines.append(f"`{rule['name']}` {conditions} → {actions}（{hits}回）")
+                embed.add_field(name=f"ルール（{len(ruleset['rules'])}件、評価順）", value="\n".join(lines), inline=False)
+                embed.add_field(name="共有される条件", value=f"{len(ruleset['conditions'])}個", inline=True)
+                embed.add_field(name="読み込み", value=f"<t:{int(ruleset['loaded_at'])}:R>", inline=True)
+            else:
+                embed.description = "ルールは設定されていません。`n!rules set` またはルールファイルで設定できます。"
+            embed.set_footer(text=f"要求者: {ctx.author.display_name}")
+            await ctx.send(embed=embed)
+            
+        elif action == "show":
+            ruleset = guild_rules.get(guild_id)
+            if not ruleset:
+                await ctx.send('❌ ルールは設定されていません。')
+                return
+            source = json.dumps(json.loads(ruleset['source']), ensure_ascii=False, indent=2)
+            if len(source) > 1900:
+                await ctx.send("📜 ルール定義", file=discord.File(io.BytesIO(source.encode('utf-8')), filename=f"{guild_id}.json"))
+            else:
+                await ctx.send(f"```json\n{source}\n```")
+            
+        elif action == "set":
+            text = value
+            for attachment in ctx.message.attachments:
+                if attachment.filename.endswith('.json') and attachment.size <= RULE_SETTINGS['max_file_size']:
+                    text = (await attachment.read()).decode('utf-8', errors='replace')
+                    break
+            if not text:
+                await ctx.send('❌ ルール定義（JSON）を指定するか、JSONファイルを添付してください。\n使用例: `n!rules set {"rules": [{"name": "mentions", "when": {"mentions": 5}, "then": ["delete", "warn"]}]}`')
+                return
+            
+            # コードブロックで囲まれていても受け付ける
+            text = re.sub(r'^```(?:json)?\s*|\s*```$', '', text.strip())
+            try:
+                ruleset = compile_rules(text, set_by=ctx.author.id)
+            except ValueError as e:
+                await ctx.send(f'❌ ルールを読み込めませんでした: {e}')
+                return
+            
+            # タイムアウト・バンを行うルールは、同じ操作のコマンドを実行できるユーザーのみ設定できる
+            used = {action[0] for rule in ruleset['rules'] for action in rule['actions']}
+            missing = [permission for action, permission in RULE_ACTION_PERMISSIONS.items()
+                       if action in used and not getattr(ctx.author.guild_permissions, permission)]
+            if missing:
+                await ctx.send(f"❌ このルールを設定するには {', '.join(missing)} 権限が必要です。")
+                return
+            install_guild_rules(guild_id, ruleset)
+            await ctx.send(f"✅ ルールを{len(ruleset['rules'])}件設定しました（共有される条件 {len(ruleset['conditions'])}個）。")
+            
+        elif action == "reload":
+            try:
+                found = load_rule_file(guild_id)
+            except (OSError, ValueError) as e:
+                await ctx.send(f'❌ ルールファイルを読み込めませんでした: {e}')
+                return
+            if not found:
+                await ctx.send(f"❌ ルールファイルがありません: `{os.path.join(RULE_SETTINGS['directory'], f'{guild_id}.json')}`")
+                return
+            await ctx.send(f"✅ ルールファイルから{len(guild_rules[guild_id]['rules'])}件のルールを読み込みました。")
+            
+        elif action == "clear":
+            install_guild_rules(guild_id, None)
+            await ctx.send("✅ ルールを削除しました。")
+            
+        else:
+            await ctx.send(f'❌ 無効なアクションです: `{action}`\n'
+                          f'使用可能: status, show, set, reload, clear')
+            
+    except Exception as e:
+        await ctx.send(f'❌ ルールコマンドの実行中にエラーが発生しました: {e}')
+        log_event('error', 'command_error', f"ルールコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
+
+@rules.error
+async def rules_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send('❌ このコマンドはサーバー管理権限を持つユーザーのみ使用できます')
+
+@bot.command(name='trace')
+@commands.is_owner()
+async def trace(ctx, action: str = "status"):
+    """
+    ボット所有者専用: メッセージトレースの記録（オフラインでの設定調整用）
+    記録はプロセス全体（すべてのサーバー）のメッセージと禁止ワード設定を対象とするため、サーバーの管理者には開放しません。
+    使用例:
+    n!trace start - 記録を開始
+    n!trace stop - 記録を終了
+    n!trace status - 記録状態を表示
+    """
+    action = action.lower()
+    
+    try:
+        if action == "start":
+            if trace_recorder['file']:
+                await ctx.send(f"❌ 既に記録中です: `{trace_recorder['path']}`")
+                return
+            path = start_trace_recording()
+            await ctx.send(f'⏺️ メッセージトレースの記録を開始しました: `{path}`\n'
+                          f'内容は匿名化され、ID・時刻・文字数のみが元のまま保存されます。')
+            log_event('info', 'trace_started', f"⏺️ トレース記録開始: {path} | 実行者: {ctx.author}")
+            
+        elif action == "stop":
+            if not trace_recorder['file']:
+                await ctx.send('❌ 記録は行われていません。')
+                return
+            path = trace_recorder['path']
+            records = stop_trace_recording()
+            await ctx.send(f'⏹️ メッセージトレースの記録を終了しました: `{path}`（{records:,}件）')
+            log_event('info', 'trace_stopped', f"⏹️ トレース記録終了: {path} ({records}件) | 実行者: {ctx.author}", records=records)
+            
+        elif action == "status":
+            if trace_recorder['file']:
+                elapsed = int(time.time() - trace_recorder['started_at'])
+                await ctx.send(f"⏺️ 記録中: `{trace_recorder['path']}`（{trace_recorder['records']:,}件 / {elapsed}秒）")
+            else:
+                await ctx.send('⏹️ 記録は行われていません。')
+            
+        else:
+            await ctx.send(f'❌ 無効なアクションです: `{action}`\n使用可能: start, stop, status')
+            
+    except OSError as e:
+        await ctx.send(f'❌ トレースファイルの操作中にエラーが発生しました: {e}')
+        log_event('error', 'command_error', f"トレースコマンドエラー: {type(e).__name__}: {e}", key=f"command_error:{ctx.command}", command=str(ctx.command))
+
+@trace.error
+async def trace_error(ctx, error):
+    if isinstance(error, commands.NotOwner):
+        await ctx.send('❌ このコマンドはボットの所有者のみ使用できます')
 
 # エラーハンドリング
 @bot.event
 async def on_command_error(ctx, error):
     if isinstance(error, commands.CommandNotFound):
         return  # コマンドが見つからない場合は無視
+    if getattr(ctx, 'outbound_shed', False):
+        return  # 過負荷で受け付けなかった遊びコマンドには返信しない
+    retry_after = getattr(ctx, 'cooldown_retry_after', None)
+    if retry_after is not None:
+        if should_send_cooldown_notice(ctx.channel.id):
+            await ctx.send(f'⏳ クールダウン中です。{retry_after:.1f}秒後にもう一度お試しください', delete_after=5)
+        return
+    
+    if ctx.command:
+        command_errors[ctx.command.qualified_name] += 1
     
-    print(f'エラーが発生しました: {error}')
+    log_event('error', 'command_error', f'エラーが発生しました: {error}', key=f"command_error:{ctx.command}", command=str(ctx.command))
     await ctx.send('❌ コマンドの実行中にエラーが発生しました')
 
 if __name__ == '__main__':
@@ -0,0 +1,346 @@
+"""
+検出処理のワーカープロセス
+command.py の重い判定（禁止ワードの照合）を ProcessPoolExecutor で実行するときに、ワーカー側で読み込まれます。
+ボット本体（discord.py）に依存しないため、照合器の作成・照合・パターンの検証はイベントループ上の判定でも同じ関数を使います。
+
+禁止ワードには文字列のほか、パターンを登録できます。
+・ワイルドカード: * を含むもの（* は空白以外の0-10文字、例: f*ck）
+・正規表現: re: で始まるもの（例: re:fr[e3]{1,3} ）。後方参照・先読み・繰り返しの入れ子・重なる文字の繰り返しの連続
+  （[a-z]+[a-z]+ など）のように、処理時間が入力の長さに対して急激に増えうる構文は登録時に拒否し、
+  パターン中の文字・文字クラスから作った最悪に近い入力で処理時間も確認します。
+
+ワーカーはサーバーごとの照合器をバージョン付きでキャッシュし、キャッシュにない（または古い）場合は
+MATCHER_MISSING を返します。呼び出し側は照合器を添えて同じ項目を送り直します。
+
+登録時の検証は、照合中にGILを手放さない re のためにスレッドではイベントループを守れないので、
+このファイルを別プロセスとして起動して行います（python detector_worker.py に検証する内容をJSONで渡す）。
+"""
+import json
+import re
+import re._parser as re_parser
+import sys
+import time
+from collections import OrderedDict
+
+MATCHER_CACHE_SIZE = 256  # ワーカーごとにキャッシュするサーバー数
+MATCHER_MISSING = False   # 照合器がない項目の結果（一致なしは None、一致は禁止ワード）
+
+PATTERN_PREFIX = 're:'           # 正規表現の禁止ワードの接頭辞
+WILDCARD = '*'                   # ワイルドカード（空白以外の0-WILDCARD_MAX文字）
+WILDCARD_MAX = 10
+PATTERN_MAX_REPEAT = 100         # 繰り返し回数の上限（{n,m} の m）
+PATTERN_MAX_AMBIGUITY = (WILDCARD_MAX + 1) ** 2  # 重なる文字の繰り返しが続く場合の、分け方の数の上限（ワイルドカード2個分まで）
+PATTERN_SAMPLE_CHARS = 'a0 _-!あ'  # 否定の文字クラスや . に一致する文字を探すための候補
+PATTERN_COST = 50                # 照合の重さの目安（パターン1件 = 文字列の禁止ワード何件分か）
+PATTERN_PROBE_LENGTHS = (250, 1000, 4000)  # 検証に使う入力の長さ（短いものから試し、遅いパターンは早めに打ち切る。最後はDiscordのメッセージの上限）
+PATTERN_PROBE_BUDGET = 0.02      # 検証用の入力1件あたりの処理時間の上限（秒）
+
+PATTERN_GLOBAL_FLAGS = re.compile(r'\(\?[aiLmsux]+\)')  # 先頭の (?i) などのフラグ（1つのグループにまとめると正規表現として不正になる）
+
+matcher_cache = OrderedDict()  # guild_id -> (バージョン, 照合器)（LRU）
+
+def is_pattern_entry(word):
+    return word.startswith(PATTERN_PREFIX) or WILDCARD in word
+
+def pattern_source(entry):
+    """パターンの禁止ワードを正規表現にする"""
+    if entry.startswith(PATTERN_PREFIX):
+        return entry[len(PATTERN_PREFIX):]
+    return f'\\S{{0,{WILDCARD_MAX}}}'.join(re.escape(part) for part in entry.split(WILDCARD))
+
+CATEGORY_TESTS = {
+    re_parser.CATEGORY_DIGIT: lambda char: char.isdecimal(),
+    re_parser.CATEGORY_NOT_DIGIT: lambda char: not char.isdecimal(),
+    re_parser.CATEGORY_SPACE: lambda char: char.isspace(),
+    re_parser.CATEGORY_NOT_SPACE: lambda char: not char.isspace(),
+    re_parser.CATEGORY_WORD: lambda char: char.isalnum() or char == '_',
+    re_parser.CATEGORY_NOT_WORD: lambda char: not (char.isalnum() or char == '_')
+}
+
+def char_matches(node, char):
+    """1文字に一致する構文（文字・文字クラス・.）が char に一致するか（大文字小文字は区別しない）"""
+    op, av = node
+    if op == re_parser.ANY:
+        return char != '\n'
+    if op in (re_parser.LITERAL, re_parser.NOT_LITERAL):
+        return (chr(av).lower() == char.lower()) == (op == re_parser.LITERAL)
+    negate = False
+    for item_op, item_av in av:
+        if item_op == re_parser.NEGATE:
+            negate = True
+        elif item_op == re_parser.LITERAL and chr(item_av).lower() == char.lower():
+            return not negate
+        elif item_op == re_parser.RANGE and any(item_av[0] <= ord(variant) <= item_av[1] for variant in (char, char.lower(), char.upper())):
+            return not negate
+        elif item_op == re_parser.CATEGORY and CATEGORY_TESTS.get(item_av, lambda char: True)(char):
+            return not negate
+    return negate
+
+def sample_chars(node):
+    """1文字に一致する構文に一致する文字の例（検証用の入力と、文字の重なりの判定に使う）"""
+    op, av = node
+    candidates = []
+    if op == re_parser.LITERAL:
+        candidates.append(chr(av))
+    elif op == re_parser.IN:
+        for item_op, item_av in av:
+            if item_op == re_parser.LITERAL:
+                candidates.append(chr(item_av))
+            elif item_op == re_parser.RANGE:
+                candidates.extend((chr(item_av[0]), chr((item_av[0] + item_av[1]) // 2), chr(item_av[1])))
+    candidates.extend(PATTERN_SAMPLE_CHARS)
+    return [char for char in dict.fromkeys(candidates) if char_matches(node, char)][:3]
+
+def collect_pattern_chars(items, found):
+    """パターン中の1文字に一致する構文を出現順に集める"""
+    for op, av in items:
+        if op in (re_parser.LITERAL, re_parser.NOT_LITERAL, re_parser.ANY, re_parser.IN):
+            found.append((op, av))
+        elif op in (re_parser.MAX_REPEAT, re_parser.MIN_REPEAT, re_parser.POSSESSIVE_REPEAT):
+            collect_pattern_chars(av[2], found)
+        elif op == re_parser.SUBPATTERN:
+            collect_pattern_chars(av[-1], found)
+        elif op == re_parser.ATOMIC_GROUP:
+            collect_pattern_chars(av, found)
+        elif op == re_parser.BRANCH:
+            for branch in av[1]:
+                collect_pattern_chars(branch, found)
+    return found
+
+def item_shape(op, av, universe):
+    """構文1つが一致しうる文字（universe 中のもの）と、一致する長さの選び方の数（固定長なら1、上限なしは無限大）"""
+    if op in (re_parser.MAX_REPEAT, re_parser.MIN_REPEAT, re_parser.POSSESSIVE_REPEAT):
+        low, high, sub = av
+        chars, width = sequence_shape(sub, universe)
+        return chars, float('inf') if high == re_parser.MAXREPEAT else width * (high - low + 1)
+    if op == re_parser.SUBPATTERN:
+        return sequence_shape(av[-1], universe)
+    if op == re_parser.ATOMIC_GROUP:
+        return sequence_shape(av, universe)
+    if op == re_parser.BRANCH:
+        shapes = [sequence_shape(branch, universe) for branch in av[1]]
+        return set().union(*(chars for chars, width in shapes)), max(width for chars, width in shapes)
+    if op in (re_parser.LITERAL, re_parser.NOT_LITERAL, re_parser.ANY, re_parser.IN):
+        return {char for char in universe if char_matches((op, av), char)}, 1
+    return set(), 1  # ^ $ \b など、文字を消費しない構文
+
+def sequence_shape(items, universe):
+    chars = set()
+    width = 1
+    for op, av in items:
+        item_chars, item_width = item_shape(op, av, universe)
+        chars |= item_chars
+        width *= item_width
+    return chars, width
+
+def check_repeat_chains(items, universe):
+    """
+    長さの変わる繰り返しが、重なる文字を挟んで続くもの（[a-c]+[a-c]+ や .*b.* など）を探す
+    同じ文字の並びを繰り返しにどう分けるかの組み合わせだけ処理時間が増えるため、その数が上限を超えるものを拒否します。
+    """
+    chain_chars = set()
+    chain_width = 1
+    chain_length = 0
+    for op, av in flatten_sequence(items):
+        chars, width = item_shape(op, av, universe)
+        if width == 1:
+            # 固定長の構文: 繰り返しと重なる文字なら、前の繰り返しとの分け方はまだ決まらない
+            if not chars & chain_chars:
+                chain_chars, chain_width, chain_length = set(), 1, 0
+            continue
+        if chars & chain_chars:
+            chain_chars |= chars
+            chain_width *= width
+            chain_length += 1
+        else:
+            chain_chars, chain_width, chain_length = set(chars), width, 1
+        if chain_length >= 2 and chain_width > PATTERN_MAX_AMBIGUITY:
+            return "重なる文字の繰り返しが続いています（[a-z]+[a-z]+ や .*x.* など）。繰り返しの間を別の文字で区切るか、{0,10} のように上限を小さくしてください"
+    for op, av in items:
+        if op == re_parser.BRANCH:
+            for branch in av[1]:
+                problem = check_repeat_chains(branch, universe)
+                if problem:
+                    return problem
+    return None
+
+def flatten_sequence(items):
+    """グループを展開した、一続きの構文の並び（| の中は別に調べる）"""
+    for op, av in items:
+        if op == re_parser.SUBPATTERN:
+            yield from flatten_sequence(av[-1])
+        elif op == re_parser.ATOMIC_GROUP:
+            yield from flatten_sequence(av)
+        else:
+            yield op, av
+
+def contains_branch(items):
+    for op, av in flatten_sequence(items):
+        if op == re_parser.BRANCH:
+            return True
+    return False
+
+def check_pattern_tree(items, in_repeat=False):
+    """構文木から、処理時間が急激に増えうる構文を探す（問題があれば理由を返す）"""
+    for op, av in items:
+        if op in (re_parser.GROUPREF, re_parser.GROUPREF_EXISTS, re_parser.ASSERT, re_parser.ASSERT_NOT):
+            return "後方参照・先読み・後読みは使用できません"
+        if op in (re_parser.MAX_REPEAT, re_parser.MIN_REPEAT, re_parser.POSSESSIVE_REPEAT):
+            low, high, sub = av
+            if in_repeat:
+                return "繰り返しの入れ子（(a+)+ など）は使用できません"
+            if high != re_parser.MAXREPEAT and high > PATTERN_MAX_REPEAT:
+                return f"繰り返し回数は{PATTERN_MAX_REPEAT}回までです"
+            if high == re_parser.MAXREPEAT and contains_branch(sub):
+                return "上限のない繰り返しの中で | は使用できません（[ab]+ のように文字クラスを使ってください）"
+            problem = check_pattern_tree(sub, True)
+        elif op == re_parser.SUBPATTERN:
+            problem = check_pattern_tree(av[-1], in_repeat)
+        elif op == re_parser.ATOMIC_GROUP:
+            problem = check_pattern_tree(av, in_repeat)
+        elif op == re_parser.BRANCH:
+            problem = next((found for found in (check_pattern_tree(branch, in_repeat) for branch in av[1]) if found), None)
+        else:
+            problem = None
+        if problem:
+            return problem
+    return None
+
+def validate_pattern(entry, case_sensitive, probe=True):
+    """
+    パターンの禁止ワードを検証する（問題があれば理由を返す。問題なければNone）
+    probe を指定した場合は、最悪に近い入力での処理時間も確認します（登録時のみ。照合器の作成時は構文だけを確認）。
+    """
+    source = pattern_source(entry)
+    if not source:
+        return "パターンが空です"
+    if PATTERN_GLOBAL_FLAGS.match(source):
+        return "先頭のフラグ（(?i) など）は使用できません（大文字小文字の区別はサーバーの設定に従います。一部だけに指定する場合は (?i:...) を使ってください）"
+    try:
+        compiled = re.compile(f"({source})", 0 if case_sensitive else re.IGNORECASE)
+        tree = re_parser.parse(source)
+    except re.error as e:
+        return f"正規表現が正しくありません: {e}"
+    if compiled.groupindex:
+        return "名前付きグループは使用できません"
+    if compiled.search('') is not None:
+        return "空の文字列に一致するパターンは使用できません"
+    samples = [sample_chars(node) for node in collect_pattern_chars(tree, [])]
+    problem = check_pattern_tree(tree) or check_repeat_chains(tree, set(PATTERN_SAMPLE_CHARS).union(*samples))
+    if problem or not probe:
+        return problem
+    
+    probes = [(unit * length)[:length] for length in PATTERN_PROBE_LENGTHS for unit in probe_units(tree)]
+    for text in probes:
+        started_at = time.perf_counter()
+        compiled.search(text)
+        if time.perf_counter() - started_at > PATTERN_PROBE_BUDGET:
+            return "長いメッセージで処理に時間がかかるパターンです（+ や * の代わりに {0,10} のように上限を指定してください）"
+    return None
+
+def probe_units(tree):
+    """
+    検証用の入力の繰り返し単位（一致しかけては失敗する入力になるもの）
+    パターン中の各文字・文字クラスに一致する文字と、パターンの先頭部分に一致する文字の並び。
+    """
+    samples = [sample_chars(node) for node in collect_pattern_chars(tree, [])]
+    units = set(PATTERN_SAMPLE_CHARS).union(*samples)
+    skeleton = [chars[0] for chars in samples[:10] if chars]
+    units.update(''.join(skeleton[:end]) for end in range(2, len(skeleton) + 1))
+    return sorted(units)
+
+def compile_banword_matcher(words, case_sensitive):
+    """
+    禁止ワードの一覧を照合用の構造にする（大文字小文字を区別しない場合は小文字にしておく）
+    パターンは1つの正規表現にまとめ、一致したグループの番号から元の禁止ワードを引きます。
+    """
+    literals = []
+    sources = []
+    entries = {}  # グループ番号 -> パターンの禁止ワード
+    group = 1
+    for word in words:
+        if not is_pattern_entry(word):
+            literals.append((word if case_sensitive else word.lower(), word))
+            continue
+        if validate_pattern(word, case_sensitive, probe=False):
+            continue  # 登録時の検証を通っていないもの（共有ストアの古い設定など）は使わない
+        source = pattern_source(word)
+        entries[group] = word
+        group += 1 + re.compile(source).groups
+        sources.append(f"({source})")
+    return {
+        'case_sensitive': case_sensitive,
+        'words': tuple(literals),
+        'pattern': re.compile('|'.join(sources), 0 if case_sensitive else re.IGNORECASE) if sources else None,
+        'pattern_entries': entries,
+        'cost': len(literals) + PATTERN_COST * len(sources)
+    }
+
+def match_banwords(matcher, content):
+    """
+    内容に含まれる禁止ワードを返す（なければNone）
+    content は大文字小文字を区別しない場合は小文字にしたものを渡してください。
+    """
+    banned_word = match_literals(matcher, content)
+    if banned_word is None and matcher['pattern'] is not None:
+        return match_patterns(matcher, content)
+    return banned_word
+
+def match_literals(matcher, content):
+    for check_word, banned_word in matcher['words']:
+        if check_word in content:
+            return banned_word
+    return None
+
+def match_patterns(matcher, content):
+    match = matcher['pattern'].search(content)
+    return matcher['pattern_entries'][match.lastindex] if match else None
+
+def store_matcher(guild_id, version, matcher):
+    matcher_cache[guild_id] = (version, matcher)
+    matcher_cache.move_to_end(guild_id)
+    if len(matcher_cache) > MATCHER_CACHE_SIZE:
+        matcher_cache.popitem(last=False)
+
+def scan_batch(batch, matchers, eval_budget, max_slow):
+    """
+    まとめて送られた内容を照合する（ワーカープロセスで実行）
+    batch: [(guild_id, バージョン, 内容)]、matchers: {guild_id: (バージョン, 照合器)}（キャッシュに入れてから照合）
+    (結果, パターンの照合にかかった秒数) のリストを返します。パターンの照合が eval_budget 秒を超えた回数が
+    このバッチ内で max_slow に達したサーバーは、残りの項目でパターンを照合しません（停止は呼び出し側が秒数から判断します）。
+    """
+    for guild_id, (version, matcher) in matchers.items():
+        store_matcher(guild_id, version, matcher)
+
+    results = []
+    slow = {}  # guild_id -> このバッチで目安を超えた照合の回数
+    for guild_id, version, content in batch:
+        cached = matcher_cache.get(guild_id)
+        if cached is None or cached[0] != version:
+            results.append((MATCHER_MISSING, 0.0))
+            continue
+        matcher_cache.move_to_end(guild_id)
+        matcher = cached[1]
+        banned_word = match_literals(matcher, content)
+        if banned_word is not None or matcher['pattern'] is None or slow.get(guild_id, 0) >= max_slow:
+            results.append((banned_word, 0.0))
+            continue
+        started_at = time.perf_counter()
+        banned_word = match_patterns(matcher, content)
+        elapsed = time.perf_counter() - started_at
+        if elapsed > eval_budget:
+            slow[guild_id] = slow.get(guild_id, 0) + 1
+        results.append((banned_word, elapsed))
+    return results
+
+def warm_up():
+    """プロセスの起動を先に済ませるための空の処理"""
+    return True
+
+def main():
+    """登録時の検証の入口（標準入力の {"entry", "case_sensitive"} を検証し、{"problem"} を標準出力に書く）"""
+    request = json.load(sys.stdin)
+    json.dump({'problem': validate_pattern(request['entry'], request['case_sensitive'])}, sys.stdout)
+
+if __name__ == '__main__':
+    main()